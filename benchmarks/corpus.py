@@ -0,0 +1,76 @@
+from html import escape
+import random
+
+from zenith import class_to_url, link_label_blacklist, ZENITH_DIV_ID
+
+
+# number of links in each benchmark corpus
+CORPUS_SIZES = [250, 2500, 25000]
+# chance of linking a URL that was already linked
+DUPLICATE_RATE = 0.1
+
+
+def generate_corpus(num_links, site_url, seed=0):
+    """Generate a page shaped like the Zenith Games guide with synthetic links
+
+    Links sit in the post div in class sections that start at the boundary
+    URLs in class_to_url, in page order. The Docs links mix the URL shapes
+    found on the real page, including legacy links that need a redirect, and
+    the non-Docs links point at site_url so web pages can be served locally.
+
+    Args:
+        num_links (int): Number of links on the page
+        site_url (str): Base URL of the web pages, such as the stub server
+        seed (int, optional): Seed for the generated links. Defaults to 0.
+
+    Returns:
+        str: HTML of the page
+    """
+    rand = random.Random(seed)
+    boundary_urls = list(class_to_url.values())
+    section_size = max(1, num_links // len(boundary_urls))
+    urls = []
+    parts = ["<html><head><title>Synthetic Guides Guide</title></head><body>",
+             "<div class=\"post-body\" id=\"{}\">".format(ZENITH_DIV_ID)]
+    for i in range(num_links):
+        if i % section_size == 0 and i // section_size < len(boundary_urls):
+            url = boundary_urls[i // section_size]
+            parts += ["<b>Section {}</b><br>".format(i // section_size)]
+        elif urls and rand.random() < DUPLICATE_RATE:
+            url = rand.choice(urls)
+        else:
+            url = generate_url(rand, site_url, i)
+        urls += [url]
+        if not url.startswith(site_url) or rand.random() > 0.1:
+            label = "Guide {} ({})".format(i, rand.choice(["Alt", "PDF", "Docs", "Draft"]))
+        else:
+            label = rand.choice(link_label_blacklist)
+        parts += ["<a href=\"{}\">{}</a><br>\n".format(escape(url), escape(label, quote=False))]
+    parts += ["</div></body></html>\n"]
+    return "".join(parts)
+
+
+def generate_url(rand, site_url, i):
+    """Generate a guide URL in one of the shapes linked on the real page
+
+    Args:
+        rand (random.Random): Random generator for the corpus
+        site_url (str): Base URL of the web pages
+        i (int): Position of the link
+
+    Returns:
+        str: URL of the link
+    """
+    file_id = "1" + "".join(rand.choice("0123456789abcdefABCDEF_-") for _ in range(32))
+    shape = rand.random()
+    if shape < 0.45:
+        return "https://docs.google.com/document/d/{}/{}".format(
+            file_id, rand.choice(["edit", "pub", "edit?usp=sharing", "edit#", "edit?pli=1"]))
+    if shape < 0.6:
+        return "https://drive.google.com/file/d/{}/view".format(file_id)
+    if shape < 0.7:
+        return "https://docs.google.com/document/pub?id=" + file_id
+    if shape < 0.8:
+        # legacy links resolve to a new ID through a redirect
+        return "https://docs.google.com/Doc?docid=0A{}&hl=en".format(file_id[1:])
+    return "{}site/{}/guide.html".format(site_url, i)
@@ -0,0 +1,212 @@
+import hashlib
+import io
+from threading import Lock
+import time
+from urllib.parse import parse_qs, urlsplit
+import zipfile
+
+import httplib2
+
+
+# mimeTypes of the synthetic files with how often each is picked
+FILE_TYPES = [
+    ("application/vnd.google-apps.document", 14),
+    ("application/pdf", 4),
+    ("application/vnd.google-apps.spreadsheet", 2),
+]
+EXPORT_TYPES = {
+    "application/vnd.google-apps.document": "application/zip",
+    "application/vnd.google-apps.spreadsheet":
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+
+class FakeDriveService():
+    """Stand-in for the Drive v3 calls DriveDownloader makes
+
+    Every file ID maps to a synthetic file whose type, name and contents are
+    derived from the ID, so any corpus of IDs is served without setup. Each
+    round trip sleeps for latency seconds to model the network.
+    """
+    def __init__(self, latency=0.0, file_size=16 * 1024):
+        self.latency = latency
+        self.file_size = file_size
+        self.http = FakeHttp(self)
+        self.api_calls = 0
+        self.bytes_served = 0
+        self._lock = Lock()
+
+    def files(self):
+        return FakeFiles(self)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatchRequest(self, callback)
+
+    def round_trip(self, num_bytes=0):
+        """Count a request to the fake API and wait out its latency
+
+        Args:
+            num_bytes (int, optional): Bytes sent in the response. Defaults to 0.
+        """
+        with self._lock:
+            self.api_calls += 1
+            self.bytes_served += num_bytes
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_type(self, file_id):
+        """Get the mimeType of a synthetic file
+
+        Args:
+            file_id (str): ID of the file
+
+        Returns:
+            str: mimeType picked from the hash of the ID
+        """
+        weight = int(hashlib.md5(file_id.encode("utf-8")).hexdigest()[:4], 16) % \
+            sum(type_weight for _, type_weight in FILE_TYPES)
+        for mime_type, type_weight in FILE_TYPES:
+            if weight < type_weight:
+                return mime_type
+            weight -= type_weight
+
+    def get_metadata(self, file_id, fields=None):
+        """Get the metadata fields of a synthetic file
+
+        Args:
+            file_id (str): ID of the file
+            fields (str, optional): Comma separated fields to return. Defaults to all fields.
+
+        Returns:
+            dict: Metadata of the file
+        """
+        mime_type = self.get_type(file_id)
+        metadata = {
+            "id": file_id,
+            "name": "Guide " + file_id,
+            "mimeType": mime_type,
+            "modifiedTime": "2020-01-01T00:00:00.000Z",
+            "version": "1",
+        }
+        if mime_type in EXPORT_TYPES:
+            export_type = EXPORT_TYPES[mime_type]
+            metadata["exportLinks"] = {
+                export_type: "fake://export/{}?mimeType={}".format(file_id, export_type)}
+        else:
+            content = self.get_content(file_id, mime_type)
+            metadata["size"] = str(len(content))
+            metadata["md5Checksum"] = hashlib.md5(content).hexdigest()
+        if fields is None:
+            return metadata
+        fields = [field.strip() for field in fields.split(",")]
+        return {field: value for field, value in metadata.items() if field in fields}
+
+    def get_content(self, file_id, download_type):
+        """Get the bytes of a synthetic file as downloaded or exported
+
+        Args:
+            file_id (str): ID of the file
+            download_type (str): mimeType it is downloaded as
+
+        Returns:
+            bytes: Contents of the file
+        """
+        # regenerated on each request, so the fake doesn't hold the corpus in memory
+        # incompressible filler, so the zips are about file_size on disk
+        seed = hashlib.sha256(file_id.encode("utf-8")).digest()
+        filler = b"".join(hashlib.sha256(seed + bytes([i % 256, i // 256])).digest()
+                          for i in range(self.file_size // 32))
+        if download_type == "application/zip":
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zip_f:
+                zip_f.writestr("Guide{}.html".format(file_id),
+                               "<html><body><h1>Guide {0}</h1><p>Text of guide {0}</p>"
+                               "<img src=\"images/image1.png\"></body></html>".format(file_id))
+                zip_f.writestr("images/image1.png", filler)
+            return buffer.getvalue()
+        return filler
+
+
+class FakeFiles():
+    """Stand-in for the files resource of the Drive service
+    """
+    def __init__(self, service):
+        self.service = service
+
+    def get(self, fileId, fields=None):
+        return FakeRequest(self.service, "fake://metadata/" + fileId,
+                           lambda: self.service.get_metadata(fileId, fields))
+
+    def export_media(self, fileId, mimeType):
+        return FakeRequest(self.service, "fake://export/{}?mimeType={}".format(fileId, mimeType))
+
+    def get_media(self, fileId):
+        return FakeRequest(self.service, "fake://media/" + fileId)
+
+
+class FakeRequest():
+    """Stand-in for HttpRequest, with the attributes MediaIoBaseDownload reads
+    """
+    def __init__(self, service, uri, response_function=None):
+        self.service = service
+        self.uri = uri
+        self.headers = {}
+        self.http = service.http
+        self.response_function = response_function
+
+    def execute(self):
+        self.service.round_trip()
+        return self.response_function()
+
+
+class FakeBatchRequest():
+    """Stand-in for BatchHttpRequest, sending all of its requests in one round trip
+    """
+    def __init__(self, service, callback=None):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests += [(request_id, request)]
+
+    def execute(self):
+        self.service.round_trip()
+        for request_id, request in self.requests:
+            response, exception = None, None
+            try:
+                response = request.response_function()
+            except Exception as e:
+                exception = e
+            if self.callback is not None:
+                self.callback(request_id, response, exception)
+
+
+class FakeHttp():
+    """Stand-in for the httplib2.Http of the service, serving media by byte range
+    """
+    def __init__(self, service):
+        self.service = service
+
+    def request(self, uri, method="GET", headers=None, **kwargs):
+        split_uri = urlsplit(uri)
+        file_id = split_uri.path.lstrip("/")
+        if split_uri.netloc == "export":
+            download_type = parse_qs(split_uri.query)["mimeType"][0]
+        else:
+            download_type = self.service.get_type(file_id)
+        content = self.service.get_content(file_id, download_type)
+        range_header = (headers or {}).get("range")
+        if range_header is None:
+            self.service.round_trip(len(content))
+            return httplib2.Response({"status": 200,
+                                      "content-length": str(len(content))}), content
+        start, end = (int(byte) for byte in range_header[len("bytes="):].split("-"))
+        if start >= len(content):
+            self.service.round_trip()
+            return httplib2.Response({"status": 416,
+                                      "content-range": "bytes */{}".format(len(content))}), b""
+        chunk = content[start:end + 1]
+        self.service.round_trip(len(chunk))
+        content_range = "bytes {}-{}/{}".format(start, start + len(chunk) - 1, len(content))
+        return httplib2.Response({"status": 206, "content-range": content_range}), chunk
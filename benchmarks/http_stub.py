@@ -0,0 +1,131 @@
+import hashlib
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+import time
+from urllib.parse import parse_qs, urlsplit
+import urllib.request
+
+
+# hosts whose requests are answered by the stub instead of the network
+STUB_HOSTS = ["docs.google.com", "drive.google.com"]
+
+
+class StubServer():
+    """Local HTTP server standing in for Docs redirects and guide web pages
+
+    Legacy Docs links (docid, srcid and key queries) redirect to
+    /document/d/<new ID>/edit like Docs does, HEAD is answered without a body,
+    and /site/ serves pages with shared CSS and images that honor ETags.
+    """
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.requests = 0
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), StubRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.stub = self
+        self.port = self.httpd.server_address[1]
+        self.base_url = "http://127.0.0.1:{}/".format(self.port)
+        self._thread = None
+        self._old_opener = None
+
+    def __enter__(self):
+        self._thread = Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        # send urllib requests for the Docs hosts to the stub
+        self._old_opener = urllib.request._opener
+        urllib.request.install_opener(urllib.request.build_opener(StubHTTPSHandler(self.port)))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        urllib.request._opener = self._old_opener
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class StubHTTPSHandler(urllib.request.HTTPSHandler):
+    """HTTPS handler connecting to the stub for STUB_HOSTS
+
+    The request keeps its https URL, so redirects and response.url look the
+    same as they would from Docs.
+    """
+    def __init__(self, port):
+        super().__init__()
+        self.port = port
+
+    def https_open(self, req):
+        if req.host not in STUB_HOSTS:
+            return super().https_open(req)
+        return self.do_open(lambda host, **kwargs: http.client.HTTPConnection(
+            "127.0.0.1", self.port, **kwargs), req)
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def respond(self, send_body=True):
+        stub = self.server.stub
+        stub.requests += 1
+        if stub.latency:
+            time.sleep(stub.latency)
+        split_path = urlsplit(self.path)
+        query = parse_qs(split_path.query)
+        legacy_fields = [field for field in ["docid", "srcid", "key"] if field in query]
+        if legacy_fields:
+            # legacy links redirect to a new ID derived from the old one
+            old_id = query[legacy_fields[0]][0]
+            new_id = "1" + hashlib.sha1(old_id.encode("utf-8")).hexdigest()[:32]
+            self.send_response(302)
+            self.send_header("Location",
+                             "https://docs.google.com/document/d/{}/edit".format(new_id))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if split_path.path.startswith("/site/"):
+            body = get_site_content(split_path.path)
+        else:
+            body = b"<html><body>Document</body></html>"
+        etag = "\"" + hashlib.md5(body).hexdigest() + "\""
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/css" if self.path.endswith(".css") else
+                         "image/png" if self.path.endswith(".png") else "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def get_site_content(path):
+    """Get the body served for a path under /site/
+
+    Pages share one stylesheet and a handful of images, like the pages of one
+    blog or forum do.
+
+    Args:
+        path (str): Path of the request
+
+    Returns:
+        bytes: Body of the response
+    """
+    if path.endswith(".css"):
+        return b"body { font-family: serif; }\n" * 64
+    if path.endswith(".png"):
+        return hashlib.sha256(path.encode("utf-8")).digest() * 256
+    image_num = int(hashlib.md5(path.encode("utf-8")).hexdigest()[:2], 16) % 5
+    return ("<html><head><link rel=\"stylesheet\" href=\"/site/style.css\"></head>"
+            "<body><h1>Guide at {0}</h1><p>Text of the guide at {0}</p>"
+            "<img src=\"/site/image{1}.png\"></body></html>".format(path, image_num)
+            ).encode("utf-8")
@@ -0,0 +1,319 @@
+"""Run the archive pipeline offline against synthetic corpora and record its performance
+
+Usage:
+    python -m benchmarks.run [--sizes 250 2500 25000] [--compare RESULTS_JSON]
+
+Each corpus is archived in a temporary folder, with Drive served by
+FakeDriveService and Docs redirects and web pages served by StubServer, so no
+credentials or network are needed. The stages are timed one module at a
+time, then the whole Pipeline is timed cold, rerun and resumed from its
+checkpoints. Results are written to benchmarks/results, or to --output.
+"""
+import argparse
+from contextlib import redirect_stdout
+from datetime import datetime
+import io
+import json
+from multiprocessing.dummy import Pool
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.corpus import CORPUS_SIZES, generate_corpus
+from benchmarks.fake_drive import FakeDriveService
+from benchmarks.http_stub import StubServer
+from extract import extract_zip
+from gdrive import DriveDownloader
+from html_export import archive_links, export_archive
+from pipeline import CHECKPOINT_DIR, Pipeline, write_run
+from sitemap import update_sitemap
+from web import WebArchiver
+from zenith import ZenithParser
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class StageTimer():
+    """Time pipeline stages and record their throughput and peak memory
+    """
+    def __init__(self, trace_memory=True, service=None, server=None):
+        self.trace_memory = trace_memory
+        self.service = service
+        self.server = server
+        self.stages = []
+
+    def run(self, name, function, num_items=None):
+        """Run a stage with its output captured
+
+        Args:
+            name (str): Name of the stage
+            function (function): Stage to run, returning the number of items processed
+                                 if num_items isn't given
+            num_items (int, optional): Number of items the stage processes. Defaults to None.
+
+        Returns:
+            The value returned by function
+        """
+        api_calls = self.service.api_calls if self.service is not None else 0
+        http_requests = self.server.requests if self.server is not None else 0
+        output = io.StringIO()
+        if self.trace_memory:
+            tracemalloc.start()
+        start_time = time.perf_counter()
+        with redirect_stdout(output):
+            result = function()
+        seconds = time.perf_counter() - start_time
+        peak_bytes = None
+        if self.trace_memory:
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if num_items is None:
+            num_items = result
+        stage = {
+            "name": name,
+            "seconds": round(seconds, 4),
+            "items": num_items,
+            "items_per_second": round(num_items / seconds, 1) if seconds > 0 else None,
+            "peak_mib": round(peak_bytes / 1024 ** 2, 2) if peak_bytes is not None else None,
+            # the pipeline reports failures by printing them
+            "errors": output.getvalue().count("Exception for"),
+        }
+        if self.service is not None:
+            stage["drive_calls"] = self.service.api_calls - api_calls
+        if self.server is not None:
+            stage["http_requests"] = self.server.requests - http_requests
+        self.stages += [stage]
+        print("  {name:<24} {seconds:>9.3f} s {items:>7} items {rate:>11} /s {peak:>9} MiB"
+              "{errors}".format(name=name, seconds=seconds, items=num_items,
+                                rate=str(stage["items_per_second"]),
+                                peak="-" if peak_bytes is None else stage["peak_mib"],
+                                errors="  ({} errors)".format(stage["errors"])
+                                if stage["errors"] else ""))
+        return result
+
+
+def run_corpus(num_links, args):
+    """Archive a synthetic corpus in a temporary folder, timing each stage
+
+    Args:
+        num_links (int): Number of links in the corpus
+        args (argparse.Namespace): Benchmark options
+
+    Returns:
+        dict: Stage results and peak resident memory of the run
+    """
+    print("Corpus of {} links".format(num_links))
+    old_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="pfguide-bench-") as work_dir, \
+            StubServer(latency=args.http_latency) as server:
+        os.chdir(work_dir)
+        try:
+            os.makedirs("archive")
+            with open("zenith.html", "w") as f:
+                f.write(generate_corpus(num_links, server.base_url, seed=args.seed))
+            service = FakeDriveService(latency=args.drive_latency, file_size=args.file_size)
+            timer = StageTimer(trace_memory=not args.no_memory, service=service, server=server)
+            run_stages(timer, service, server, args)
+            # the whole pipeline runs in its own folder, so it starts without the caches above
+            os.makedirs(os.path.join("pipeline", "archive"))
+            os.chdir("pipeline")
+            run_pipeline(timer, FakeDriveService(latency=args.drive_latency,
+                                                 file_size=args.file_size), args)
+        finally:
+            os.chdir(old_cwd)
+    return {"stages": timer.stages, "max_rss_mib": get_max_rss_mib()}
+
+
+def run_stages(timer, service, server, args):
+    """Run the pipeline stages on the corpus in the working folder
+
+    Args:
+        timer (StageTimer): Timer recording the stages
+        service (FakeDriveService): Drive service for the downloaders
+        server (StubServer): Server for redirects and web pages
+        args (argparse.Namespace): Benchmark options
+    """
+    def parse():
+        return ZenithParser("zenith.html").get_guide_records()
+
+    num_records = timer.run("zenith_parse_cold", lambda: len(parse()))
+    records = timer.run("zenith_parse_cached", parse, num_items=num_records)
+    docs_urls = records.unique_urls(is_docs=True)
+
+    def new_downloader():
+        # the fake service has no quota, so only its latency limits the rate
+        return DriveDownloader(None, num_threads=args.threads, max_requests_per_second=None,
+                               service=service)
+
+    def get_doc_ids():
+        return new_downloader().get_doc_ids(docs_urls)
+
+    docs_file_ids = timer.run("get_doc_ids_cold", get_doc_ids, num_items=len(docs_urls))
+    timer.run("get_doc_ids_cached", get_doc_ids, num_items=len(docs_urls))
+    for docs_url, docs_file_id in zip(docs_urls, docs_file_ids):
+        records.set_file_id(docs_url, docs_file_id)
+    file_ids = [file_id for file_id in dict.fromkeys(docs_file_ids) if file_id is not None]
+    d_downloader = new_downloader()
+    timer.run("prefetch_metadata", lambda: d_downloader.prefetch_metadata(file_ids),
+              num_items=len(file_ids))
+    file_paths = timer.run("save_docs", lambda: d_downloader.save_docs(file_ids),
+                           num_items=len(file_ids))
+    d_downloader.manifest.save()
+    zip_paths = [file_path for file_path in file_paths
+                 if file_path is not None and file_path.endswith(".zip")]
+
+    def extract_zips():
+        thread_pool = Pool(args.threads)
+        html_paths = thread_pool.map(extract_zip, zip_paths)
+        thread_pool.close()
+        return html_paths
+
+    html_paths = timer.run("extract_zips_cold", extract_zips, num_items=len(zip_paths))
+    timer.run("extract_zips_cached", extract_zips, num_items=len(zip_paths))
+    # point the records at the extracted HTML like archive_records does
+    file_paths = dict(zip(file_ids, file_paths))
+    html_paths = dict(zip(zip_paths, html_paths))
+    for docs_url, docs_file_id in zip(docs_urls, docs_file_ids):
+        file_path = file_paths.get(docs_file_id)
+        records.set_archive_path(docs_url, html_paths.get(file_path, file_path))
+    # rerun the whole Docs step the way main.py does with everything archived
+    timer.run("archive_records_rerun",
+              lambda: new_downloader().archive_records(records), num_items=len(docs_urls))
+    web_urls = [url for url in records.unique_urls(is_docs=False)
+                if url.startswith(server.base_url)]
+    archiver = WebArchiver(num_threads=args.threads)
+    web_paths = timer.run("save_webpages_cold", lambda: archiver.save_webpages(web_urls),
+                          num_items=len(web_urls))
+    timer.run("save_webpages_revalidate",
+              lambda: WebArchiver(num_threads=args.threads).save_webpages(web_urls),
+              num_items=len(web_urls))
+    for url, web_path in zip(web_urls, web_paths):
+        records.set_archive_path(url, web_path)
+    num_archived = sum(record.archive_path is not None for record in records)
+    timer.run("archive_links", lambda: archive_links(records), num_items=num_archived)
+    timer.run("update_sitemap", update_sitemap, num_items=num_archived)
+    timer.run("export_archive", lambda: export_archive(records), num_items=num_archived)
+
+
+def run_pipeline(timer, service, args):
+    """Run the whole Pipeline on the corpus one folder up, timing its checkpoint overhead
+
+    Args:
+        timer (StageTimer): Timer recording the runs
+        service (FakeDriveService): Drive service for the downloaders
+        args (argparse.Namespace): Benchmark options
+    """
+    def run_pipeline():
+        d_downloader = DriveDownloader(None, num_threads=args.threads,
+                                       max_requests_per_second=None, service=service)
+        # web pages are left out, since the corpus links some real sites at class boundaries
+        records = Pipeline(d_downloader, backup_path=os.path.join("..", "zenith.html")).run()
+        return sum(record.archive_path is not None for record in records)
+
+    num_archived = timer.run("pipeline_cold", run_pipeline)
+    timer.run("pipeline_rerun", run_pipeline, num_items=num_archived)
+    # a run interrupted during export resumes from the checkpoints of every other stage
+    write_run({"complete": False})
+    os.remove(os.path.join(CHECKPOINT_DIR, "export.json"))
+    timer.run("pipeline_resume", run_pipeline, num_items=num_archived)
+
+
+def get_max_rss_mib():
+    """Get the peak resident memory of the process
+
+    Returns:
+        float: Peak resident memory in MiB or None where it can't be read
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on macOS and in KiB elsewhere
+    if sys.platform == "darwin":
+        return round(max_rss / 1024 ** 2, 1)
+    return round(max_rss / 1024, 1)
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(old_results, new_results):
+    """Print the change in each stage time between two result files
+
+    Args:
+        old_results (dict): Earlier results
+        new_results (dict): Results of this run
+    """
+    print("Compared to {} ({}):".format(old_results["time"], old_results.get("commit")))
+    for size, run in new_results["runs"].items():
+        if size not in old_results["runs"]:
+            continue
+        print("Corpus of {} links".format(size))
+        old_stages = {stage["name"]: stage for stage in old_results["runs"][size]["stages"]}
+        for stage in run["stages"]:
+            old_stage = old_stages.get(stage["name"])
+            if old_stage is None:
+                continue
+            ratio = old_stage["seconds"] / stage["seconds"] if stage["seconds"] > 0 else None
+            print("  {:<24} {:>9.3f} s -> {:>9.3f} s  {}".format(
+                stage["name"], old_stage["seconds"], stage["seconds"],
+                "{:.2f}x speedup".format(ratio) if ratio is not None else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the archive pipeline offline")
+    parser.add_argument("--sizes", type=int, nargs="+", default=CORPUS_SIZES,
+                        help="numbers of links in the corpora to run")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="threads for downloads, extraction and web pages")
+    parser.add_argument("--drive-latency", type=float, default=0.0,
+                        help="seconds each fake Drive request takes")
+    parser.add_argument("--http-latency", type=float, default=0.0,
+                        help="seconds each stub HTTP request takes")
+    parser.add_argument("--file-size", type=int, default=16 * 1024,
+                        help="approximate bytes in each fake Drive file")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the corpora")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip tracing peak memory, which slows stages down")
+    parser.add_argument("--compare", help="earlier results JSON to compare against")
+    parser.add_argument("--output", help="path to write results to")
+    args = parser.parse_args()
+
+    results = {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": {key: value for key, value in vars(args).items()
+                    if key not in ["compare", "output"]},
+        "runs": {},
+    }
+    for num_links in args.sizes:
+        results["runs"][str(num_links)] = run_corpus(num_links, args)
+    output_path = args.output
+    if output_path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output_path = os.path.join(RESULTS_DIR,
+                                   datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print("Results written to " + output_path)
+    if args.compare is not None:
+        with open(args.compare, encoding="utf-8") as f:
+            compare_results(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import json
+import os
+from threading import Lock
+import time
+
+
+CACHE_DIR = "cache"
+
+
+class JsonCache():
+    """Thread safe dict persisted to a JSON file, with optional expiry of entries
+    """
+    def __init__(self, cache_name, ttl=None):
+        """
+        Args:
+            cache_name (str): Name of the JSON file in CACHE_DIR
+            ttl (float, optional): Seconds before an entry expires. Defaults to None (never).
+        """
+        self.cache_path = os.path.join(CACHE_DIR, cache_name)
+        self.ttl = ttl
+        self.entries = {}
+        self._lock = Lock()
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path, encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    def get(self, key, default=None):
+        """Get a value from the cache
+
+        Args:
+            key (str): Key for the value
+            default (optional): Value returned for missing or expired keys. Defaults to None.
+
+        Returns:
+            Cached value or default
+        """
+        with self._lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return default
+        if self.ttl is not None and time.time() - entry["time"] > self.ttl:
+            return default
+        return entry["value"]
+
+    def set(self, key, value):
+        """Set a value in the cache
+
+        Args:
+            key (str): Key for the value
+            value: JSON serializable value
+        """
+        with self._lock:
+            self.entries[key] = {"time": time.time(), "value": value}
+
+    def save(self):
+        """Write the cache to disk, dropping expired entries
+        """
+        now = time.time()
+        with self._lock:
+            if self.ttl is not None:
+                self.entries = {key: entry for key, entry in self.entries.items()
+                                if now - entry["time"] <= self.ttl}
+            cache_str = json.dumps(self.entries, ensure_ascii=False)
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = self.cache_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(cache_str)
+        os.replace(tmp_path, self.cache_path)
+
+
+# archive files written or removed since their checksums were last recorded, one per line,
+# kept on disk so a run that is interrupted still records them when it resumes
+WRITTEN_PATHS_PATH = os.path.join(CACHE_DIR, "written_paths.txt")
+_written_lock = Lock()
+
+
+def note_written(*file_paths):
+    """Note archive files that were written or removed, so their checksums are recorded again
+
+    Args:
+        *file_paths (str): Paths of the files
+    """
+    if not file_paths:
+        return
+    lines = "".join(os.path.normpath(file_path) + "\n" for file_path in file_paths)
+    with _written_lock:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(WRITTEN_PATHS_PATH, "a", encoding="utf-8") as f:
+            f.write(lines)
+
+
+def read_written_paths():
+    """Read the archive files noted as written or removed
+
+    Returns:
+        set: Normalized paths of the files
+    """
+    with _written_lock:
+        if not os.path.exists(WRITTEN_PATHS_PATH):
+            return set()
+        with open(WRITTEN_PATHS_PATH, encoding="utf-8") as f:
+            return {line.rstrip("\n") for line in f if line.strip()}
+
+
+def clear_written_paths():
+    """Forget the noted files once their checksums are recorded
+    """
+    with _written_lock:
+        if os.path.exists(WRITTEN_PATHS_PATH):
+            os.remove(WRITTEN_PATHS_PATH)
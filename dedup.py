@@ -0,0 +1,231 @@
+import hashlib
+import os
+from multiprocessing.dummy import Pool
+import shutil
+import zipfile
+
+from cache import JsonCache, note_written
+from extract import EXTRACTION_MARKER, read_marker, write_marker
+from utils import print_exception
+
+
+ARCHIVE_DIR = "archive"
+# content-addressed store of extracted files, named by their SHA-256
+STORE_DIR = os.path.join(ARCHIVE_DIR, ".objects")
+
+
+def dedupe_archive(mode="link", num_threads=4):
+    """Store identical files from extracted exports only once
+
+    Files are hashed once and kept in STORE_DIR. In "link" mode duplicates are
+    replaced with hardlinks to the stored copy. In "rewrite" mode duplicates
+    are deleted and the HTML in their folder is rewritten to point at the
+    stored copy, which also shrinks the published site.
+
+    Args:
+        mode (str, optional): "link" or "rewrite". Defaults to "link".
+        num_threads (int, optional): Number of threads to hash files on. Defaults to 4.
+
+    Returns:
+        int: Number of bytes freed
+    """
+    if mode not in ["link", "rewrite"]:
+        raise ValueError("Unexpected dedupe mode:\n" + mode)
+    # hash extracted assets on multiple threads, reusing hashes of unchanged files
+    hash_cache = JsonCache("content_hashes.json")
+    assets = [(folder_path, file_name) for folder_path in extracted_folders()
+              for file_name in folder_assets(folder_path)]
+    asset_paths = [os.path.join(folder_path, file_name) for folder_path, file_name in assets]
+    thread_pool = Pool(num_threads)
+    digests = thread_pool.map(lambda file_path: hash_file(file_path, hash_cache), asset_paths)
+    # close threads, but don't bother waiting for them to free resources
+    thread_pool.close()
+    hash_cache.save()
+    bytes_freed = 0
+    folder_moves = {}
+    for (folder_path, file_name), file_path, digest in zip(assets, asset_paths, digests):
+        blob_path = get_blob_path(digest, os.path.splitext(file_path)[1])
+        if not os.path.exists(blob_path):
+            # the first copy of the content becomes the stored copy
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            link_or_copy(file_path, blob_path)
+            note_written(blob_path)
+            continue
+        if os.path.samefile(file_path, blob_path):
+            continue
+        bytes_freed += os.path.getsize(file_path)
+        if mode == "link":
+            tmp_path = file_path + ".tmp"
+            link_or_copy(blob_path, tmp_path)
+            os.replace(tmp_path, file_path)
+            note_written(file_path)
+        else:
+            folder_moves.setdefault(folder_path, {})[file_name] = blob_path
+    for folder_path, moves in folder_moves.items():
+        rewrite_references(folder_path, moves)
+    return bytes_freed
+
+
+def collect_garbage():
+    """Remove zips whose extracted folders are verified to match them
+
+    Returns:
+        list: Paths of the removed zips
+    """
+    removed_paths = []
+    for folder_path in extracted_folders():
+        zip_path = folder_path + ".zip"
+        if not os.path.exists(zip_path):
+            continue
+        try:
+            if verify_extraction(zip_path):
+                os.remove(zip_path)
+                note_written(zip_path)
+                removed_paths += [zip_path]
+        except Exception as e:
+            print_exception("Exception for ZIP:", zip_path, e)
+    return removed_paths
+
+
+def verify_extraction(zip_path):
+    """Check that every file extracted from a zip is present and has the zip's CRC
+
+    Args:
+        zip_path (str): Path to the zip file
+
+    Returns:
+        bool: Whether the extracted folder holds the zip's contents
+    """
+    folder_path = zip_path[:-4]
+    marker = read_marker(folder_path)
+    if marker is None:
+        return False
+    with zipfile.ZipFile(zip_path, "r") as zip_f:
+        entries = {zip_info.filename: [zip_info.CRC, zip_info.file_size]
+                   for zip_info in zip_f.filelist}
+    if entries != marker["entries"]:
+        return False
+    # moved files live in the store and rewritten files were changed on purpose
+    skipped_names = set(marker.get("moved", {})) | set(marker.get("rewritten", []))
+    for file_name, (crc, file_size) in entries.items():
+        if file_name in skipped_names or file_name.endswith("/"):
+            continue
+        file_path = os.path.join(folder_path, file_name)
+        if not os.path.exists(file_path) or os.path.getsize(file_path) != file_size:
+            return False
+        with open(file_path, "rb") as f:
+            if zipfile.crc32(f.read()) != crc:
+                return False
+    return True
+
+
+def rewrite_references(folder_path, moves):
+    """Point the HTML in a folder at stored copies and delete the duplicates
+
+    Args:
+        folder_path (str): Path to the extracted folder
+        moves (dict): Relative file names mapped to their stored copies
+    """
+    marker = read_marker(folder_path)
+    rewritten = set(marker.get("rewritten", []))
+    for file_name in marker["entries"]:
+        if not file_name.endswith(".html"):
+            continue
+        html_path = os.path.join(folder_path, file_name)
+        with open(html_path, encoding="utf-8") as f:
+            html = f.read()
+        html_dir = os.path.dirname(html_path)
+        for moved_name, blob_path in moves.items():
+            blob_url = os.path.relpath(blob_path, html_dir).replace("\\", "/")
+            html = html.replace("\"" + moved_name + "\"", "\"" + blob_url + "\"")
+        # replace the file rather than writing through a hardlink to it
+        tmp_path = html_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(html)
+        os.replace(tmp_path, html_path)
+        note_written(html_path)
+        rewritten.add(file_name)
+    for moved_name in moves:
+        os.remove(os.path.join(folder_path, moved_name))
+        note_written(os.path.join(folder_path, moved_name))
+    marker["moved"] = {**marker.get("moved", {}), **moves}
+    marker["rewritten"] = sorted(rewritten)
+    write_marker(folder_path, marker)
+
+
+def hash_file(file_path, hash_cache=None):
+    """Get the SHA-256 of a file, reusing the cached hash if it hasn't changed
+
+    Args:
+        file_path (str): Path to the file
+        hash_cache (JsonCache, optional): Cache of earlier hashes. Defaults to None.
+
+    Returns:
+        str: Hex digest of the file
+    """
+    stat = os.stat(file_path)
+    if hash_cache is not None:
+        cached = hash_cache.get(file_path)
+        if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+    if hash_cache is not None:
+        hash_cache.set(file_path, [stat.st_size, stat.st_mtime_ns, digest])
+    return digest
+
+
+def get_blob_path(digest, extension):
+    """Get the stored path for content with the given hash
+
+    Args:
+        digest (str): Hex digest of the content
+        extension (str): File extension to keep so the content is served correctly
+
+    Returns:
+        str: Path in the store
+    """
+    return os.path.join(STORE_DIR, digest[:2], digest + extension)
+
+
+def link_or_copy(src_path, dst_path):
+    """Hardlink a file, copying it on file systems without hardlinks
+
+    Args:
+        src_path (str): Existing file
+        dst_path (str): New path
+    """
+    try:
+        os.link(src_path, dst_path)
+    except OSError:
+        shutil.copyfile(src_path, dst_path)
+
+
+def extracted_folders():
+    """Get the folders in the archive extracted from zips
+
+    Returns:
+        list: Paths of the extracted folders
+    """
+    return [entry.path for entry in os.scandir(ARCHIVE_DIR)
+            if entry.is_dir() and os.path.exists(os.path.join(entry.path, EXTRACTION_MARKER))]
+
+
+def folder_assets(folder_path):
+    """Get the extracted files in a folder that aren't HTML
+
+    Args:
+        folder_path (str): Path to the extracted folder
+
+    Returns:
+        list: Names of the files relative to the folder
+    """
+    marker = read_marker(folder_path)
+    moved_names = marker.get("moved", {})
+    return [file_name for file_name in marker["entries"]
+            if not file_name.endswith(".html") and not file_name.endswith("/") and
+            file_name not in moved_names and
+            os.path.exists(os.path.join(folder_path, file_name))]
@@ -0,0 +1,127 @@
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+
+from cache import note_written
+from runlog import count, span
+
+
+# file recording the zip entries a folder was extracted from
+EXTRACTION_MARKER = ".extracted.json"
+
+
+def extract_zip(zip_path):
+    """Extract a zipped HTML export, skipping folders that already match the zip
+
+    A folder matches when its marker lists the same entries with the same CRC
+    and size as the zip's central directory and every entry still exists, so
+    unchanged zips cost a directory read and a few stats.
+
+    Args:
+        zip_path (str): Path to the zip file
+
+    Returns:
+        str: Path to the extracted HTML file
+    """
+    with span(zip_path, kind="file", stage="extract"):
+        return _extract_zip(zip_path)
+
+
+def _extract_zip(zip_path):
+    folder_path = zip_path[:-4]
+    if not os.path.exists(zip_path):
+        # zips are removed once their extraction is verified, so use the folder as is
+        marker = read_marker(folder_path)
+        if marker is None:
+            raise FileNotFoundError("Missing zip and extracted folder:\n" + zip_path)
+        count("cache_hits")
+        return os.path.join(folder_path, marker["html_file_name"])
+    with zipfile.ZipFile(zip_path, "r") as zip_f:
+        # collect entries and find the HTML file in a single pass
+        entries = {}
+        html_file_name = None
+        for zip_info in zip_f.filelist:
+            file_name = zip_info.filename
+            entries[file_name] = [zip_info.CRC, zip_info.file_size]
+            if html_file_name is None and len(file_name) > 5 and file_name[-5:] == ".html":
+                html_file_name = file_name
+        marker = read_marker(folder_path)
+        if marker is None or marker["entries"] != entries or \
+           not all(os.path.exists(os.path.join(folder_path, file_name)) or
+                   file_name in marker.get("moved", {})
+                   for file_name in entries):
+            extract_members(zip_f, folder_path)
+            write_marker(folder_path, {"entries": entries, "html_file_name": html_file_name})
+            count("bytes", sum(file_size for _, file_size in entries.values()))
+        else:
+            count("cache_hits")
+    return os.path.join(folder_path, html_file_name)
+
+
+def extract_members(zip_f, folder_path):
+    """Extract a zip into a folder, replacing files rather than writing through them
+
+    Extracted files may be hardlinks into the content store shared by other
+    guides, so each file is extracted beside the folder and moved over the old
+    one instead of being overwritten in place.
+
+    Args:
+        zip_f (ZipFile): Open zip file
+        folder_path (str): Path to the extracted folder
+    """
+    os.makedirs(folder_path, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=".extract-", dir=os.path.dirname(folder_path) or ".")
+    try:
+        zip_f.extractall(tmp_dir)
+        for dir_path, _, file_names in os.walk(tmp_dir):
+            dst_dir = os.path.join(folder_path, os.path.relpath(dir_path, tmp_dir))
+            os.makedirs(dst_dir, exist_ok=True)
+            for file_name in file_names:
+                os.replace(os.path.join(dir_path, file_name), os.path.join(dst_dir, file_name))
+                note_written(os.path.join(dst_dir, file_name))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def is_archived(file_path):
+    """Check if a file is in the archive, counting zips that were extracted and removed
+
+    Args:
+        file_path (str): Archive path of the file
+
+    Returns:
+        bool: Whether the file or its extracted folder exists
+    """
+    if os.path.exists(file_path):
+        return True
+    return file_path[-4:] == ".zip" and read_marker(file_path[:-4]) is not None
+
+
+def read_marker(folder_path):
+    """Read the extraction marker of a folder
+
+    Args:
+        folder_path (str): Path to the extracted folder
+
+    Returns:
+        dict: Marker contents or None if the folder has no marker
+    """
+    marker_path = os.path.join(folder_path, EXTRACTION_MARKER)
+    if not os.path.exists(marker_path):
+        return None
+    with open(marker_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_marker(folder_path, marker):
+    """Write the extraction marker of a folder
+
+    Args:
+        folder_path (str): Path to the extracted folder
+        marker (dict): Marker contents
+    """
+    marker_path = os.path.join(folder_path, EXTRACTION_MARKER)
+    with open(marker_path, "w", encoding="utf-8") as f:
+        json.dump(marker, f, ensure_ascii=False)
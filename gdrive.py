@@ -1,113 +1,344 @@
+from contextlib import nullcontext
 import io
 import os
 from multiprocessing.dummy import Pool
-from urllib.request import urlopen
-import zipfile
-
-from apiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-from oauth2client.service_account import ServiceAccountCredentials
-
-from utils import print_exception
+from threading import local, Lock
+from urllib.error import HTTPError
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from urllib.request import Request, urlopen
+
+from cache import JsonCache, note_written
+from extract import extract_zip, is_archived
+from manifest import ArchiveManifest
+from runlog import count, span
+from utils import ByteBudget, is_rate_limit_error, print_exception, RateLimiter
+from versions import VersionStore
+
+
+# metadata fields needed to name, type and download a file in a single request
+METADATA_FIELDS = "id, name, mimeType, exportLinks, size, modifiedTime, md5Checksum, version"
+# maximum number of calls the Drive batch endpoint accepts in one request
+BATCH_SIZE = 100
+# seconds before a cached URL resolution is checked again
+RESOLUTION_TTL = 30 * 24 * 60 * 60
+# query fields that identify the file a Docs URL points to, the rest only change the view
+FILE_QUERY_FIELDS = ["id", "docid", "srcid", "key"]
+# map Docs file type to proper file extension
+TYPE_TO_EXTENSION = {
+    "application/pdf": ".pdf",
+    "application/zip": ".zip",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": ".xlsx"
+}
 
 
 class DriveDownloader():
-    def __init__(self, cred_json_path):
-        SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
-
-        creds = ServiceAccountCredentials.from_json_keyfile_name(cred_json_path, SCOPES)
-        self.service = build("drive", "v3", credentials=creds)
+    def __init__(self, cred_json_path, num_threads=4, max_bytes_in_flight=256 * 1024 ** 2,
+                 chunk_size=8 * 1024 ** 2, max_requests_per_second=10, max_retries=5,
+                 keep_versions=True, service=None):
+        # credentials are only read once a request is made, so cached runs need none
+        self.cred_json_path = cred_json_path
+        self._creds = None
+        self._creds_lock = Lock()
+        # use the given Drive service instead of credentials, such as a stand-in for benchmarks
+        self._service = service
+        self._thread_services = local()
 
         # number of threads to use when multithreading
-        self.num_threads = 4
+        self.num_threads = num_threads
+        # requests per second shared by all threads, lowered when Drive throttles them
+        self.rate_limiter = RateLimiter(max_requests_per_second)
+        # retries of throttled and failed requests before a file is given up on
+        self.max_retries = max_retries
+        # limit on bytes being downloaded at once across all threads
+        self.byte_budget = ByteBudget(max_bytes_in_flight)
+        # assumed size of exports, since Drive only reports sizes for stored files
+        self.download_size_estimate = 8 * 1024 ** 2
+        # bytes requested per download chunk and written to disk at a time
+        self.chunk_size = chunk_size
+        # metadata fetched during this run, keyed by file ID
+        self.metadata_cache = {}
+        self._metadata_lock = Lock()
+        # upstream revisions of archived files for incremental updates
+        self.manifest = ArchiveManifest()
+        # earlier revisions of updated files, kept as deltas
+        self.versions = VersionStore() if keep_versions else None
+        # partial downloads left by earlier runs, keyed by file ID, listed once when needed
+        self._part_paths = None
+        self._part_lock = Lock()
+        # URL to (final URL, file ID) resolutions from previous runs
+        self.resolution_cache = JsonCache("resolved_urls.json", ttl=RESOLUTION_TTL)
+
+    @property
+    def service(self):
+        """Drive service of the current thread, built on first use
+        """
+        if self._service is not None:
+            return self._service
+        if not hasattr(self._thread_services, "service"):
+            # the Google API client is slow to import, so it is only loaded once needed
+            from apiclient.discovery import build
+            from oauth2client.service_account import ServiceAccountCredentials
+
+            SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
+            with self._creds_lock:
+                if self._creds is None:
+                    self._creds = ServiceAccountCredentials.from_json_keyfile_name(
+                        self.cred_json_path, SCOPES)
+            # httplib2 connections aren't thread safe, so each thread builds its own service
+            self._thread_services.service = build("drive", "v3", credentials=self._creds)
+        return self._thread_services.service
+
+    def call(self, function, *args, num_tokens=1):
+        """Make a request within the rate limit, retrying throttled and transient failures
+
+        Args:
+            function (function): Function making the request, such as request.execute
+            *args: Arguments for the function
+            num_tokens (int, optional): Number of requests the function makes. Defaults to 1.
+
+        Returns:
+            Result of the function
+        """
+        return self.rate_limiter.call(function, *args, num_tokens=num_tokens,
+                                      max_retries=self.max_retries)
 
     def archive_urls(self, docs_urls, update_archive=False):
         """Archive Docs from their URLs
 
         Args:
             docs_urls (list): List of URLs to Google Docs
-            update_archive (bool, optional): Whether to redownload and update archived Docs.
-                                             Defaults to False.
+            update_archive (bool or str, optional): Whether to redownload and update archived
+                                                    Docs, or "incremental" to redownload only
+                                                    Docs changed upstream. Defaults to False.
 
         Returns:
             list: List of archive paths or None
         """
         # get file IDs
         docs_file_ids = self.get_doc_ids(docs_urls)
-        # download documents
-        file_paths = self.save_docs(docs_file_ids, update_archive=update_archive)
-        # extract zips
-        for i, file_path in enumerate(file_paths):
+        return self.archive_file_ids(docs_file_ids, update_archive=update_archive)
+
+    def archive_records(self, records, update_archive=False):
+        """Archive the Docs of guide records, setting their file IDs and archive paths
+
+        Args:
+            records (GuideRecords): Guide records to archive the Docs of
+            update_archive (bool or str, optional): Whether to redownload and update archived
+                                                    Docs, or "incremental" to redownload only
+                                                    Docs changed upstream. Defaults to False.
+        """
+        docs_urls = records.unique_urls(is_docs=True)
+        docs_file_ids = self.get_doc_ids(docs_urls)
+        for docs_url, docs_file_id in zip(docs_urls, docs_file_ids):
+            records.set_file_id(docs_url, docs_file_id)
+        file_paths = self.archive_file_ids(docs_file_ids, update_archive=update_archive)
+        for docs_url, file_path in zip(docs_urls, file_paths):
+            records.set_archive_path(docs_url, file_path)
+
+    def archive_file_ids(self, docs_file_ids, update_archive=False):
+        """Archive Docs from their file IDs
+
+        Args:
+            docs_file_ids (list): List of IDs for the Google Docs or None
+            update_archive (bool or str, optional): Whether to redownload and update archived
+                                                    Docs, or "incremental" to redownload only
+                                                    Docs changed upstream. Defaults to False.
+
+        Returns:
+            list: List of archive paths or None
+        """
+        # get metadata for all files up front in batched requests
+        self.prefetch_metadata(docs_file_ids)
+        # download documents, extracting zips on another pool as soon as each one lands
+        extract_pool = Pool(self.num_threads)
+        extractions = {}
+        path_extractions = {}
+        path_lock = Lock()
+
+        def start_extraction(i, file_path):
             if file_path is not None and file_path[-4:] == ".zip":
-                with zipfile.ZipFile(file_path, "r") as zip_f:
-                    folder_path = file_path[:-4]
-                    zip_f.extractall(folder_path)
-                    # change filepath to the html file
-                    html_file_name = None
-                    for zip_info in zip_f.filelist:
-                        file_name = zip_info.filename
-                        if len(file_name) > 5 and file_name[-5:] == ".html":
-                            html_file_name = file_name
-                            break
-                    file_paths[i] = os.path.join(folder_path, html_file_name)
+                # extract each zip once even if several links point to it
+                with path_lock:
+                    if file_path not in path_extractions:
+                        path_extractions[file_path] = extract_pool.apply_async(extract_zip,
+                                                                               (file_path,))
+                    extractions[i] = path_extractions[file_path]
+
+        file_paths = self.save_docs(docs_file_ids, update_archive=update_archive,
+                                    on_saved=start_extraction)
+        self.manifest.save()
+        # change zip filepaths to the extracted html files
+        with span("extract"):
+            for i, extraction in extractions.items():
+                try:
+                    file_paths[i] = extraction.get()
+                except Exception as e:
+                    print_exception("Exception for ZIP:", file_paths[i], e)
+                    file_paths[i] = None
+        # close threads, but don't bother waiting for them to free resources
+        extract_pool.close()
         return file_paths
 
-    def save_doc(self, file_id, update_archive=False):
+    def save_doc(self, file_id, update_archive=False, file_path=None):
         """Save document in archive
 
         Args:
             file_id (str): ID for the Google Doc
-            update_archive (bool, optional): Whether to redownload and update archived Docs.
-                                             Defaults to False.
+            update_archive (bool or str, optional): Whether to redownload and update archived
+                                                    Docs, or "incremental" to redownload only
+                                                    Docs changed upstream. Defaults to False.
+            file_path (str, optional): Path to archive the file at. Defaults to the path
+                                       from get_archive_path.
         """
         if file_id is None:
             return None
-        file_path = None
+        with span(file_id, kind="file", stage="download"):
+            return self._save_doc(file_id, update_archive, file_path)
+
+    def _save_doc(self, file_id, update_archive=False, file_path=None):
         try:
-            # get name and download type from Docs
-            file_name = self.sanitize_name(self.get_doc_name(file_id))
             download_type = self.get_download_type(file_id)
-            # map Docs file type to proper file extension
-            type_to_extension = {
-                "application/pdf": ".pdf",
-                "application/zip": ".zip",
-                "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": ".xlsx"
-            }
-            if download_type not in type_to_extension:
-                raise ValueError("File with unhandled type:\n" + download_type)
-            file_ext = type_to_extension[download_type]
-            # create file path without duplicate extensions
-            if file_name[-len(file_ext):] != file_ext:
-                file_path = "archive/" + file_name + file_ext
-            else:
-                file_path = "archive/" + file_name
-            # get rid of invalid trailing characters for ZIP files (causes issues when extracting)
-            if file_path[-4:] == ".zip":
-                invalid_chars = [" ", "."]
-                while file_path[-5] in invalid_chars:
-                    file_path = file_path[:-5] + ".zip"
+            if file_path is None:
+                file_path = self.get_archive_path(file_id)
             # download and write file if not archived already or if updating archive
-            if not os.path.exists(file_path) or update_archive:
-                file_buffer, _ = self.download_doc(file_id, download_type)
-                with open(file_path, "wb") as f:
-                    f.write(file_buffer.getbuffer())
+            if update_archive == "incremental":
+                metadata = self.get_doc_metadata(file_id)
+                download = not self.manifest.is_current(file_id, metadata, download_type,
+                                                        file_path)
+            else:
+                download = not is_archived(file_path) or update_archive
+            if download:
+                download_size = self.get_download_size(file_id, download_type)
+                # keep the revision being replaced, storing it once the budget is released
+                updating = nullcontext() if self.versions is None else \
+                    self.versions.updating(file_id, file_path, self.manifest.get(file_id))
+                with updating:
+                    with self.byte_budget.reserve(download_size):
+                        self.download_doc_to_file(file_id, file_path, download_type)
+                self.manifest.record(file_id, self.get_doc_metadata(file_id), download_type,
+                                     file_path)
+            else:
+                count("cache_hits")
         except Exception as e:
             print_exception("Exception for file ID:", file_id, e)
             file_path = None
         return file_path
 
-    def save_docs(self, file_ids, update_archive=False):
-        """Save document in archive
+    def get_archive_path(self, file_id):
+        """Get the path a Doc is archived at from its name and download type
 
         Args:
-            file_ids (str): List of IDs for the Google Docs or None
-            update_archive (bool, optional): Whether to redownload and update archived Docs.
-                                             Defaults to False.
+            file_id (str): ID for the Google Doc
+
+        Returns:
+            str: Archive path of the file
         """
-        # process downloads
-        file_paths = [self.save_doc(file_id, update_archive) for file_id in file_ids]
+        # get name and download type from Docs
+        file_name = self.sanitize_name(self.get_doc_name(file_id))
+        download_type = self.get_download_type(file_id)
+        if download_type not in TYPE_TO_EXTENSION:
+            raise ValueError("File with unhandled type:\n" + download_type)
+        file_ext = TYPE_TO_EXTENSION[download_type]
+        # create file path without duplicate extensions
+        if file_name[-len(file_ext):] != file_ext:
+            file_path = "archive/" + file_name + file_ext
+        else:
+            file_path = "archive/" + file_name
+        # get rid of invalid trailing characters for ZIP files (causes issues when extracting)
+        if file_path[-4:] == ".zip":
+            invalid_chars = [" ", "."]
+            while file_path[-5] in invalid_chars:
+                file_path = file_path[:-5] + ".zip"
+        return file_path
+
+    def plan_archive_paths(self, file_ids):
+        """Get the archive path of each Doc, giving Docs whose names collide their own paths
+
+        A path that sanitized names share stays with the Doc the manifest
+        already archived there, or else goes to the Doc listed first. The other
+        Docs get their file ID added to the name instead of overwriting it.
+
+        Args:
+            file_ids (list): Unique IDs for the Google Docs
+
+        Returns:
+            dict: File IDs mapped to archive paths, leaving out Docs whose metadata failed
+        """
+        # only fetch what the metadata stage didn't, so its cache hits aren't counted twice
+        with self._metadata_lock:
+            missing_ids = [file_id for file_id in file_ids if file_id not in self.metadata_cache]
+        if missing_ids:
+            self.prefetch_metadata(missing_ids)
+        file_paths = {}
+        claimants = {}
+        for file_id in file_ids:
+            try:
+                file_paths[file_id] = self.get_archive_path(file_id)
+            except Exception:
+                # reported when the download is attempted
+                continue
+            # archive paths are served from case-insensitive file systems too
+            claimants.setdefault(file_paths[file_id].casefold(), []).append(file_id)
+        # paths already holding a Doc, which may not be among these, such as on a resumed run
+        path_owners = {file_path.casefold(): file_id
+                       for file_id, file_path in self.manifest.paths().items()}
+        for path_key, file_ids_at_path in claimants.items():
+            owner_id = path_owners.get(path_key, file_ids_at_path[0])
+            if file_ids_at_path == [owner_id]:
+                continue
+            file_path = file_paths[file_ids_at_path[0]]
+            print("Archive path collision:\n" + file_path)
+            print(" ".join([owner_id] + [file_id for file_id in file_ids_at_path
+                                         if file_id != owner_id]) + "\n")
+            count("collisions", len(file_ids_at_path) - (owner_id in file_ids_at_path))
+            name, ext = os.path.splitext(file_path)
+            for file_id in file_ids_at_path:
+                if file_id != owner_id:
+                    file_paths[file_id] = "{} [{}]{}".format(name, file_id, ext)
         return file_paths
 
+    def save_docs(self, file_ids, update_archive=False, on_saved=None):
+        """Save documents in archive
+
+        Each file is downloaded once however many times it is listed, and
+        files whose names collide are saved to separate paths.
+
+        Args:
+            file_ids (str): List of IDs for the Google Docs or None
+            update_archive (bool or str, optional): Whether to redownload and update archived
+                                                    Docs, or "incremental" to redownload only
+                                                    Docs changed upstream. Defaults to False.
+            on_saved (function, optional): Called with the index and archive path of each
+                                           document as soon as it is saved. Defaults to None.
+
+        Returns:
+            list: List of archive paths or None, in the same order as file_ids
+        """
+        # indexes of each file, so duplicates share one download
+        file_inds = {}
+        for i, file_id in enumerate(file_ids):
+            file_inds.setdefault(file_id, []).append(i)
+        unique_ids = [file_id for file_id in file_inds if file_id is not None]
+        if on_saved is not None:
+            for i in file_inds.get(None, []):
+                on_saved(i, None)
+        with span("download"):
+            planned_paths = self.plan_archive_paths(unique_ids)
+
+            def save_doc(file_id):
+                file_path = self.save_doc(file_id, update_archive, planned_paths.get(file_id))
+                if on_saved is not None:
+                    for i in file_inds[file_id]:
+                        on_saved(i, file_path)
+                return file_path
+
+            # process downloads on multiple threads, bounded by the byte budget
+            thread_pool = Pool(self.num_threads)
+            saved_paths = dict(zip(unique_ids, thread_pool.map(save_doc, unique_ids)))
+        # close threads, but don't bother waiting for them to free resources
+        thread_pool.close()
+        return [saved_paths.get(file_id) for file_id in file_ids]
+
     def download_doc(self, file_id, download_type=None):
         """Download a Google Doc from the file id
 
@@ -119,6 +350,8 @@ class DriveDownloader():
             (io.BytesIO, str): Binary stream representing the file,
                                Type of file stream
         """
+        from googleapiclient.http import MediaIoBaseDownload
+
         request = self.download_request(file_id, download_type)
         # construct buffer and downloader
         file_buffer = io.BytesIO()
@@ -126,9 +359,73 @@ class DriveDownloader():
         # download the file
         done = False
         while done is False:
-            status, done = downloader.next_chunk()
+            status, done = self.call(downloader.next_chunk)
         return file_buffer, download_type
 
+    def download_doc_to_file(self, file_id, file_path, download_type=None):
+        """Stream a Google Doc to disk, replacing file_path only once complete
+
+        Chunks are written to a partial file in the archive, which is resumed
+        by byte range on the next attempt for stored files. Exports are
+        regenerated on request, so their partial files are restarted.
+
+        Args:
+            file_id (str): ID for the Google Doc
+            file_path (str): Path to write the file to
+            download_type (str, optional): mimeType to download file as. Defaults to None.
+
+        Returns:
+            str: Path the file was written to
+        """
+        if download_type is None:
+            download_type = self.get_download_type(file_id)
+        metadata = self.get_doc_metadata(file_id)
+        part_path = "archive/." + file_id + "-" + str(metadata.get("version")) + ".part"
+        # remove partial downloads of older revisions
+        for old_part_path in self.pop_part_paths(file_id):
+            if old_part_path != part_path and os.path.exists(old_part_path):
+                os.remove(old_part_path)
+        total_size = self.get_doc_size(file_id)
+        start = 0
+        if download_type == "application/pdf" and os.path.exists(part_path):
+            start = os.path.getsize(part_path)
+            if total_size is not None and start > total_size:
+                start = 0
+        with open(part_path, "ab" if start > 0 else "wb") as f:
+            if total_size is None or start < total_size:
+                request = self.download_request(file_id, download_type)
+                downloader = resumable_download(f, request, self.chunk_size, start=start)
+                done = False
+                while done is False:
+                    status, done = self.call(downloader.next_chunk)
+                    count("api_calls")
+                count("bytes", downloader._progress - start)
+        os.replace(part_path, file_path)
+        note_written(file_path)
+        return file_path
+
+    def pop_part_paths(self, file_id):
+        """Take the partial downloads of a file left by earlier runs
+
+        The archive is listed once for all files, instead of once per download.
+
+        Args:
+            file_id (str): ID for the Google Doc
+
+        Returns:
+            list: Paths of the partial downloads
+        """
+        with self._part_lock:
+            if self._part_paths is None:
+                self._part_paths = {}
+                for entry in os.scandir("archive"):
+                    if entry.name.startswith(".") and entry.name.endswith(".part"):
+                        # named .<file ID>-<version>.part
+                        part_file_id = entry.name[1:-len(".part")].rsplit("-", 1)[0]
+                        self._part_paths.setdefault(part_file_id, []).append(
+                            "archive/" + entry.name)
+            return self._part_paths.pop(file_id, [])
+
     def download_request(self, file_id, download_type=None):
         """Create request to download a Google Doc from the file id
 
@@ -147,9 +444,7 @@ class DriveDownloader():
                         "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"]
         download_types = ["application/pdf"]
         if download_type in export_types:
-            # construct request for export URLs
-            url_request = self.service.files().get(fileId=file_id, fields="exportLinks")
-            export_urls = url_request.execute()["exportLinks"]
+            export_urls = self.get_doc_metadata(file_id)["exportLinks"]
             # construct request to get exported file
             request = self.service.files().export_media(fileId=file_id, mimeType=download_type)
             # use export links to avoid file size limit instead of export function
@@ -161,22 +456,38 @@ class DriveDownloader():
         return request
 
     def get_doc_id(self, docs_url):
+        """Gets the Docs ID for a URL, following redirects only when needed
+
+        Args:
+            docs_url (str): URL linking or redirecting to a Docs file
+
+        Returns:
+            str: Docs ID or None
+        """
+        cached = self.resolution_cache.get(docs_url)
+        if cached is not None:
+            count("cache_hits")
+            return cached[1]
         docs_file_id = None
         redirect_url = None
-        try:
-            # update url if it redirects
-            response = urlopen(docs_url)
-            redirect_url = response.url
-            if redirect_url != docs_url:
-                print("Redirecting URL:")
-                print(docs_url + " => " + redirect_url + "\n")
-        except Exception as e:
-            print_exception("Exception for URL request:", docs_url, e)
+        if self.has_file_id(docs_url):
+            # the ID in the URL is stable, so there is no need to follow it
+            redirect_url = docs_url
+        else:
+            try:
+                # update url if it redirects
+                redirect_url = self.resolve_redirect(docs_url)
+                if redirect_url != docs_url:
+                    print("Redirecting URL:")
+                    print(docs_url + " => " + redirect_url + "\n")
+            except Exception as e:
+                print_exception("Exception for URL request:", docs_url, e)
         if redirect_url is not None:
             try:
                 # get the docs file id for export
                 file_id = self.url_to_file_id(redirect_url)
                 docs_file_id = file_id
+                self.resolution_cache.set(docs_url, [redirect_url, docs_file_id])
             except Exception as e:
                 print_exception("Exception for URL:", redirect_url, e)
         return docs_file_id
@@ -191,25 +502,143 @@ class DriveDownloader():
             (list, list): List of Docs IDs
                           List of failed urls
         """
+        # resolve each canonical URL once, however many links share it
+        canonical_urls = [self.canonical_url(docs_url) for docs_url in docs_urls]
+        unique_urls = list(dict.fromkeys(canonical_urls))
         # process Docs IDs on multiple threads
         thread_pool = Pool(self.num_threads)
-        docs_file_ids = thread_pool.map(self.get_doc_id, docs_urls)
+        with span("resolve") as resolve_span:
+            resolve_span.count("cache_hits", len(docs_urls) - len(unique_urls))
+            file_ids = dict(zip(unique_urls, thread_pool.map(self.get_doc_id, unique_urls)))
         # close threads, but don't bother waiting for them to free resources
         thread_pool.close()
-        return docs_file_ids
+        self.resolution_cache.save()
+        return [file_ids[canonical_url] for canonical_url in canonical_urls]
+
+    def canonical_url(self, url):
+        """Drop the parts of a Docs URL that don't change which file it points to
+
+        The fragment and view options such as /edit, ?usp= and ?hl= are
+        dropped, so the different shapes of a link to the same file are
+        resolved once.
+
+        Args:
+            url (str): URL linking or redirecting to a Docs file
+
+        Returns:
+            str: Canonical URL
+        """
+        split_url = urlsplit(url)
+        if split_url.netloc not in ["docs.google.com", "drive.google.com"] or \
+           split_url.path.startswith("/forms/"):
+            return url
+        path = split_url.path
+        if "/d/" in path:
+            # the ID in the path is all that identifies the file
+            start_ind = path.find("/d/") + 3
+            end_ind = path.find("/", start_ind)
+            path = path[:end_ind if end_ind > -1 else len(path)]
+            query = ""
+        else:
+            query = urlencode([(field, value) for field, value in parse_qsl(split_url.query)
+                               if field in FILE_QUERY_FIELDS])
+        return urlunsplit(("https", split_url.netloc, path, query, ""))
+
+    def resolve_redirect(self, url):
+        """Follow redirects for a URL without downloading the page
+
+        Args:
+            url (str): URL to resolve
+
+        Returns:
+            str: Final URL after redirects
+        """
+        try:
+            count("http_requests")
+            with self.call(urlopen, Request(url, method="HEAD")) as response:
+                return response.url
+        except HTTPError as e:
+            # fall back to a GET for servers that refuse HEAD, leaving the body unread
+            if e.code not in [405, 501]:
+                raise
+        # a planned second request rather than a retry of a failed one
+        count("head_fallbacks")
+        count("http_requests")
+        with self.call(urlopen, url) as response:
+            return response.url
+
+    def has_file_id(self, url):
+        """Check if a URL contains a file ID that redirects can't change
+
+        Args:
+            url (str): URL linking to a Docs file
+
+        Returns:
+            bool: Whether the file ID can be read from the URL directly
+        """
+        if not (url.startswith("https://docs.google.com") or
+                url.startswith("https://drive.google.com")):
+            return False
+        if url.startswith("https://docs.google.com/forms/"):
+            return False
+        # legacy docid and srcid links redirect to files with new IDs
+        return "/d/" in url or "?id=" in url or "&id=" in url
 
     def get_doc_metadata(self, file_id):
-        """Gets default Docs metadata fields
+        """Gets Docs metadata fields, fetching them only once per run
 
         Args:
             file_id (str): ID for the Google Doc
 
         Returns:
-            dict: Metadata dict
+            dict: Metadata dict with the METADATA_FIELDS fields
         """
-        response_dict = self.service.files().get(fileId=file_id).execute()
+        with self._metadata_lock:
+            response_dict = self.metadata_cache.get(file_id)
+        if response_dict is None:
+            request = self.service.files().get(fileId=file_id, fields=METADATA_FIELDS)
+            response_dict = self.call(request.execute)
+            count("api_calls")
+            with self._metadata_lock:
+                self.metadata_cache[file_id] = response_dict
         return response_dict
 
+    def prefetch_metadata(self, file_ids):
+        """Fetch metadata for many files using the Drive batch endpoint
+
+        Files that fail here are left uncached so get_doc_metadata can retry
+        and report them individually.
+
+        Args:
+            file_ids (list): IDs for the Google Docs or None
+        """
+        def store_response(request_id, response, exception):
+            if exception is None:
+                with self._metadata_lock:
+                    self.metadata_cache[request_id] = response
+            elif is_rate_limit_error(exception):
+                self.rate_limiter.throttled()
+
+        # skip missing and already fetched IDs, keeping each ID once
+        with self._metadata_lock:
+            pending_ids = [file_id for file_id in dict.fromkeys(file_ids)
+                           if file_id is not None and file_id not in self.metadata_cache]
+        with span("metadata") as metadata_span:
+            metadata_span.count("cache_hits", len(set(file_ids) - {None}) - len(pending_ids))
+            for start_ind in range(0, len(pending_ids), BATCH_SIZE):
+                batch = self.service.new_batch_http_request(callback=store_response)
+                chunk_ids = pending_ids[start_ind:start_ind + BATCH_SIZE]
+                for file_id in chunk_ids:
+                    request = self.service.files().get(fileId=file_id, fields=METADATA_FIELDS)
+                    batch.add(request, request_id=file_id)
+                try:
+                    # Drive counts each call in a batch against the quota
+                    self.call(batch.execute, num_tokens=len(chunk_ids))
+                    metadata_span.count("api_calls")
+                except Exception as e:
+                    print_exception("Exception for metadata batch starting at file ID:",
+                                    pending_ids[start_ind], e)
+
     def get_doc_type(self, file_id):
         """Gets Doc mimeType
 
@@ -247,6 +676,38 @@ class DriveDownloader():
             download_type = type_map[cur_type]
         return download_type
 
+    def get_doc_size(self, file_id):
+        """Gets Doc size in bytes
+
+        Args:
+            file_id (str): ID for the Google Doc
+
+        Returns:
+            int: Size of the stored file or None for Google Docs native files
+        """
+        response_dict = self.get_doc_metadata(file_id)
+        if "size" not in response_dict:
+            return None
+        return int(response_dict["size"])
+
+    def get_download_size(self, file_id, download_type):
+        """Gets the expected number of bytes to download
+
+        Args:
+            file_id (str): ID for the Google Doc
+            download_type (str): mimeType the file will be downloaded as
+
+        Returns:
+            int: Expected download size in bytes
+        """
+        download_size = None
+        # only stored files have a size, exports are generated on request
+        if download_type == "application/pdf":
+            download_size = self.get_doc_size(file_id)
+        if download_size is None:
+            download_size = self.download_size_estimate
+        return download_size
+
     def get_doc_name(self, file_id):
         """Gets Doc name
 
@@ -283,7 +744,7 @@ class DriveDownloader():
         if file_id is None:
             raise ValueError("URL does not match known patterns:\n" + url)
         if file_id.endswith("#"):
-            file_id[:-1]
+            file_id = file_id[:-1]
         return file_id
 
     def extract_url_query_field(self, url, field):
@@ -294,7 +755,8 @@ class DriveDownloader():
             field = field[:end_ind]
         return field
 
-    def sanitize_name(self, name):
+    @staticmethod
+    def sanitize_name(name):
         """Map invalid path character to a similar unicode character
 
         Args:
@@ -316,3 +778,23 @@ class DriveDownloader():
         }
         return "".join(char_to_sanitized[char] if char in char_to_sanitized else char
                        for char in name)
+
+
+def resumable_download(fd, request, chunksize, start=0):
+    """Create a MediaIoBaseDownload that continues from a byte offset
+
+    Args:
+        fd (io.IOBase): File to write the chunks to
+        request (HttpRequest): Request for the media
+        chunksize (int): Bytes requested per chunk
+        start (int, optional): Byte offset to continue from. Defaults to 0.
+
+    Returns:
+        MediaIoBaseDownload: Downloader of the remaining bytes
+    """
+    from googleapiclient.http import MediaIoBaseDownload
+
+    downloader = MediaIoBaseDownload(fd, request, chunksize=chunksize)
+    # next_chunk requests the byte range starting at the current progress
+    downloader._progress = start
+    return downloader
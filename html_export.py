@@ -1,23 +1,233 @@
-from bs4 import BeautifulSoup
-
-
-def archive_links(link_labels, link_classes, archive_paths):
-    # create an empty HTML page
-    html_str = """
-    <!doctype html>
-    <html lang="en"></html>
-    """
-    soup = BeautifulSoup(html_str, "html.parser")
-    html_tag = soup.html
-    # add links to the HTML
-    for i, archive_path in enumerate(archive_paths):
-        if archive_path is None:
-            continue
-        link_tag = soup.new_tag("a", href=archive_path)
-        link_tag.string = link_labels[i]
-        link_tag["class"] = link_classes[i]
-        html_tag.append(link_tag)
-        html_tag.append(soup.new_tag("br"))
-    html = soup.prettify()
-    with open("archive_links.html", "w", encoding="utf-8") as f:
-        f.write(html)
+from contextlib import ExitStack
+from datetime import datetime, timezone
+import html
+import json
+import os
+import re
+
+from records import GuideRecord, GuideRecords
+from runlog import span
+from sitemap import SITE_URL, get_page_url
+
+
+ARCHIVE_LINKS_PATH = "archive_links.html"
+ARCHIVE_INDEX_PATH = "archive_index.json"
+# links grouped into one fragment per class, listed in a manifest
+CLASS_LINKS_DIR = "archive_links"
+CLASS_MANIFEST_PATH = "archive_links.json"
+INDEX_PATH = "index.html"
+SITEMAP_TXT_PATH = "sitemap.txt"
+SITEMAP_XML_PATH = "sitemap.xml"
+
+
+def archive_links(records):
+    """Write links to the archived guides to archive_links.html
+
+    Args:
+        records (GuideRecords): Guide records to link, skipping those not archived
+    """
+    with open(ARCHIVE_LINKS_PATH, "w", encoding="utf-8") as f:
+        f.write(LINKS_HEADER)
+        for record in records:
+            if record.archive_path is not None:
+                f.write(link_html(record))
+        f.write(LINKS_FOOTER)
+
+
+def export_archive(records, sitemap_xml=False, inline_index=False):
+    """Write the link page, sitemap and JSON index together in one pass over the records
+
+    Links are also written to one fragment per class in CLASS_LINKS_DIR, listed
+    in CLASS_MANIFEST_PATH, so the site only fetches the sections it shows.
+
+    Args:
+        records (GuideRecords): Guide records to export, skipping those not archived
+        sitemap_xml (bool, optional): Whether to also write sitemap.xml with lastmod dates.
+                                      Defaults to False.
+        inline_index (bool, optional): Whether to write the grouped links straight into
+                                       index.html. Defaults to False.
+    """
+    with span("export"):
+        # remove fragments of classes that may no longer have links
+        os.makedirs(CLASS_LINKS_DIR, exist_ok=True)
+        for file_name in os.listdir(CLASS_LINKS_DIR):
+            if file_name.endswith(".html"):
+                os.remove(os.path.join(CLASS_LINKS_DIR, file_name))
+        class_files = {}
+        class_counts = {}
+        with ExitStack() as stack:
+            links_f = stack.enter_context(open(ARCHIVE_LINKS_PATH, "w", encoding="utf-8"))
+            sitemap_f = stack.enter_context(open(SITEMAP_TXT_PATH, "w", encoding="utf8"))
+            index_f = stack.enter_context(open(ARCHIVE_INDEX_PATH, "w", encoding="utf-8"))
+            xml_f = None
+            if sitemap_xml:
+                xml_f = stack.enter_context(open(SITEMAP_XML_PATH, "w", encoding="utf-8"))
+            # write the start of every output
+            links_f.write(LINKS_HEADER)
+            sitemap_f.write(SITE_URL + "\n")
+            index_f.write("[")
+            if xml_f is not None:
+                xml_f.write(SITEMAP_XML_HEADER)
+                xml_f.write(sitemap_xml_entry(SITE_URL))
+            # write each archived guide to every output as it is reached
+            first_entry = True
+            for record in records:
+                if record.archive_path is None:
+                    continue
+                page_url = get_page_url(record.archive_path)
+                links_f.write(link_html(record))
+                if record.link_class not in class_files:
+                    class_files[record.link_class] = stack.enter_context(
+                        open(get_class_links_path(record.link_class), "w", encoding="utf-8"))
+                    class_counts[record.link_class] = 0
+                class_files[record.link_class].write(link_html(record))
+                class_counts[record.link_class] += 1
+                sitemap_f.write(page_url + "\n")
+                index_entry = {
+                    "label": record.label.strip(),
+                    "class": record.link_class,
+                    "path": record.archive_path.replace("\\", "/"),
+                    "source_url": record.url,
+                    "file_id": record.file_id,
+                }
+                index_f.write(("\n" if first_entry else ",\n") +
+                              json.dumps(index_entry, ensure_ascii=False))
+                first_entry = False
+                if xml_f is not None:
+                    xml_f.write(sitemap_xml_entry(page_url, get_lastmod(record.archive_path)))
+            # write the end of every output
+            links_f.write(LINKS_FOOTER)
+            index_f.write("\n]\n")
+            if xml_f is not None:
+                xml_f.write(SITEMAP_XML_FOOTER)
+        # list the fragments for the site to fetch
+        class_manifest = {link_class: {"path": get_class_links_path(link_class).replace("\\", "/"),
+                                       "count": count}
+                          for link_class, count in class_counts.items()}
+        with open(CLASS_MANIFEST_PATH, "w", encoding="utf-8") as f:
+            json.dump(class_manifest, f, ensure_ascii=False)
+        if inline_index:
+            inline_class_links(class_manifest)
+
+
+def read_archive_index():
+    """Read the archived guide records back from the JSON index of the last export
+
+    Returns:
+        GuideRecords: Records of the archived guides or None if nothing was exported
+    """
+    if not os.path.exists(ARCHIVE_INDEX_PATH):
+        return None
+    with open(ARCHIVE_INDEX_PATH, encoding="utf-8") as f:
+        index = json.load(f)
+    return GuideRecords(GuideRecord(entry["source_url"], entry["label"], entry["class"],
+                                    is_docs=entry["file_id"] is not None,
+                                    file_id=entry["file_id"],
+                                    # the index always uses "/", so match paths built by a run
+                                    archive_path=os.path.normpath(entry["path"]))
+                        for entry in index)
+
+
+def inline_class_links(class_manifest):
+    """Write the class fragments into index.html after their class labels
+
+    Links from an earlier inlining are replaced, and link_loader.js skips
+    fetching classes that are already inlined.
+
+    Args:
+        class_manifest (dict): Classes mapped to their fragment paths
+    """
+    def inline_links(match):
+        indent, label_html, link_class = match.group(1), match.group(2), match.group(3)
+        if link_class not in class_manifest:
+            return indent + label_html
+        with open(get_class_links_path(link_class), encoding="utf-8") as f:
+            links_html = f.read()
+        return "{0}{1}\n{0}<div class=\"class-links\" data-class=\"{2}\">\n{3}{0}</div>".format(
+            indent, label_html, link_class, links_html)
+
+    with open(INDEX_PATH, encoding="utf-8") as f:
+        index_html = f.read()
+    index_html = CLASS_LABEL_PATTERN.sub(inline_links, index_html)
+    with open(INDEX_PATH, "w", encoding="utf-8") as f:
+        f.write(index_html)
+
+
+def get_class_links_path(link_class):
+    """Get the path of the fragment holding the links for a class
+
+    Args:
+        link_class (str): Class of the links
+
+    Returns:
+        str: Path to the fragment
+    """
+    return os.path.join(CLASS_LINKS_DIR, link_class + ".html")
+
+
+def link_html(record):
+    """Render the link for a guide record
+
+    Args:
+        record (GuideRecord): Archived guide record
+
+    Returns:
+        str: HTML for the link and the line break after it
+    """
+    return " <a class=\"{}\" href=\"{}\">\n  {}\n </a>\n <br/>\n".format(
+        escape_attribute(record.link_class), escape_attribute(record.archive_path),
+        html.escape(record.label.strip(), quote=False))
+
+
+def escape_attribute(value):
+    """Escape a double quoted attribute value, leaving apostrophes as they are
+
+    Args:
+        value (str): Attribute value
+
+    Returns:
+        str: Escaped value
+    """
+    return html.escape(value, quote=False).replace("\"", "&quot;")
+
+
+def sitemap_xml_entry(page_url, lastmod=None):
+    """Render a sitemap.xml entry
+
+    Args:
+        page_url (str): URL of the page
+        lastmod (str, optional): Date the page was last modified. Defaults to None.
+
+    Returns:
+        str: XML for the entry
+    """
+    entry = "  <url>\n    <loc>{}</loc>\n".format(html.escape(page_url))
+    if lastmod is not None:
+        entry += "    <lastmod>{}</lastmod>\n".format(lastmod)
+    return entry + "  </url>\n"
+
+
+def get_lastmod(archive_path):
+    """Get the date an archived file was last written
+
+    Args:
+        archive_path (str): Path to the archived file
+
+    Returns:
+        str: W3C date or None if the file is missing
+    """
+    if not os.path.exists(archive_path):
+        return None
+    mtime = os.path.getmtime(archive_path)
+    return datetime.fromtimestamp(mtime, timezone.utc).strftime("%Y-%m-%d")
+
+
+# class label and any links inlined after it by an earlier export
+CLASS_LABEL_PATTERN = re.compile(
+    r"([ \t]*)(<h4 class=\"class-label\" id=\"([^\"]+)\">.*?</h4>)"
+    r"(?:\s*<div class=\"class-links\" data-class=\"\3\">.*?</div>)?", re.DOTALL)
+LINKS_HEADER = "<!DOCTYPE html>\n<html lang=\"en\">\n"
+LINKS_FOOTER = "</html>\n"
+SITEMAP_XML_HEADER = "<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n" \
+    "<urlset xmlns=\"http://www.sitemaps.org/schemas/sitemap/0.9\">\n"
+SITEMAP_XML_FOOTER = "</urlset>\n"
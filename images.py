@@ -0,0 +1,165 @@
+import hashlib
+from importlib.util import find_spec
+import io
+from multiprocessing import Pool
+import os
+
+from cache import JsonCache, note_written
+from dedup import extracted_folders, folder_assets, get_blob_path, hash_file, link_or_copy, \
+    rewrite_references
+from extract import read_marker, write_marker
+from runlog import count, span
+from utils import print_exception
+
+
+IMAGE_EXTENSIONS = [".png", ".jpg", ".jpeg"]
+# longest side of resized images, well past the width of a Docs page
+MAX_DIMENSION = 1600
+JPEG_QUALITY = 85
+# share of the original size an image must shrink by to be replaced
+MIN_SAVINGS = 0.1
+
+
+def optimize_images(max_dimension=MAX_DIMENSION, num_processes=None):
+    """Recompress and downsize the images of extracted exports
+
+    Images are processed on a process pool. Results are cached by content
+    hash in the store, so an image shared by several guides, or extracted
+    again from an unchanged zip, is only processed once. Opaque PNGs with
+    many colors become JPEGs, in which case the HTML is rewritten to point
+    at the new file, and other images keep their format and name.
+
+    Args:
+        max_dimension (int, optional): Longest side of the resized images.
+                                       Defaults to MAX_DIMENSION.
+        num_processes (int, optional): Number of processes to compress images on.
+                                       Defaults to the number of CPUs.
+
+    Returns:
+        int: Number of bytes saved
+    """
+    if find_spec("PIL") is None:
+        print("Pillow is not installed, so images won't be optimized\n")
+        return 0
+    with span("images") as images_span:
+        hash_cache = JsonCache("content_hashes.json")
+        # source hashes mapped to [optimized hash, extension], or [None, None] to keep as is
+        results = JsonCache("optimized_images.json")
+        images = []
+        for folder_path in extracted_folders():
+            for file_name in folder_assets(folder_path):
+                if os.path.splitext(file_name)[1].lower() in IMAGE_EXTENSIONS:
+                    file_path = os.path.join(folder_path, file_name)
+                    images += [(folder_path, file_name, hash_file(file_path, hash_cache))]
+        hash_cache.save()
+        # process each new image once
+        pending = {}
+        for folder_path, file_name, digest in images:
+            if results.get(digest) is None and digest not in pending:
+                pending[digest] = os.path.join(folder_path, file_name)
+        images_span.count("cache_hits", len(images) - len(pending))
+        with Pool(num_processes) as process_pool:
+            optimized = process_pool.imap(optimize_image,
+                                          [(file_path, max_dimension)
+                                           for file_path in pending.values()])
+            for digest, result in zip(pending, optimized):
+                # images that failed are retried on the next run
+                if result is None:
+                    continue
+                results.set(digest, result)
+                if result[0] is not None:
+                    # optimized images are never processed again
+                    results.set(result[0], [None, None])
+        results.save()
+        bytes_saved = 0
+        folder_moves = {}
+        folder_rewrites = {}
+        for folder_path, file_name, digest in images:
+            optimized_digest, ext = results.get(digest, [None, None])
+            if optimized_digest is None:
+                continue
+            file_path = os.path.join(folder_path, file_name)
+            new_path = os.path.splitext(file_path)[0] + ext
+            bytes_saved += os.path.getsize(file_path) - \
+                os.path.getsize(get_blob_path(optimized_digest, ext))
+            # the image becomes a hardlink to the store, so it is only ever replaced, and
+            # extraction replaces files the same way rather than writing through the link
+            tmp_path = new_path + ".tmp"
+            link_or_copy(get_blob_path(optimized_digest, ext), tmp_path)
+            os.replace(tmp_path, new_path)
+            # the worker that stored the result can't note it, so note it here
+            note_written(new_path, get_blob_path(optimized_digest, ext))
+            if new_path != file_path:
+                folder_moves.setdefault(folder_path, {})[file_name] = new_path
+            else:
+                folder_rewrites.setdefault(folder_path, []).append(file_name)
+        # rewritten files no longer match the zip on purpose
+        for folder_path, file_names in folder_rewrites.items():
+            marker = read_marker(folder_path)
+            marker["rewritten"] = sorted(set(marker.get("rewritten", [])) | set(file_names))
+            write_marker(folder_path, marker)
+        # point the HTML at images whose format changed and remove the originals
+        for folder_path, moves in folder_moves.items():
+            rewrite_references(folder_path, moves)
+        count("bytes", bytes_saved)
+    return bytes_saved
+
+
+def optimize_image(args):
+    """Recompress and downsize an image, storing the result by its hash
+
+    Args:
+        args ((str, int)): Path to the image,
+                           Longest side of the resized image
+
+    Returns:
+        list: [hash, extension] of the stored result, [None, None] if the image
+              should be kept as is, or None if it couldn't be read
+    """
+    file_path, max_dimension = args
+    try:
+        # only needed when optimizing, so the archive builds without it
+        from PIL import Image
+        with Image.open(file_path) as image:
+            if getattr(image, "n_frames", 1) > 1:
+                return [None, None]
+            image.load()
+            image_format = image.format
+            if max(image.size) > max_dimension:
+                image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+            has_alpha = image.mode in ["RGBA", "LA", "P"] and \
+                (image.mode != "P" or "transparency" in image.info)
+            buffer = io.BytesIO()
+            if image_format == "JPEG" or \
+               (not has_alpha and image.getcolors(maxcolors=256) is None):
+                # photos compress far better as JPEG than PNG
+                image.convert("RGB").save(buffer, "JPEG", quality=JPEG_QUALITY, optimize=True,
+                                          progressive=True)
+                ext = ".jpg"
+            else:
+                image.save(buffer, "PNG", optimize=True)
+                ext = ".png"
+        data = buffer.getvalue()
+        original_ext = os.path.splitext(file_path)[1].lower()
+        if original_ext == ".jpeg" and ext == ".jpg":
+            ext = original_ext
+        if len(data) > os.path.getsize(file_path) * (1 - MIN_SAVINGS):
+            return [None, None]
+        digest = hashlib.sha256(data).hexdigest()
+        blob_path = get_blob_path(digest, ext)
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            tmp_path = "{}.{}.tmp".format(blob_path, os.getpid())
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, blob_path)
+        return [digest, ext]
+    except Exception as e:
+        print_exception("Exception for image:", file_path, e)
+        return None
+
+
+# guard the script so the processes compressing images don't rerun it
+if __name__ == "__main__":
+    bytes_saved = optimize_images()
+    print("Saved {:.1f} MB".format(bytes_saved / 2 ** 20))
@@ -0,0 +1,291 @@
+import html
+import json
+from multiprocessing import Pool
+import os
+import re
+import shutil
+
+from cache import JsonCache, note_written
+from dedup import hash_file
+from gdrive import DriveDownloader
+from records import GuideRecord
+from runlog import count, span
+from sitemap import get_page_url
+from utils import print_exception
+
+
+INGEST_DIR = "to_archive"
+# file names mapped to the "label", "class" and optional "source_url" of their guide
+INGEST_GUIDES_PATH = os.path.join(INGEST_DIR, "guides.json")
+# extensions converted to HTML, and those archived as they are
+CONVERTED_EXTENSIONS = [".rtf"]
+COPIED_EXTENSIONS = [".pdf", ".html", ".htm", ".xlsx"]
+# RTF groups holding settings rather than text
+RTF_SKIPPED_DESTINATIONS = {
+    "fonttbl", "colortbl", "expandedcolortbl", "stylesheet", "info", "pict", "listtable",
+    "listoverridetable", "header", "headerl", "headerr", "footer", "footerl", "footerr",
+    "object", "themedata", "colorschememapping", "datastore", "latentstyles", "generator",
+    "xmlnstbl", "rsidtbl", "filetbl", "revtbl",
+}
+RTF_TOKEN_PATTERN = re.compile(
+    r"\\([a-zA-Z]+)(-?\d+)? ?|\\'([0-9a-fA-F]{2})|\\(.)|([{}])|[\r\n]+|([^\\{}\r\n]+)",
+    re.DOTALL)
+HYPERLINK_PATTERN = re.compile(r"HYPERLINK\s+\"([^\"]*)\"")
+
+
+def ingest_files(num_processes=None):
+    """Archive the guides added by hand to INGEST_DIR
+
+    Files are converted or copied into the archive on a process pool, and
+    files whose content was ingested before are skipped. Only files given a
+    class in INGEST_GUIDES_PATH are ingested, since a guide without a class
+    has nowhere to be linked.
+
+    Args:
+        num_processes (int, optional): Number of processes to convert files on.
+                                       Defaults to the number of CPUs.
+
+    Returns:
+        list: GuideRecords of the ingested guides
+    """
+    if not os.path.exists(INGEST_GUIDES_PATH):
+        return []
+    with open(INGEST_GUIDES_PATH, encoding="utf-8") as f:
+        guides = json.load(f)
+    with span("ingest") as ingest_span:
+        hash_cache = JsonCache("content_hashes.json")
+        # content hashes of ingested files mapped to their archive paths
+        ingested = JsonCache("ingested_files.json")
+        ingested_paths = {entry["value"] for entry in ingested.entries.values()}
+        records = []
+        pending = []
+        for file_name in sorted(os.listdir(INGEST_DIR)):
+            file_path = os.path.join(INGEST_DIR, file_name)
+            stem, ext = os.path.splitext(file_name)
+            if ext.lower() not in CONVERTED_EXTENSIONS + COPIED_EXTENSIONS:
+                continue
+            guide = guides.get(file_name)
+            if guide is None or guide.get("class") is None:
+                print("No class for {} in {}, so it won't be archived\n".format(
+                    file_name, INGEST_GUIDES_PATH))
+                continue
+            if ext.lower() in CONVERTED_EXTENSIONS:
+                archive_name = DriveDownloader.sanitize_name(stem) + ".html"
+            else:
+                archive_name = DriveDownloader.sanitize_name(file_name)
+            archive_path = "archive/" + archive_name
+            digest = hash_file(file_path, hash_cache)
+            if ingested.get(digest) == archive_path and os.path.exists(archive_path):
+                ingest_span.count("cache_hits")
+            elif os.path.exists(archive_path) and archive_path not in ingested_paths:
+                # never replace a guide that was archived from Drive or the web
+                print("{} is already archived, so {} wasn't ingested\n".format(
+                    archive_path, file_path))
+                continue
+            else:
+                pending += [(file_path, archive_path, digest)]
+            records += [GuideRecord(guide.get("source_url") or get_page_url(archive_path),
+                                    guide.get("label", stem), guide["class"],
+                                    archive_path=archive_path)]
+        hash_cache.save()
+        if not pending:
+            return records
+        with Pool(num_processes) as process_pool:
+            results = process_pool.imap(ingest_file, [(file_path, archive_path)
+                                                      for file_path, archive_path, _ in pending])
+            for (file_path, archive_path, digest), result in zip(pending, results):
+                if result is None:
+                    records = [record for record in records
+                               if record.archive_path != archive_path]
+                    continue
+                ingested.set(digest, archive_path)
+                # the file was written by a worker process, which can't note it
+                note_written(archive_path)
+                count("bytes", os.path.getsize(archive_path))
+        ingested.save()
+    return records
+
+
+def add_ingested_records(records, ingested_guides):
+    """Add records for ingested guides, updating those the records already link
+
+    Args:
+        records (GuideRecords): Guide records
+        ingested_guides (dict): Archive paths mapped to [url, label, class] of ingested guides
+    """
+    archive_paths = set()
+    for record in records:
+        if record.archive_path in ingested_guides:
+            # the label and class may have been edited in INGEST_GUIDES_PATH
+            record.label, record.link_class = ingested_guides[record.archive_path][1:]
+            archive_paths.add(record.archive_path)
+    for archive_path, (url, label, link_class) in ingested_guides.items():
+        if archive_path not in archive_paths and not records.with_url(url):
+            records.add(GuideRecord(url, label, link_class, archive_path=archive_path))
+
+
+def ingest_file(args):
+    """Convert or copy a file into the archive, replacing the old copy only once written
+
+    Args:
+        args ((str, str)): Path to the file,
+                           Path to archive it at
+
+    Returns:
+        str: Archive path or None if the file couldn't be ingested
+    """
+    file_path, archive_path = args
+    tmp_path = archive_path + ".tmp"
+    try:
+        if os.path.splitext(file_path)[1].lower() == ".rtf":
+            with open(file_path, encoding="ascii", errors="replace") as f:
+                rtf = f.read()
+            title = os.path.splitext(os.path.basename(file_path))[0]
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(rtf_to_html(rtf, title))
+        else:
+            shutil.copyfile(file_path, tmp_path)
+        os.replace(tmp_path, archive_path)
+        return archive_path
+    except Exception as e:
+        print_exception("Exception for file:", file_path, e)
+        return None
+
+
+def rtf_to_html(rtf, title):
+    """Convert the text, paragraphs, bold, italics and links of an RTF document to HTML
+
+    Args:
+        rtf (str): RTF document
+        title (str): Title of the HTML page
+
+    Returns:
+        str: HTML document
+    """
+    paragraphs = []
+    cur_paragraph = []
+    # formatting of each open group, innermost last
+    state = {"bold": False, "italic": False, "skip": False, "field_inst": False, "link": False,
+             "uc": 1}
+    stack = []
+    encoding = "cp1252"
+    field_inst = []
+    link_url = None
+    # characters after a \u escape that repeat it for older readers
+    fallback_chars = 0
+    group_start = False
+
+    def add_text(text):
+        if state["skip"]:
+            return
+        if state["field_inst"]:
+            field_inst.append(text)
+            return
+        text = html.escape(text, quote=False)
+        if state["italic"]:
+            text = "<i>" + text + "</i>"
+        if state["bold"]:
+            text = "<b>" + text + "</b>"
+        cur_paragraph.append(text)
+
+    def end_paragraph():
+        if "".join(cur_paragraph).strip():
+            paragraphs.append("".join(cur_paragraph).strip())
+        cur_paragraph.clear()
+
+    for match in RTF_TOKEN_PATTERN.finditer(rtf):
+        word, param, hex_byte, symbol, brace, text = match.groups()
+        is_group_start = group_start
+        group_start = False
+        if brace == "{":
+            stack.append(dict(state))
+            group_start = True
+        elif brace == "}":
+            if state["link"] and stack and not stack[-1]["link"]:
+                cur_paragraph.append("</a>")
+            if state["field_inst"] and stack and not stack[-1]["field_inst"]:
+                hyperlink = HYPERLINK_PATTERN.search("".join(field_inst))
+                link_url = hyperlink.group(1) if hyperlink is not None else None
+                field_inst.clear()
+            if stack:
+                state = stack.pop()
+        elif word is not None:
+            if fallback_chars > 0:
+                fallback_chars -= 1
+                continue
+            if word in RTF_SKIPPED_DESTINATIONS and is_group_start:
+                state["skip"] = True
+            elif word == "fldinst":
+                state["field_inst"] = True
+            elif word == "fldrslt":
+                if link_url is not None and not state["skip"]:
+                    cur_paragraph.append("<a href=\"{}\">".format(html.escape(link_url)))
+                    state["link"] = True
+                link_url = None
+            elif word == "ansicpg" and param is not None:
+                encoding = "cp" + param
+            elif word in ["par", "sect", "page"]:
+                if not state["skip"]:
+                    end_paragraph()
+            elif word == "line":
+                if not state["skip"]:
+                    cur_paragraph.append("<br>")
+            elif word == "tab":
+                add_text(" ")
+            elif word == "b":
+                state["bold"] = param != "0"
+            elif word == "i":
+                state["italic"] = param != "0"
+            elif word == "plain":
+                state["bold"] = state["italic"] = False
+            elif word == "uc" and param is not None:
+                state["uc"] = int(param)
+            elif word == "u" and param is not None:
+                add_text(chr(int(param) % 65536))
+                fallback_chars = state["uc"]
+            elif word in ["emdash", "endash", "bullet", "lquote", "rquote", "ldblquote",
+                          "rdblquote"]:
+                add_text({"emdash": "\u2014", "endash": "\u2013", "bullet": "\u2022",
+                          "lquote": "\u2018", "rquote": "\u2019", "ldblquote": "\u201c",
+                          "rdblquote": "\u201d"}[word])
+        elif hex_byte is not None:
+            if fallback_chars > 0:
+                fallback_chars -= 1
+                continue
+            add_text(bytes([int(hex_byte, 16)]).decode(encoding, errors="replace"))
+        elif symbol is not None:
+            if symbol == "*" and is_group_start:
+                # unknown destinations marked ignorable are skipped, except field instructions
+                group_start = True
+                if not rtf.startswith("\\fldinst", match.end()):
+                    state["skip"] = True
+            elif symbol in "\r\n":
+                # a backslash before a line break ends the paragraph
+                if not state["skip"]:
+                    end_paragraph()
+            elif symbol == "~":
+                add_text("\u00a0")
+            elif symbol == "_":
+                add_text("\u2011")
+            elif symbol in "\\{}":
+                add_text(symbol)
+        elif text is not None:
+            if fallback_chars > 0:
+                skipped = min(fallback_chars, len(text))
+                text = text[skipped:]
+                fallback_chars -= skipped
+            if text:
+                add_text(text)
+    end_paragraph()
+    body = "".join("<p>{}</p>\n".format(paragraph) for paragraph in paragraphs)
+    return RTF_HTML_TEMPLATE.format(title=html.escape(title), body=body)
+
+
+RTF_HTML_TEMPLATE = "<!DOCTYPE html>\n<html>\n<head>\n<meta charset=\"utf-8\">\n" \
+                    "<title>{title}</title>\n</head>\n<body>\n{body}</body>\n</html>\n"
+
+
+# guard the script so processes started for conversion don't rerun it
+if __name__ == "__main__":
+    for record in ingest_files():
+        print(record.archive_path)
@@ -1,17 +1,35 @@
-var parseHTML = function(str) {
-    var tmp = document.implementation.createHTMLDocument();
-    tmp.body.innerHTML = str;
-    return tmp.body.children;
+var loadClassLinks = function (label, path) {
+    $.get(path, function (links_html_str) {
+        filled_div = $("<div></div>").addClass("class-links").attr("data-class", label.id);
+        $(label).after(filled_div.html(links_html_str));
+    });
 };
 
-$.get("archive_links.html", function (links_html_str) {
-    links_html = parseHTML(links_html_str);
-    // iterate over class-label elements
+$.getJSON("archive_links.json", function (class_manifest) {
+    var pending = {};
+    // iterate over class-label elements that weren't inlined at build time
     $(".class-label").each(function () {
         class_str = $(this).attr("id");
-        empty_div = $.parseHTML("<div></div>");
-        filled_div = $(empty_div).append($(links_html).filter("." + class_str));
-        $("#" + class_str).after(filled_div);
-        $("." + class_str).after("<br>");
+        if (class_str in class_manifest && !$(this).next().hasClass("class-links")) {
+            pending[class_str] = class_manifest[class_str].path;
+        }
+    });
+    if (!("IntersectionObserver" in window)) {
+        $.each(pending, function (class_str, path) {
+            loadClassLinks(document.getElementById(class_str), path);
+        });
+        return;
+    }
+    // only fetch the links for a class once its section is close to the screen
+    var observer = new IntersectionObserver(function (entries) {
+        entries.forEach(function (entry) {
+            if (entry.isIntersecting) {
+                observer.unobserve(entry.target);
+                loadClassLinks(entry.target, pending[entry.target.id]);
+            }
+        });
+    }, {rootMargin: "1000px 0px"});
+    $.each(pending, function (class_str) {
+        observer.observe(document.getElementById(class_str));
     });
 });
@@ -1,37 +1,141 @@
-from html_export import archive_links
-from gdrive import DriveDownloader
-from sitemap import update_sitemap
-from web import save_webpages_with_path
-from zenith import ZenithParser
+import argparse
+import sys
 
 
 # give Google API credentials to DriveDownloader
 CRED_PATH = "pathfinderguidesguide-252540c96635.json"
-d_downloader = DriveDownloader(CRED_PATH)
-# get master URL reference
-z_parser = ZenithParser()
-urls, link_labels, link_classes = z_parser.get_guide_urls()
-# get URLs for non-Docs links and archive
-# non_docs_urls, non_docs_link_labels = z_parser.get_non_docs_urls()
-# non_docs_archive_paths = save_webpages_with_path(non_docs_urls)
-# get URLs for Google Docs links and archive
-docs_urls, docs_link_labels = z_parser.get_docs_urls()
-docs_archive_paths = d_downloader.archive_urls(docs_urls)
-# combine archive paths into single list
-archive_paths = [None] * len(urls)
-url_path_lists = [
-    # (non_docs_urls, ["#"] * len(non_docs_urls)),
-    (docs_urls, docs_archive_paths),
-]
-for i, url in enumerate(urls):
-    for url_list, path_list in url_path_lists:
-        try:
-            index = url_list.index(url)
-            archive_paths[i] = path_list[index]
-            break
-        except ValueError:
-            pass
-# output metadata in HTML
-archive_links(link_labels, link_classes, archive_paths)
-# update the sitemap for search engines
-update_sitemap()
+# subcommands that run the pipeline up to and including their stage
+PIPELINE_COMMANDS = ["parse", "resolve", "download", "extract"]
+
+
+def main(argv=None):
+    """Run the archive, or a single stage of it, from the command line
+
+    Each command imports only what it needs, so commands that work on what is
+    already on disk start quickly and need no credentials.
+
+    Args:
+        argv (list, optional): Command line arguments. Defaults to sys.argv[1:].
+
+    Returns:
+        int: Exit status
+    """
+    parser = argparse.ArgumentParser(description="Archive the guides linked by Zenith Games.")
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    run_parser = subparsers.add_parser("run", help="run every stage (the default)")
+    stage_parsers = [run_parser]
+    for stage in PIPELINE_COMMANDS:
+        stage_parsers += [subparsers.add_parser(stage, help="run the stages through " + stage)]
+    export_parser = subparsers.add_parser(
+        "export", help="write the link page, sitemap and indexes from the archived guides")
+    ingest_parser = subparsers.add_parser(
+        "ingest", help="archive the guides in to_archive/ and export them with the archive")
+    subparsers.add_parser("sitemap", help="rewrite sitemap.txt from archive_links.html")
+    verify_parser = subparsers.add_parser("verify", help="check the archive for problems")
+    verify_parser.add_argument("--record", action="store_true",
+                               help="record the current checksums instead of checking them")
+    for stage_parser in stage_parsers:
+        stage_parser.add_argument("--threads", type=int, default=4,
+                                  help="number of threads for Drive requests")
+        stage_parser.add_argument("--update", choices=["full", "incremental"],
+                                  help="redownload every Doc, or only Docs changed upstream")
+        stage_parser.add_argument("--web-pages", action="store_true",
+                                  help="also archive the guides that aren't Docs")
+        stage_parser.add_argument("--images", action="store_true",
+                                  help="recompress and downsize extracted images")
+        stage_parser.add_argument("--force", action="append", default=[], metavar="STAGE",
+                                  help="re-run a stage and the stages after it, where "
+                                       "forcing download redownloads every Doc")
+    for command_parser in stage_parsers + [export_parser, ingest_parser]:
+        command_parser.add_argument("--no-log", action="store_true",
+                                    help="don't write a run log to logs/")
+    argv = sys.argv[1:] if argv is None else argv
+    # a full run is the default command
+    if not argv or argv[0] not in list(subparsers.choices) + ["-h", "--help"]:
+        argv = ["run"] + argv
+    args = parser.parse_args(argv)
+
+    if args.command == "sitemap":
+        from sitemap import update_sitemap
+        update_sitemap()
+        return 0
+    if args.command == "verify":
+        from cache import clear_written_paths
+        from verify import print_report, record_checksums, verify_archive
+        if args.record:
+            record_checksums()
+            clear_written_paths()
+            return 0
+        report = verify_archive()
+        print_report(report)
+        return 1 if any(report.values()) else 0
+
+    from runlog import end_run_log, start_run_log, summarize_run_log
+    # record stage and file timings in logs/
+    if not args.no_log:
+        start_run_log()
+    if args.command in ["export", "ingest"]:
+        status = export(ingest=args.command == "ingest")
+    else:
+        run_pipeline(args)
+        status = 0
+    # report the slowest stages and files of the run
+    if not args.no_log:
+        print(summarize_run_log(end_run_log()))
+    return status
+
+
+def run_pipeline(args):
+    """Parse the master URL reference, archive the Docs links and export the archive,
+    resuming from the checkpoints of an interrupted run
+
+    Args:
+        args (argparse.Namespace): Parsed arguments of a pipeline command
+    """
+    from gdrive import DriveDownloader
+    from pipeline import Pipeline
+
+    # credentials are only read once Drive is called, so resumed stages may not need them
+    d_downloader = DriveDownloader(CRED_PATH, num_threads=args.threads)
+    update_archive = {None: False, "full": True, "incremental": "incremental"}[args.update]
+    pipeline = Pipeline(d_downloader, update_archive=update_archive, web_pages=args.web_pages,
+                        images=args.images, force=args.force)
+    pipeline.run(through="export" if args.command == "run" else args.command)
+    # optionally store shared extracted assets once and drop zips that were extracted
+    # from dedup import collect_garbage, dedupe_archive
+    # dedupe_archive(mode="link")
+    # collect_garbage()
+
+
+def export(ingest=False):
+    """Export the archive again from the guides in the JSON index of the last export
+
+    Args:
+        ingest (bool, optional): Whether to first archive the guides in to_archive/ and
+                                 add them to the export. Defaults to False.
+
+    Returns:
+        int: Exit status
+    """
+    from html_export import read_archive_index
+    from ingest import add_ingested_records, ingest_files
+    from pipeline import export_records, read_run
+
+    run = read_run()
+    if run is not None and not run["complete"]:
+        print("An interrupted run isn't included until it finishes with `main.py run`\n")
+    records = read_archive_index()
+    if records is None:
+        print("Nothing has been exported yet, so run the archive first")
+        return 1
+    if ingest:
+        add_ingested_records(records, {record.archive_path: [record.url, record.label,
+                                                             record.link_class]
+                                       for record in ingest_files()})
+    export_records(records)
+    return 0
+
+
+# guard the script so processes started for text extraction don't rerun it
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+import json
+import os
+from threading import Lock
+
+from extract import is_archived
+
+
+MANIFEST_PATH = "archive/manifest.json"
+# metadata fields that change whenever the file changes upstream
+REVISION_FIELDS = ["version", "modifiedTime", "md5Checksum"]
+
+
+class ArchiveManifest():
+    """Record of the Drive revision each archived file was exported from
+    """
+    def __init__(self, manifest_path=MANIFEST_PATH):
+        self.manifest_path = manifest_path
+        self.entries = {}
+        self._lock = Lock()
+        if os.path.exists(manifest_path):
+            with open(manifest_path, encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    def is_current(self, file_id, metadata, download_type, file_path):
+        """Check if the archived file matches the upstream revision
+
+        Args:
+            file_id (str): ID for the Google Doc
+            metadata (dict): Current Drive metadata for the file
+            download_type (str): mimeType the file would be downloaded as
+            file_path (str): Path the file would be archived at
+
+        Returns:
+            bool: Whether the archived copy is up to date
+        """
+        with self._lock:
+            entry = self.entries.get(file_id)
+        if entry is None or entry["path"] != file_path or \
+           entry["download_type"] != download_type:
+            return False
+        if not is_archived(file_path):
+            return False
+        return all(entry.get(field) == metadata.get(field) for field in REVISION_FIELDS)
+
+    def get(self, file_id):
+        """Get the recorded revision of an archived file
+
+        Args:
+            file_id (str): ID for the Google Doc
+
+        Returns:
+            dict: Manifest entry or None if the file wasn't recorded
+        """
+        with self._lock:
+            return self.entries.get(file_id)
+
+    def paths(self):
+        """Get the path each recorded file was archived at
+
+        Returns:
+            dict: File IDs mapped to their archive paths
+        """
+        with self._lock:
+            return {file_id: entry["path"] for file_id, entry in self.entries.items()}
+
+    def record(self, file_id, metadata, download_type, file_path):
+        """Record the upstream revision of a freshly archived file
+
+        Args:
+            file_id (str): ID for the Google Doc
+            metadata (dict): Drive metadata the file was downloaded with
+            download_type (str): mimeType the file was downloaded as
+            file_path (str): Path the file was archived at
+        """
+        entry = {field: metadata.get(field) for field in REVISION_FIELDS}
+        entry["download_type"] = download_type
+        entry["path"] = file_path
+        with self._lock:
+            self.entries[file_id] = entry
+
+    def save(self):
+        """Write the manifest to disk, replacing the old one only once fully written
+        """
+        with self._lock:
+            manifest_str = json.dumps(self.entries, indent=4, sort_keys=True, ensure_ascii=False)
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(manifest_str)
+        os.replace(tmp_path, self.manifest_path)
@@ -0,0 +1,441 @@
+import hashlib
+import json
+from multiprocessing.dummy import Pool
+import os
+from threading import Lock
+
+from cache import CACHE_DIR, clear_written_paths, JsonCache, read_written_paths
+from extract import extract_zip
+from gdrive import BATCH_SIZE
+from html_export import export_archive
+from images import optimize_images
+from ingest import add_ingested_records, ingest_files, INGEST_DIR
+from runlog import span
+from search import build_search_index, export_search_index, SEARCH_DB_PATH, SEARCH_INDEX_DIR
+from utils import print_exception
+from verify import record_checksums
+from web import save_webpage_records
+from zenith import links_to_records, ZenithParser, ZENITH_BACKUP_PATH
+
+
+CHECKPOINT_DIR = os.path.join(CACHE_DIR, "checkpoints")
+RUN_PATH = os.path.join(CHECKPOINT_DIR, "run.json")
+STAGES = ["parse", "web", "resolve", "metadata", "download", "extract", "images", "ingest",
+          "export"]
+# units of work finished between checkpoint writes
+CHECKPOINT_INTERVAL = 25
+
+
+class Checkpoint():
+    """Units of work a stage has finished in the current run
+
+    The checkpoint is tied to a hash of the stage inputs, so a stage whose
+    inputs changed starts over instead of resuming.
+    """
+    def __init__(self, stage, inputs):
+        self.checkpoint_path = os.path.join(CHECKPOINT_DIR, stage + ".json")
+        self.inputs_hash = hashlib.sha256(json.dumps(inputs).encode("utf-8")).hexdigest()
+        self.complete = False
+        self.units = {}
+        self._lock = Lock()
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, encoding="utf-8") as f:
+                saved = json.load(f)
+            if saved["inputs"] == self.inputs_hash:
+                self.complete = saved["complete"]
+                self.units = saved["units"]
+
+    def add(self, key, value):
+        """Record a finished unit of work
+
+        Args:
+            key (str): Key of the unit, such as a URL or file ID
+            value: JSON serializable result of the unit
+        """
+        with self._lock:
+            self.units[key] = value
+
+    def save(self):
+        """Write the checkpoint, replacing the old one only once fully written
+        """
+        with self._lock:
+            checkpoint_str = json.dumps({"inputs": self.inputs_hash, "complete": self.complete,
+                                         "units": self.units}, ensure_ascii=False)
+        os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(checkpoint_str)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def finish(self):
+        """Mark the stage complete and write the checkpoint
+        """
+        self.complete = True
+        self.save()
+
+
+class Pipeline():
+    """Archive run split into stages that checkpoint their progress
+
+    A run that stops partway, from a crash or an exhausted quota, is resumed
+    by the next run from the last unfinished unit of work of the first
+    incomplete stage. Once every stage completes the run is done, and the
+    next run starts over.
+    """
+    def __init__(self, d_downloader, backup_path=ZENITH_BACKUP_PATH, update_archive=False,
+                 web_pages=False, images=False, force=()):
+        """
+        Args:
+            d_downloader (DriveDownloader): Downloader for the Docs
+            backup_path (str, optional): Path of the Zenith Games page. Defaults to
+                                         ZENITH_BACKUP_PATH.
+            update_archive (bool or str, optional): Whether to redownload and update archived
+                                                    Docs, or "incremental" to redownload only
+                                                    Docs changed upstream. Defaults to False.
+            web_pages (bool, optional): Whether to archive the non-Docs guides. Defaults to False.
+            images (bool, optional): Whether to recompress and downsize extracted images.
+                                     Defaults to False.
+            force (list, optional): Stages to re-run even if their checkpoint is complete,
+                                    along with the stages after them. Forcing "download"
+                                    redownloads every Doc unless update_archive is
+                                    "incremental". Defaults to none.
+        """
+        for stage in force:
+            if stage not in STAGES:
+                raise ValueError("Unexpected stage:\n" + stage)
+        self.d_downloader = d_downloader
+        self.backup_path = backup_path
+        # files already on disk are only downloaded again when updating
+        if "download" in force and not update_archive:
+            update_archive = True
+        self.update_archive = update_archive
+        self.web_pages = web_pages
+        self.images = images
+        self.force = force
+        self._stages = STAGES
+        self._extract_pool = None
+        self._extractions = {}
+        self._extraction_lock = Lock()
+
+    def run(self, through=STAGES[-1]):
+        """Run the stages, resuming an interrupted run from its checkpoints
+
+        A run that stops before the last stage is left unfinished, so the
+        next run picks up from its checkpoints.
+
+        Args:
+            through (str, optional): Last stage to run. Defaults to the last of STAGES.
+
+        Returns:
+            GuideRecords: Records of the guides with their file IDs and archive paths
+        """
+        if through not in STAGES:
+            raise ValueError("Unexpected stage:\n" + through)
+        self.start_run()
+        self._stages = STAGES[:STAGES.index(through) + 1]
+        self._extract_pool = Pool(self.d_downloader.num_threads)
+        stage_functions = {
+            "web": self.archive_web_pages,
+            "resolve": self.resolve,
+            "metadata": self.fetch_metadata,
+            "download": self.download,
+            "extract": self.extract,
+            "images": self.optimize_images,
+            "ingest": self.ingest,
+            "export": self.export,
+        }
+        records = self.parse()
+        for stage in self._stages[1:]:
+            # optional stages
+            if (stage == "web" and not self.web_pages) or (stage == "images" and not self.images):
+                continue
+            stage_functions[stage](records)
+        # close threads, but don't bother waiting for them to free resources
+        self._extract_pool.close()
+        if through == STAGES[-1]:
+            write_run({"complete": True})
+        return records
+
+    def start_run(self):
+        """Resume the unfinished run or start a new one, clearing forced checkpoints
+        """
+        run = read_run()
+        if run is None or run["complete"]:
+            cleared_stages = STAGES
+        else:
+            print("Resuming interrupted run\n")
+            # forcing a stage also re-runs the stages that use its results
+            forced_inds = [STAGES.index(stage) for stage in self.force]
+            cleared_stages = STAGES[min(forced_inds):] if forced_inds else []
+        for stage in cleared_stages:
+            checkpoint_path = os.path.join(CHECKPOINT_DIR, stage + ".json")
+            if os.path.exists(checkpoint_path):
+                os.remove(checkpoint_path)
+        write_run({"complete": False})
+
+    def parse(self):
+        """Parse the link table of the Zenith Games page
+
+        Returns:
+            GuideRecords: Records for every guide link
+        """
+        checkpoint = Checkpoint("parse", self.backup_path)
+        if not checkpoint.complete:
+            checkpoint.add("links", ZenithParser(self.backup_path).links)
+            checkpoint.finish()
+        return links_to_records(checkpoint.units["links"])
+
+    def archive_web_pages(self, records):
+        """Archive the non-Docs guides, setting their archive paths
+
+        Args:
+            records (GuideRecords): Guide records
+        """
+        web_urls = records.unique_urls(is_docs=False)
+        checkpoint = Checkpoint("web", web_urls)
+        if not checkpoint.complete:
+            # saved pages are revalidated rather than fetched again
+            save_webpage_records(records)
+            for url in web_urls:
+                checkpoint.add(url, records.with_url(url)[0].archive_path)
+            checkpoint.finish()
+        for url in web_urls:
+            records.set_archive_path(url, checkpoint.units[url])
+
+    def resolve(self, records):
+        """Resolve the file IDs of the Docs links, setting them on the records
+
+        Args:
+            records (GuideRecords): Guide records
+        """
+        docs_urls = records.unique_urls(is_docs=True)
+        checkpoint = Checkpoint("resolve", docs_urls)
+        if not checkpoint.complete:
+            # URLs that failed are retried when resuming
+            pending_urls = [url for url in docs_urls if checkpoint.units.get(url) is None]
+            chunk_size = CHECKPOINT_INTERVAL * self.d_downloader.num_threads
+            for start_ind in range(0, len(pending_urls), chunk_size):
+                chunk_urls = pending_urls[start_ind:start_ind + chunk_size]
+                for url, file_id in zip(chunk_urls, self.d_downloader.get_doc_ids(chunk_urls)):
+                    checkpoint.add(url, file_id)
+                checkpoint.save()
+            checkpoint.finish()
+        for url in docs_urls:
+            records.set_file_id(url, checkpoint.units.get(url))
+
+    def fetch_metadata(self, records):
+        """Fetch the Drive metadata of the Docs in batches
+
+        Args:
+            records (GuideRecords): Guide records with file IDs
+        """
+        file_ids = get_file_ids(records)
+        checkpoint = Checkpoint("metadata", file_ids)
+        d_downloader = self.d_downloader
+        with d_downloader._metadata_lock:
+            d_downloader.metadata_cache.update(checkpoint.units)
+        if checkpoint.complete:
+            return
+        pending_ids = [file_id for file_id in file_ids if file_id not in checkpoint.units]
+        chunk_size = BATCH_SIZE * 10
+        for start_ind in range(0, len(pending_ids), chunk_size):
+            chunk_ids = pending_ids[start_ind:start_ind + chunk_size]
+            d_downloader.prefetch_metadata(chunk_ids)
+            with d_downloader._metadata_lock:
+                for file_id in chunk_ids:
+                    if file_id in d_downloader.metadata_cache:
+                        checkpoint.add(file_id, d_downloader.metadata_cache[file_id])
+            checkpoint.save()
+        checkpoint.finish()
+
+    def download(self, records):
+        """Download the Docs, starting extraction of each zip as soon as it lands
+
+        Args:
+            records (GuideRecords): Guide records with file IDs
+        """
+        file_ids = get_file_ids(records)
+        checkpoint = Checkpoint("download", [file_ids, self.update_archive])
+        if checkpoint.complete:
+            return
+        # files that failed are retried when resuming
+        pending_ids = [file_id for file_id in file_ids if checkpoint.units.get(file_id) is None]
+        save_lock = Lock()
+        num_saved = [0]
+
+        def on_saved(i, file_path):
+            checkpoint.add(pending_ids[i], file_path)
+            self.start_extraction(file_path)
+            with save_lock:
+                num_saved[0] += 1
+                if num_saved[0] % CHECKPOINT_INTERVAL == 0:
+                    # record downloads in the manifest before checkpointing them
+                    self.d_downloader.manifest.save()
+                    checkpoint.save()
+
+        self.d_downloader.save_docs(pending_ids, update_archive=self.update_archive,
+                                    on_saved=on_saved)
+        self.d_downloader.manifest.save()
+        checkpoint.finish()
+
+    def start_extraction(self, file_path):
+        """Start extracting a downloaded zip on the extraction pool
+
+        Args:
+            file_path (str): Archive path of the download or None
+        """
+        if file_path is None or file_path[-4:] != ".zip" or "extract" not in self._stages:
+            return
+        # extract each zip once even if several files are saved to it
+        with self._extraction_lock:
+            if file_path not in self._extractions:
+                self._extractions[file_path] = self._extract_pool.apply_async(extract_zip,
+                                                                              (file_path,))
+
+    def extract(self, records):
+        """Extract the downloaded zips, setting the archive paths of the Docs records
+
+        Args:
+            records (GuideRecords): Guide records with file IDs
+        """
+        file_ids = get_file_ids(records)
+        file_paths = self.downloaded_paths(file_ids)
+        checkpoint = Checkpoint("extract", file_paths)
+        if not checkpoint.complete:
+            with span("extract"):
+                # zips downloaded before a resume haven't been queued yet
+                for file_path in file_paths.values():
+                    if file_path not in checkpoint.units:
+                        self.start_extraction(file_path)
+                for file_path, extraction in self._extractions.items():
+                    if file_path in checkpoint.units:
+                        continue
+                    try:
+                        checkpoint.add(file_path, extraction.get())
+                    except Exception as e:
+                        print_exception("Exception for ZIP:", file_path, e)
+            checkpoint.finish()
+        # point zips at their extracted HTML files
+        for url in records.unique_urls(is_docs=True):
+            file_path = file_paths.get(records.with_url(url)[0].file_id)
+            if file_path is not None and file_path[-4:] == ".zip":
+                file_path = checkpoint.units.get(file_path)
+            records.set_archive_path(url, file_path)
+
+    def optimize_images(self, records):
+        """Recompress and downsize the images of the extracted Docs
+
+        Args:
+            records (GuideRecords): Guide records with archive paths
+        """
+        archive_paths = [record.archive_path for record in records if record.is_docs]
+        checkpoint = Checkpoint("images", archive_paths)
+        if checkpoint.complete:
+            return
+        # images already optimized are skipped by their hash, so there's nothing to resume
+        checkpoint.add("bytes_saved", optimize_images())
+        checkpoint.finish()
+
+    def ingest(self, records):
+        """Archive the guides added by hand to to_archive/, adding their records
+
+        Args:
+            records (GuideRecords): Guide records
+        """
+        checkpoint = Checkpoint("ingest", sorted(os.listdir(INGEST_DIR))
+                                if os.path.isdir(INGEST_DIR) else [])
+        if not checkpoint.complete:
+            for record in ingest_files():
+                checkpoint.add(record.archive_path, [record.url, record.label, record.link_class])
+            checkpoint.finish()
+        add_ingested_records(records, checkpoint.units)
+
+    def downloaded_paths(self, file_ids):
+        """Get the archive paths the download stage saved the Docs to
+
+        Args:
+            file_ids (list): IDs for the Google Docs
+
+        Returns:
+            dict: File IDs mapped to their archive paths or None
+        """
+        units = Checkpoint("download", [file_ids, self.update_archive]).units
+        return {file_id: units.get(file_id) for file_id in file_ids}
+
+    def export(self, records):
+        """Write the link page, sitemap, JSON index and search index
+
+        Args:
+            records (GuideRecords): Guide records with archive paths
+        """
+        archive_paths = [[record.url, record.archive_path] for record in records]
+        checkpoint = Checkpoint("export", archive_paths)
+        if checkpoint.complete:
+            return
+        export_records(records)
+        checkpoint.finish()
+
+
+def export_records(records):
+    """Write the link page, sitemap, JSON index and search index, and record checksums
+
+    Args:
+        records (GuideRecords): Guide records with archive paths
+    """
+    export_archive(records)
+    written_paths = read_written_paths()
+    # the index only changes with the indexed files and their labels, so an export
+    # after a run that wrote none of them keeps the index it has
+    search_inputs = [[record.archive_path, record.label, record.link_class]
+                     for record in records]
+    inputs_hash = hashlib.sha256(json.dumps(search_inputs).encode("utf-8")).hexdigest()
+    search_cache = JsonCache("search_inputs.json")
+    if search_cache.get("inputs_hash") != inputs_hash or \
+       any(record.archive_path is not None and
+           os.path.normpath(record.archive_path) in written_paths for record in records) or \
+       not os.path.exists(SEARCH_DB_PATH) or \
+       not os.path.exists(os.path.join(SEARCH_INDEX_DIR, "docs.json")):
+        with span("search"):
+            build_search_index(records)
+            export_search_index()
+        search_cache.set("inputs_hash", inputs_hash)
+        search_cache.save()
+    # record the files written since the last export for verify.py
+    record_checksums(written_paths)
+    clear_written_paths()
+
+
+def get_file_ids(records):
+    """Get each resolved file ID of the Docs records once, in the order first linked
+
+    Args:
+        records (GuideRecords): Guide records with file IDs
+
+    Returns:
+        list: IDs for the Google Docs
+    """
+    return list(dict.fromkeys(record.file_id for record in records
+                              if record.is_docs and record.file_id is not None))
+
+
+def read_run():
+    """Read the state of the latest run
+
+    Returns:
+        dict: State of the run or None if there hasn't been one
+    """
+    if not os.path.exists(RUN_PATH):
+        return None
+    with open(RUN_PATH, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_run(run):
+    """Write the state of the current run
+
+    Args:
+        run (dict): State of the run
+    """
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+    with open(RUN_PATH, "w", encoding="utf-8") as f:
+        json.dump(run, f)
@@ -0,0 +1,104 @@
+class GuideRecord():
+    """A guide link and where it was archived
+    """
+    __slots__ = ["url", "label", "link_class", "is_docs", "blacklisted", "file_id",
+                 "archive_path"]
+
+    def __init__(self, url, label, link_class, is_docs=False, blacklisted=False, file_id=None,
+                 archive_path=None):
+        self.url = url
+        self.label = label
+        self.link_class = link_class
+        self.is_docs = is_docs
+        self.blacklisted = blacklisted
+        self.file_id = file_id
+        self.archive_path = archive_path
+
+
+class GuideRecords():
+    """Ordered guide records with lookups by URL and by file ID
+    """
+    def __init__(self, records=()):
+        self.records = []
+        self.by_url = {}
+        self.by_file_id = {}
+        for record in records:
+            self.add(record)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, record):
+        """Add a record to the end of the records
+
+        Args:
+            record (GuideRecord): Record to add
+        """
+        self.records.append(record)
+        self.by_url.setdefault(record.url, []).append(record)
+        if record.file_id is not None:
+            self.by_file_id.setdefault(record.file_id, []).append(record)
+
+    def with_url(self, url):
+        """Get the records linking to a URL
+
+        Args:
+            url (str): URL of the guide
+
+        Returns:
+            list: Records with the URL
+        """
+        return self.by_url.get(url, [])
+
+    def with_file_id(self, file_id):
+        """Get the records for a Docs file
+
+        Args:
+            file_id (str): ID for the Google Doc
+
+        Returns:
+            list: Records with the file ID
+        """
+        return self.by_file_id.get(file_id, [])
+
+    def set_file_id(self, url, file_id):
+        """Set the file ID of every record linking to a URL
+
+        Args:
+            url (str): URL of the guide
+            file_id (str): ID for the Google Doc or None
+        """
+        for record in self.with_url(url):
+            if record.file_id is not None:
+                self.by_file_id[record.file_id].remove(record)
+            record.file_id = file_id
+            if file_id is not None:
+                self.by_file_id.setdefault(file_id, []).append(record)
+
+    def set_archive_path(self, url, archive_path):
+        """Set the archive path of every record linking to a URL
+
+        Args:
+            url (str): URL of the guide
+            archive_path (str): Path the guide was archived at or None
+        """
+        for record in self.with_url(url):
+            record.archive_path = archive_path
+
+    def unique_urls(self, is_docs=True):
+        """Get each URL once, in the order first linked
+
+        Args:
+            is_docs (bool, optional): Whether to get Docs URLs or non-Docs guide URLs.
+                                      Defaults to True.
+
+        Returns:
+            list: URLs of the records
+        """
+        # blacklisted labels only mark non-Docs links that aren't guides
+        return list(dict.fromkeys(record.url for record in self.records
+                                  if record.is_docs == is_docs and
+                                  (is_docs or not record.blacklisted)))
@@ -0,0 +1,308 @@
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import os
+import sys
+from threading import get_ident, local, Lock
+import time
+
+
+LOGS_DIR = "logs"
+# counters every file span reports, even when zero
+FILE_COUNTERS = ["bytes", "api_calls", "retries", "cache_hits", "errors"]
+
+
+class Span():
+    """A timed stage or file with counters, written to the run log when it ends
+
+    Worker threads count toward the stage span of the thread that opened it,
+    so counters are only changed and read under the span's lock.
+    """
+    __slots__ = ["name", "kind", "counters", "start_time", "_lock"]
+
+    def __init__(self, name, kind):
+        self.name = name
+        self.kind = kind
+        self.counters = dict.fromkeys(FILE_COUNTERS, 0) if kind == "file" else {}
+        self.start_time = time.time()
+        self._lock = Lock()
+
+    def count(self, counter, amount=1):
+        """Add to a counter of the span
+
+        Args:
+            counter (str): Name of the counter, such as "bytes" or "api_calls"
+            amount (int, optional): Amount to add. Defaults to 1.
+        """
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def get_counters(self):
+        """Get a copy of the counters that other threads can't change while it is read
+
+        Returns:
+            dict: Counter names mapped to their totals
+        """
+        with self._lock:
+            return dict(self.counters)
+
+
+class RunLog():
+    """Thread safe JSONL log of the spans and errors of one run
+
+    Each line is a JSON object with a "type" of "run_start", "span", "error"
+    or "run_end". Spans are written when they end, so a log cut short by a
+    crash still holds everything that finished.
+    """
+    def __init__(self, log_path=None):
+        if log_path is None:
+            log_path = os.path.join(LOGS_DIR,
+                                    "run-" + datetime.now().strftime("%Y%m%d-%H%M%S") + ".jsonl")
+        self.log_path = log_path
+        os.makedirs(os.path.dirname(log_path) or ".", exist_ok=True)
+        self._f = open(log_path, "w", encoding="utf-8")
+        self._lock = Lock()
+        self.start_time = time.time()
+        # stage spans are opened one after another, so files report the latest one
+        self._stages = []
+        self.write({"type": "run_start", "time": self.start_time, "argv": sys.argv})
+
+    def write(self, entry):
+        """Write an entry as a line of the log
+
+        Args:
+            entry (dict): JSON serializable entry
+        """
+        line = json.dumps(entry, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            if not self._f.closed:
+                self._f.write(line)
+
+    def close(self):
+        """Write the end of the run and close the log
+        """
+        self.write({"type": "run_end", "time": time.time(),
+                    "seconds": round(time.time() - self.start_time, 4)})
+        with self._lock:
+            self._f.close()
+
+
+# log of the current run, or None when nothing is being logged
+_active_log = None
+# spans open on each thread, innermost last
+_thread_spans = local()
+
+
+def start_run_log(log_path=None):
+    """Start logging spans and errors of the run to a new JSONL file
+
+    Args:
+        log_path (str, optional): Path of the log. Defaults to a timestamped file in LOGS_DIR.
+
+    Returns:
+        RunLog: Log of the run
+    """
+    global _active_log
+    if _active_log is not None:
+        _active_log.close()
+    _active_log = RunLog(log_path)
+    return _active_log
+
+
+def end_run_log():
+    """Close the log of the run
+
+    Returns:
+        str: Path of the closed log or None if no log was started
+    """
+    global _active_log
+    if _active_log is None:
+        return None
+    _active_log.close()
+    log_path = _active_log.log_path
+    _active_log = None
+    return log_path
+
+
+@contextmanager
+def span(name, kind="stage", stage=None, **fields):
+    """Time a stage or file, collecting the counters added while it is open
+
+    Spans can be opened without a run log, in which case nothing is written.
+
+    Args:
+        name (str): Name of the stage, or identifier of the file
+        kind (str, optional): "stage" or "file". Defaults to "stage".
+        stage (str, optional): Stage the span belongs to. Defaults to the latest open stage.
+        **fields: Extra fields to record, such as the file type
+
+    Yields:
+        Span: The open span
+    """
+    run_log = _active_log
+    cur_span = Span(name, kind)
+    if run_log is not None:
+        # worker threads read the open stages while they change
+        with run_log._lock:
+            if stage is None and run_log._stages:
+                stage = run_log._stages[-1].name
+            if kind == "stage":
+                run_log._stages.append(cur_span)
+    spans = _get_thread_spans()
+    spans.append(cur_span)
+    try:
+        yield cur_span
+    finally:
+        spans.pop()
+        if run_log is not None:
+            if kind == "stage":
+                with run_log._lock:
+                    run_log._stages.remove(cur_span)
+            run_log.write({
+                "type": "span",
+                "kind": kind,
+                "name": name,
+                "stage": stage,
+                "start": cur_span.start_time,
+                "seconds": round(time.time() - cur_span.start_time, 4),
+                "thread": get_ident(),
+                **fields,
+                "counters": cur_span.get_counters(),
+            })
+
+
+def count(counter, amount=1):
+    """Add to a counter of the innermost span open on this thread, or the current stage
+
+    Args:
+        counter (str): Name of the counter, such as "bytes" or "api_calls"
+        amount (int, optional): Amount to add. Defaults to 1.
+    """
+    spans = _get_thread_spans()
+    if spans:
+        spans[-1].count(counter, amount)
+        return
+    # worker threads outside a file span count toward the current stage
+    run_log = _active_log
+    if run_log is not None:
+        with run_log._lock:
+            if run_log._stages:
+                run_log._stages[-1].count(counter, amount)
+
+
+def log_error(msg, identifier, exception):
+    """Record an error in the run log and count it on the innermost span
+
+    Args:
+        msg (str): Description of what failed
+        identifier (str): File ID, URL or path that failed
+        exception (Exception): Exception raised
+    """
+    count("errors")
+    if _active_log is not None:
+        spans = _get_thread_spans()
+        _active_log.write({
+            "type": "error",
+            "time": time.time(),
+            "message": msg,
+            "identifier": identifier,
+            "exception": type(exception).__name__ + ": " + str(exception),
+            "span": spans[-1].name if spans else None,
+        })
+
+
+def _get_thread_spans():
+    if not hasattr(_thread_spans, "spans"):
+        _thread_spans.spans = []
+    return _thread_spans.spans
+
+
+def summarize_run_log(log_path, top=10):
+    """Summarize a run log with the time of each stage and the slowest files
+
+    Args:
+        log_path (str): Path of the JSONL log
+        top (int, optional): Number of slowest files to list. Defaults to 10.
+
+    Returns:
+        str: Report of the run
+    """
+    stages = []
+    files = []
+    errors = []
+    run_seconds = None
+    with open(log_path, encoding="utf-8") as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry["type"] == "span":
+                (stages if entry["kind"] == "stage" else files).append(entry)
+            elif entry["type"] == "error":
+                errors.append(entry)
+            elif entry["type"] == "run_end":
+                run_seconds = entry["seconds"]
+    # totals of each stage over its spans and the files in it
+    stage_seconds = {}
+    stage_totals = {}
+    for stage in stages:
+        stage_seconds[stage["name"]] = stage_seconds.get(stage["name"], 0) + stage["seconds"]
+        totals = stage_totals.setdefault(stage["name"], {})
+        for counter, amount in stage["counters"].items():
+            totals[counter] = totals.get(counter, 0) + amount
+    for file_span in files:
+        totals = stage_totals.setdefault(file_span["stage"], {})
+        totals["files"] = totals.get("files", 0) + 1
+        for counter, amount in file_span["counters"].items():
+            totals[counter] = totals.get(counter, 0) + amount
+    lines = ["Run log: " + log_path]
+    if run_seconds is not None:
+        lines += ["Total: {:.2f} s".format(run_seconds)]
+    lines += ["", "Stages by time:"]
+    for name, seconds in sorted(stage_seconds.items(), key=lambda item: item[1], reverse=True):
+        lines += ["  {:<12} {:>9.2f} s  {}".format(name, seconds,
+                                                   format_counters(stage_totals[name]))]
+    lines += ["", "Slowest {} of {} files:".format(min(top, len(files)), len(files))]
+    for file_span in sorted(files, key=lambda file_span: file_span["seconds"],
+                            reverse=True)[:top]:
+        lines += ["  {:>9.2f} s  {:<10} {}  {}".format(
+            file_span["seconds"], str(file_span["stage"]), file_span["name"],
+            format_counters(file_span["counters"]))]
+    lines += ["", "Errors: {}".format(len(errors))]
+    for error in errors[:top]:
+        lines += ["  {} {}: {}".format(error["message"], error["identifier"],
+                                       error["exception"])]
+    return "\n".join(line.rstrip() for line in lines)
+
+
+def format_counters(counters):
+    """Format the nonzero counters of a span
+
+    Args:
+        counters (dict): Counter names mapped to amounts
+
+    Returns:
+        str: Counters as name=amount pairs
+    """
+    return " ".join("{}={}".format(counter, amount) for counter, amount in counters.items()
+                    if amount)
+
+
+def latest_run_log():
+    """Get the most recent run log
+
+    Returns:
+        str: Path of the newest log in LOGS_DIR or None if there are none
+    """
+    if not os.path.isdir(LOGS_DIR):
+        return None
+    log_paths = [os.path.join(LOGS_DIR, file_name) for file_name in os.listdir(LOGS_DIR)
+                 if file_name.startswith("run-") and file_name.endswith(".jsonl")]
+    return max(log_paths, default=None)
+
+
+if __name__ == "__main__":
+    # summarize the given log or the latest one
+    log_path = sys.argv[1] if len(sys.argv) > 1 else latest_run_log()
+    if log_path is None:
+        print("No run logs in " + LOGS_DIR)
+    else:
+        print(summarize_run_log(log_path))
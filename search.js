@@ -0,0 +1,69 @@
+// split text into terms the way the SQLite FTS5 unicode61 tokenizer does
+var searchTerms = function (query) {
+    return query.normalize("NFD").replace(/[\u0300-\u036f]/g, "").toLowerCase()
+        .split(/[^\p{L}\p{N}]+/u).filter(function (term) { return term.length > 0; });
+};
+
+// match search.get_shard_name
+var shardName = function (term) {
+    return term.slice(0, 2).replace(/[^a-z0-9]/g, "_");
+};
+
+var shardCache = {};
+var getShard = function (name) {
+    if (!(name in shardCache)) {
+        shardCache[name] = $.getJSON("search_index/" + name + ".json")
+            .then(null, function () { return $.Deferred().resolve({}); });
+    }
+    return shardCache[name];
+};
+
+var docsRequest = $.getJSON("search_index/docs.json").then(function (docs) {
+    // only offer search once the index has been published
+    $("#search-form").show();
+    return docs;
+});
+
+var searchGuides = function (query, callback) {
+    var terms = searchTerms(query);
+    if (terms.length === 0) {
+        callback([]);
+        return;
+    }
+    var requests = [docsRequest].concat(terms.map(function (term) {
+        return getShard(shardName(term));
+    }));
+    $.when.apply($, requests).done(function () {
+        var docs = arguments[0];
+        var shards = Array.prototype.slice.call(arguments, 1);
+        // only keep documents containing every term, ranked by total term count
+        var scores = null;
+        terms.forEach(function (term, i) {
+            var termScores = {};
+            (shards[i][term] || []).forEach(function (posting) {
+                if (scores === null || posting[0] in scores) {
+                    termScores[posting[0]] = (scores === null ? 0 : scores[posting[0]]) +
+                        posting[1];
+                }
+            });
+            scores = termScores;
+        });
+        var results = Object.keys(scores).sort(function (a, b) {
+            return scores[b] - scores[a];
+        }).slice(0, 50).map(function (doc) { return docs[doc]; });
+        callback(results);
+    });
+};
+
+$("#search-form").on("submit", function (event) {
+    event.preventDefault();
+    searchGuides($("#search-input").val(), function (results) {
+        var results_div = $("#search-results").empty();
+        if (results.length === 0) {
+            results_div.text("No guides found.");
+        }
+        results.forEach(function (result) {
+            results_div.append($("<a></a>").attr("href", result[1]).text(result[0]), "<br>");
+        });
+    });
+});
@@ -0,0 +1,216 @@
+from html.parser import HTMLParser
+from importlib.util import find_spec
+from multiprocessing import Pool
+import json
+import os
+import sqlite3
+import zipfile
+from xml.etree import ElementTree
+
+from cache import CACHE_DIR, JsonCache
+from dedup import hash_file
+from utils import print_exception
+
+
+SEARCH_DB_PATH = os.path.join(CACHE_DIR, "search.sqlite")
+# sharded static index the site queries client-side
+SEARCH_INDEX_DIR = "search_index"
+
+
+class TextExtractor(HTMLParser):
+    """Collect the visible text of an HTML document
+    """
+    def __init__(self):
+        super().__init__()
+        self.text_parts = []
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ["script", "style"]:
+            self._skip_depth += 1
+
+    def handle_endtag(self, tag):
+        if tag in ["script", "style"] and self._skip_depth > 0:
+            self._skip_depth -= 1
+
+    def handle_data(self, data):
+        if self._skip_depth == 0:
+            self.text_parts.append(data)
+
+
+def extract_text(file_path):
+    """Extract the searchable text of an archived guide
+
+    Args:
+        file_path (str): Path to an archived HTML, PDF or XLSX file
+
+    Returns:
+        str: Text of the guide or None if it couldn't be read
+    """
+    try:
+        ext = os.path.splitext(file_path)[1].lower()
+        if ext in [".html", ".htm"]:
+            with open(file_path, encoding="utf-8", errors="replace") as f:
+                extractor = TextExtractor()
+                extractor.feed(f.read())
+            return " ".join(extractor.text_parts)
+        if ext == ".pdf":
+            # only needed for PDFs, so guides stay searchable without it
+            from pypdf import PdfReader
+            return " ".join(page.extract_text() or "" for page in PdfReader(file_path).pages)
+        if ext == ".xlsx":
+            with zipfile.ZipFile(file_path, "r") as zip_f:
+                if "xl/sharedStrings.xml" not in zip_f.namelist():
+                    return ""
+                root = ElementTree.fromstring(zip_f.read("xl/sharedStrings.xml"))
+            return " ".join(node.text for node in root.iter() if node.tag.endswith("}t") and
+                            node.text)
+    except Exception as e:
+        print_exception("Exception for text extraction:", file_path, e)
+    return None
+
+
+def build_search_index(records, num_processes=None):
+    """Index the text of the archived guides, re-reading only files that changed
+
+    Args:
+        records (GuideRecords): Guide records with archive paths
+        num_processes (int, optional): Number of processes to extract text on.
+                                       Defaults to the number of CPUs.
+    """
+    # one document per archived file, labeled by the first link to it
+    doc_labels = {}
+    for record in records:
+        if record.archive_path is not None and os.path.exists(record.archive_path) and \
+           record.archive_path not in doc_labels:
+            doc_labels[record.archive_path] = (record.label.strip(), record.link_class)
+    hash_cache = JsonCache("content_hashes.json")
+    doc_hashes = {file_path: hash_file(file_path, hash_cache) for file_path in doc_labels}
+    hash_cache.save()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with sqlite3.connect(SEARCH_DB_PATH) as db:
+        db.execute("CREATE TABLE IF NOT EXISTS docs "
+                   "(path TEXT PRIMARY KEY, sha256 TEXT, label TEXT, link_class TEXT)")
+        db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5(path UNINDEXED, body)")
+        indexed_hashes = {}
+        indexed_labels = {}
+        for file_path, digest, label in db.execute("SELECT path, sha256, label FROM docs"):
+            indexed_hashes[file_path] = digest
+            indexed_labels[file_path] = label
+        # drop documents that are gone or changed, and those whose label changed,
+        # since the label is indexed with the text
+        stale_paths = [file_path for file_path, digest in indexed_hashes.items()
+                       if doc_hashes.get(file_path) != digest or
+                       indexed_labels[file_path] != doc_labels[file_path][0]]
+        for file_path in stale_paths:
+            db.execute("DELETE FROM docs WHERE path = ?", (file_path,))
+            db.execute("DELETE FROM docs_fts WHERE path = ?", (file_path,))
+            del indexed_hashes[file_path]
+        # extract text of new and changed documents in parallel
+        pending_paths = [file_path for file_path in doc_labels
+                         if indexed_hashes.get(file_path) != doc_hashes[file_path]]
+        if find_spec("pypdf") is None:
+            print("pypdf is not installed, so PDFs won't be indexed\n")
+            pending_paths = [file_path for file_path in pending_paths
+                             if not file_path.lower().endswith(".pdf")]
+        # warm runs usually have nothing to extract, so don't start processes for them
+        if pending_paths:
+            with Pool(num_processes) as process_pool:
+                texts = process_pool.imap(extract_text, pending_paths)
+                for file_path, text in zip(pending_paths, texts):
+                    if text is None:
+                        continue
+                    label, link_class = doc_labels[file_path]
+                    db.execute("INSERT INTO docs VALUES (?, ?, ?, ?)",
+                               (file_path, doc_hashes[file_path], label, link_class))
+                    db.execute("INSERT INTO docs_fts VALUES (?, ?)",
+                               (file_path, label + " " + text))
+        # classes can change without the file changing
+        db.executemany("UPDATE docs SET link_class = ? WHERE path = ?",
+                       [(link_class, file_path)
+                        for file_path, (_, link_class) in doc_labels.items()])
+
+
+def search(query, limit=20):
+    """Search the indexed guides
+
+    Args:
+        query (str): FTS5 query, such as words to match
+        limit (int, optional): Maximum number of results. Defaults to 20.
+
+    Returns:
+        list: (label, path, snippet) of the best matches
+    """
+    with sqlite3.connect(SEARCH_DB_PATH) as db:
+        return db.execute("SELECT docs.label, docs.path, "
+                          "snippet(docs_fts, 1, '[', ']', '...', 12) "
+                          "FROM docs_fts JOIN docs ON docs.path = docs_fts.path "
+                          "WHERE docs_fts MATCH ? ORDER BY bm25(docs_fts) LIMIT ?",
+                          (query, limit)).fetchall()
+
+
+def export_search_index():
+    """Write the index as static shards of terms sharing a two character prefix
+
+    search_index/docs.json lists [label, path] for each document, and each
+    shard maps its terms to [document number, count] postings, so the site
+    only fetches the shards for the words being searched.
+    """
+    os.makedirs(SEARCH_INDEX_DIR, exist_ok=True)
+    for file_name in os.listdir(SEARCH_INDEX_DIR):
+        os.remove(os.path.join(SEARCH_INDEX_DIR, file_name))
+    with sqlite3.connect(SEARCH_DB_PATH) as db:
+        db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS docs_vocab "
+                   "USING fts5vocab(docs_fts, instance)")
+        docs = db.execute("SELECT docs_fts.rowid, docs.label, docs.path FROM docs_fts "
+                          "JOIN docs ON docs.path = docs_fts.path ORDER BY docs_fts.rowid")
+        doc_nums = {}
+        doc_list = []
+        for rowid, label, file_path in docs:
+            doc_nums[rowid] = len(doc_list)
+            doc_list += [[label, file_path.replace("\\", "/")]]
+        with open(os.path.join(SEARCH_INDEX_DIR, "docs.json"), "w", encoding="utf-8") as f:
+            json.dump(doc_list, f, ensure_ascii=False, separators=(",", ":"))
+        # terms come out sorted, so each shard is written once it is complete
+        shard_name = None
+        shard = {}
+        postings = db.execute("SELECT term, doc, COUNT(*) FROM docs_vocab "
+                              "GROUP BY term, doc ORDER BY term, doc")
+        for term, rowid, count in postings:
+            if get_shard_name(term) != shard_name:
+                write_shard(shard_name, shard)
+                shard_name = get_shard_name(term)
+                shard = {}
+            shard.setdefault(term, []).append([doc_nums[rowid], count])
+        write_shard(shard_name, shard)
+
+
+def get_shard_name(term):
+    """Get the name of the shard holding a term, matching search.js
+
+    Args:
+        term (str): Indexed term
+
+    Returns:
+        str: Shard name
+    """
+    return "".join(char if "a" <= char <= "z" or "0" <= char <= "9" else "_"
+                   for char in term[:2])
+
+
+def write_shard(shard_name, shard):
+    """Write a shard of the static index, merging with terms already written to it
+
+    Args:
+        shard_name (str): Shard name or None for no shard
+        shard (dict): Terms mapped to their postings
+    """
+    if shard_name is None:
+        return
+    shard_path = os.path.join(SEARCH_INDEX_DIR, shard_name + ".json")
+    # non-alphanumeric characters share a shard name, so a shard can be reached twice
+    if os.path.exists(shard_path):
+        with open(shard_path, encoding="utf-8") as f:
+            shard = {**json.load(f), **shard}
+    with open(shard_path, "w", encoding="utf-8") as f:
+        json.dump(shard, f, ensure_ascii=False, separators=(",", ":"))
@@ -1,15 +1,31 @@
 from urllib.parse import urljoin
 
-from bs4 import BeautifulSoup
+from runlog import span
+
+
+SITE_URL = "https://feeneygames.github.io/PFGuideArchive/"
 
 
 def update_sitemap():
-    site_url = "https://feeneygames.github.io/PFGuideArchive/"
-    with open("archive_links.html", encoding="utf8") as f:
-        soup = BeautifulSoup(f, "html.parser")
-    with open("sitemap.txt", "w", encoding="utf8") as f:
-        f.write(site_url + "\n")
-        for tag in soup.find_all("a"):
-            url = tag["href"].replace("\\", "/")
-            url = urljoin(site_url, url)
-            f.write(url + "\n")
+    # imported here so exporting the archive doesn't load bs4
+    from bs4 import BeautifulSoup
+
+    with span("sitemap"):
+        with open("archive_links.html", encoding="utf8") as f:
+            soup = BeautifulSoup(f, "html.parser")
+        with open("sitemap.txt", "w", encoding="utf8") as f:
+            f.write(SITE_URL + "\n")
+            for tag in soup.find_all("a"):
+                f.write(get_page_url(tag["href"]) + "\n")
+
+
+def get_page_url(archive_path):
+    """Get the site URL of an archived file
+
+    Args:
+        archive_path (str): Path to the archived file
+
+    Returns:
+        str: URL of the file on the site
+    """
+    return urljoin(SITE_URL, archive_path.replace("\\", "/"))
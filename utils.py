@@ -1,12 +1,224 @@
-from threading import Lock
+from contextlib import contextmanager
+from http.client import HTTPException
+import random
+import socket
+from threading import Condition, Lock
+import time
+from urllib.error import HTTPError, URLError
 
+from runlog import count, log_error
 
-# print exceptions nicely and thread safe
+
+# HTTP statuses worth retrying, besides quota errors
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+# reasons Drive gives for 403 responses that mean slow down rather than forbidden
+RATE_LIMIT_REASONS = [b"rateLimitExceeded", b"userRateLimitExceeded"]
+
+
+# print exceptions nicely and thread safe, recording them in the run log
 def print_exception(msg, identifier, exception):
+    log_error(msg, identifier, exception)
     with _print_exception_lock:
         print(msg + "\n" + identifier)
         print(exception)
         print()
 
 
+class ByteBudget():
+    """Limit the number of bytes in flight across threads
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self._cond = Condition()
+
+    @contextmanager
+    def reserve(self, num_bytes):
+        """Block until the bytes fit in the budget and hold them until exit
+
+        Args:
+            num_bytes (int): Number of bytes to reserve
+        """
+        # clamp so a file larger than the whole budget can still run on its own
+        num_bytes = min(num_bytes, self.max_bytes)
+        with self._cond:
+            while self.in_flight + num_bytes > self.max_bytes:
+                self._cond.wait()
+            self.in_flight += num_bytes
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_flight -= num_bytes
+                self._cond.notify_all()
+
+
+class RateLimiter():
+    """Token bucket shared across threads that slows down when throttled
+
+    Each call takes a token, and tokens refill at the current rate. The rate
+    halves whenever the server throttles a call and climbs back toward the
+    maximum as calls succeed.
+    """
+    def __init__(self, max_rate, burst=None, min_rate=0.5):
+        """
+        Args:
+            max_rate (float): Calls per second when nothing is throttled, or None for no limit
+            burst (int, optional): Calls that can be made at once after idling.
+                                   Defaults to max_rate.
+            min_rate (float, optional): Calls per second the rate never drops below.
+                                        Defaults to 0.5.
+        """
+        self.max_rate = max_rate
+        self.min_rate = min_rate if max_rate is None else min(min_rate, max_rate)
+        self.rate = max_rate
+        self.burst = burst if burst is not None else max(1, int(max_rate or 1))
+        self.tokens = self.burst
+        self._last_refill = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self, num_tokens=1):
+        """Block until the tokens are available and take them
+
+        Args:
+            num_tokens (int, optional): Number of calls about to be made. Defaults to 1.
+        """
+        if self.max_rate is None:
+            return
+        # clamp so a batch larger than the burst can still run on its own
+        num_tokens = min(num_tokens, self.burst)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self._last_refill) * self.rate)
+                self._last_refill = now
+                if self.tokens >= num_tokens:
+                    self.tokens -= num_tokens
+                    return
+                wait = (num_tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        """Halve the rate after the server asked to slow down
+        """
+        if self.max_rate is None:
+            return
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        """Raise the rate a step toward the maximum after a successful call
+        """
+        if self.max_rate is None:
+            return
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def call(self, function, *args, num_tokens=1, max_retries=5, base_delay=1.0,
+             max_delay=64.0, **kwargs):
+        """Call a function within the rate, retrying transient errors with backoff
+
+        Retries wait exponentially longer with full jitter, or as long as the
+        server asks with Retry-After. Errors that aren't transient, such as a
+        missing file, are raised right away.
+
+        Args:
+            function (function): Function making the request
+            *args: Arguments for the function
+            num_tokens (int, optional): Number of calls the function makes. Defaults to 1.
+            max_retries (int, optional): Retries before the error is raised. Defaults to 5.
+            base_delay (float, optional): Longest wait in seconds before the first retry.
+                                          Defaults to 1.0.
+            max_delay (float, optional): Longest wait in seconds before any retry.
+                                         Defaults to 64.0.
+            **kwargs: Keyword arguments for the function
+
+        Returns:
+            Result of the function
+        """
+        for attempt in range(max_retries + 1):
+            self.acquire(num_tokens)
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                if attempt == max_retries or not is_transient_error(e):
+                    raise
+                if is_rate_limit_error(e):
+                    self.throttled()
+                count("retries")
+                delay = get_retry_after(e)
+                if delay is None:
+                    delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+                time.sleep(min(delay, max_delay))
+            else:
+                self.succeeded()
+                return result
+
+
+def get_status(exception):
+    """Get the HTTP status of a failed request
+
+    Args:
+        exception (Exception): Exception raised by urllib or the Google API client
+
+    Returns:
+        int: HTTP status or None if the request got no response
+    """
+    if isinstance(exception, HTTPError):
+        return exception.code
+    # googleapiclient.errors.HttpError keeps the httplib2 response
+    resp = getattr(exception, "resp", None)
+    return getattr(resp, "status", None)
+
+
+def is_rate_limit_error(exception):
+    """Check if a request failed because it went over a rate limit or quota
+
+    Args:
+        exception (Exception): Exception raised by the request
+
+    Returns:
+        bool: Whether the request should be retried more slowly
+    """
+    status = get_status(exception)
+    if status == 429:
+        return True
+    content = getattr(exception, "content", None) or b""
+    return status == 403 and any(reason in content for reason in RATE_LIMIT_REASONS)
+
+
+def is_transient_error(exception):
+    """Check if a request failed in a way that retrying could fix
+
+    Args:
+        exception (Exception): Exception raised by the request
+
+    Returns:
+        bool: Whether the request should be retried
+    """
+    status = get_status(exception)
+    if status is not None:
+        return status in RETRY_STATUSES or is_rate_limit_error(exception)
+    return isinstance(exception, (ConnectionError, TimeoutError, socket.timeout, HTTPException,
+                                  URLError))
+
+
+def get_retry_after(exception):
+    """Get the seconds a server asked to wait before retrying
+
+    Args:
+        exception (Exception): Exception raised by the request
+
+    Returns:
+        float: Seconds to wait or None if the server didn't say
+    """
+    headers = getattr(exception, "headers", None) or getattr(exception, "resp", None)
+    if headers is None:
+        return None
+    try:
+        return float(headers.get("Retry-After") or headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
 _print_exception_lock = Lock()
\ No newline at end of file
@@ -0,0 +1,355 @@
+import hashlib
+import html
+import json
+import mmap
+from multiprocessing.dummy import Pool
+import os
+import re
+import sys
+import zipfile
+
+from cache import CACHE_DIR, clear_written_paths, JsonCache
+from dedup import ARCHIVE_DIR, extracted_folders, get_blob_path, hash_file, STORE_DIR, \
+    verify_extraction
+from extract import EXTRACTION_MARKER, is_archived, read_marker
+from html_export import ARCHIVE_LINKS_PATH, SITEMAP_TXT_PATH
+from manifest import ArchiveManifest, MANIFEST_PATH
+from runlog import span
+from sitemap import SITE_URL
+from utils import print_exception
+from versions import VERSIONS_DIR
+
+
+# sizes and hashes of every archived file, recorded after each run
+CHECKSUMS_PATH = os.path.join(ARCHIVE_DIR, "checksums.json")
+# files at least this large are hashed through a memory map instead of buffered reads
+MMAP_THRESHOLD = 4 * 1024 ** 2
+HREF_PATTERN = re.compile(r"href=\"([^\"]*)\"")
+
+
+def verify_archive(num_threads=None):
+    """Check the archive for missing, corrupt and orphaned files
+
+    Every file is hashed in parallel and compared to the recorded checksums
+    and the Drive md5 of downloaded PDFs. Zips are checked against their
+    extracted folders, and every link in archive_links.html and entry in
+    sitemap.txt must point at a file in the archive.
+
+    Args:
+        num_threads (int, optional): Number of threads to hash files on. Defaults to the
+                                     number of CPUs.
+
+    Returns:
+        dict: "missing", "corrupt" and "orphaned" lists of [path, reason]
+    """
+    report = {"missing": [], "corrupt": [], "orphaned": []}
+    with span("verify"):
+        file_paths = archive_files()
+        manifest = ArchiveManifest()
+        # Drive only reports checksums for stored files, such as PDFs
+        drive_md5s = {os.path.normpath(entry["path"]): entry["md5Checksum"]
+                      for entry in manifest.entries.values() if entry.get("md5Checksum")}
+        # hashlib releases the GIL, so threads hash files on every core
+        thread_pool = Pool(num_threads or os.cpu_count())
+        hashes = thread_pool.map(lambda file_path: hash_archive_file(
+            file_path, with_md5=file_path in drive_md5s), file_paths)
+        file_hashes = dict(zip(file_paths, hashes))
+        check_checksums(file_hashes, report)
+        check_downloads(manifest, file_hashes, drive_md5s, report)
+        for folder_report in thread_pool.map(check_extraction, extracted_folders()):
+            for category, problems in folder_report.items():
+                report[category] += problems
+        # close threads, but don't bother waiting for them to free resources
+        thread_pool.close()
+        linked_paths = check_links(report)
+        check_orphans(file_paths, linked_paths, report)
+    return report
+
+
+def check_checksums(file_hashes, report):
+    """Compare the archive to the recorded checksums
+
+    Args:
+        file_hashes (dict): Paths mapped to (size, SHA-256, MD5) of the files
+        report (dict): Report to add problems to
+    """
+    if not os.path.exists(CHECKSUMS_PATH):
+        print("No recorded checksums to compare against\n")
+        return
+    with open(CHECKSUMS_PATH, encoding="utf-8") as f:
+        checksums = json.load(f)
+    for rel_path, (file_size, digest) in checksums.items():
+        file_path = os.path.join(ARCHIVE_DIR, os.path.normpath(rel_path))
+        if file_path not in file_hashes:
+            report["missing"] += [[file_path, "recorded in " + CHECKSUMS_PATH]]
+        elif file_hashes[file_path] is None:
+            report["corrupt"] += [[file_path, "unreadable"]]
+        elif file_hashes[file_path][0] != file_size:
+            report["corrupt"] += [[file_path, "size {} instead of {}".format(
+                file_hashes[file_path][0], file_size)]]
+        elif file_hashes[file_path][1] != digest:
+            report["corrupt"] += [[file_path, "SHA-256 doesn't match " + CHECKSUMS_PATH]]
+
+
+def check_downloads(manifest, file_hashes, drive_md5s, report):
+    """Check that downloaded files exist and were fully written
+
+    Args:
+        manifest (ArchiveManifest): Manifest of the downloaded files
+        file_hashes (dict): Paths mapped to (size, SHA-256, MD5) of the files
+        drive_md5s (dict): Paths mapped to the MD5 Drive reported for them
+        report (dict): Report to add problems to
+    """
+    for entry in manifest.entries.values():
+        file_path = os.path.normpath(entry["path"])
+        if not is_archived(file_path):
+            report["missing"] += [[file_path, "downloaded in " + MANIFEST_PATH]]
+        elif file_path in drive_md5s and file_hashes.get(file_path) is not None and \
+                file_hashes[file_path][2] != drive_md5s[file_path]:
+            report["corrupt"] += [[file_path, "MD5 doesn't match Drive"]]
+        elif file_path in file_hashes and file_path[-5:] == ".xlsx":
+            # exports have no Drive checksum, but a truncated zip fails its CRCs
+            try:
+                with zipfile.ZipFile(file_path, "r") as zip_f:
+                    bad_name = zip_f.testzip()
+                if bad_name is not None:
+                    report["corrupt"] += [[file_path, "bad CRC for " + bad_name]]
+            except zipfile.BadZipFile as e:
+                report["corrupt"] += [[file_path, str(e)]]
+
+
+def check_extraction(folder_path):
+    """Check that an extracted folder matches its zip, or its marker once the zip is removed
+
+    Args:
+        folder_path (str): Path to the extracted folder
+
+    Returns:
+        dict: "missing" and "corrupt" lists of [path, reason]
+    """
+    folder_report = {"missing": [], "corrupt": []}
+    zip_path = folder_path + ".zip"
+    if os.path.exists(zip_path):
+        try:
+            if not verify_extraction(zip_path):
+                folder_report["corrupt"] += [[folder_path, "doesn't match " + zip_path]]
+        except zipfile.BadZipFile as e:
+            folder_report["corrupt"] += [[zip_path, str(e)]]
+        return folder_report
+    marker = read_marker(folder_path)
+    moved = marker.get("moved", {})
+    for file_name in marker["entries"]:
+        if file_name.endswith("/"):
+            continue
+        file_path = moved.get(file_name, os.path.join(folder_path, file_name))
+        if not os.path.exists(file_path):
+            folder_report["missing"] += [[os.path.normpath(file_path),
+                                          "extracted from " + zip_path]]
+    return folder_report
+
+
+def check_links(report):
+    """Check that every link and sitemap entry points at an archived file
+
+    Args:
+        report (dict): Report to add problems to
+
+    Returns:
+        set: Normalized paths of the linked files
+    """
+    linked_paths = set()
+    if os.path.exists(ARCHIVE_LINKS_PATH):
+        with open(ARCHIVE_LINKS_PATH, encoding="utf-8") as f:
+            for href in HREF_PATTERN.findall(f.read()):
+                linked_paths.add(normalize_link(html.unescape(href)))
+        for file_path in sorted(linked_paths):
+            if not os.path.isfile(file_path):
+                report["missing"] += [[file_path, "linked from " + ARCHIVE_LINKS_PATH]]
+    if os.path.exists(SITEMAP_TXT_PATH):
+        sitemap_paths = set()
+        with open(SITEMAP_TXT_PATH, encoding="utf8") as f:
+            for line in f:
+                url = line.rstrip("\n")
+                if url.startswith(SITE_URL) and url != SITE_URL:
+                    sitemap_paths.add(normalize_link(url[len(SITE_URL):]))
+        for file_path in sorted(sitemap_paths - linked_paths):
+            if not os.path.isfile(file_path):
+                report["missing"] += [[file_path, "listed in " + SITEMAP_TXT_PATH]]
+        for file_path in sorted(linked_paths - sitemap_paths):
+            report["missing"] += [[file_path, "linked but not listed in " + SITEMAP_TXT_PATH]]
+        linked_paths |= sitemap_paths
+    return linked_paths
+
+
+def check_orphans(file_paths, linked_paths, report):
+    """Find files in the archive that nothing links to or depends on
+
+    Args:
+        file_paths (list): Paths of every file in the archive
+        linked_paths (set): Normalized paths of the linked files
+        report (dict): Report to add problems to
+    """
+    # a linked file keeps its whole top-level folder, and that folder's zip
+    used_roots = set()
+    for file_path in linked_paths:
+        parts = file_path.split(os.sep)
+        if len(parts) > 1 and parts[0] == ARCHIVE_DIR:
+            used_roots.add(parts[1])
+            used_roots.add(parts[1] + ".zip")
+    # stored copies are used by extracted folders and saved web pages
+    used_blobs = set()
+    for folder_path in extracted_folders():
+        used_blobs.update(os.path.normpath(blob_path)
+                          for blob_path in read_marker(folder_path).get("moved", {}).values())
+    if os.path.exists(os.path.join(CACHE_DIR, "web_validators.json")):
+        used_blobs.update(os.path.normpath(entry["value"]["path"])
+                          for entry in JsonCache("web_validators.json").entries.values())
+    # optimized images are kept to reuse for identical images
+    for entry in JsonCache("optimized_images.json").entries.values():
+        optimized_digest, ext = entry["value"]
+        if optimized_digest is not None:
+            used_blobs.add(get_blob_path(optimized_digest, ext))
+    for file_path in file_paths:
+        parts = file_path.split(os.sep)
+        if file_path.endswith(".part") or file_path.endswith(".tmp"):
+            report["orphaned"] += [[file_path, "partial write"]]
+        elif file_path.startswith(VERSIONS_DIR + os.sep):
+            # history of updated files is only read by versions.py
+            continue
+        elif file_path.startswith(STORE_DIR + os.sep):
+            if file_path not in used_blobs:
+                report["orphaned"] += [[file_path, "stored copy nothing uses"]]
+        elif parts[1] not in used_roots and parts[1] != "websites":
+            report["orphaned"] += [[file_path, "not linked from " + ARCHIVE_LINKS_PATH]]
+
+
+def record_checksums(file_paths=None, num_threads=None):
+    """Record the size and SHA-256 of archived files for later verification
+
+    Only the given files are recorded again, so checksums of files a run
+    didn't write are kept as they were and a file changed outside the
+    pipeline is still reported by verify_archive. Given files that no longer
+    exist are dropped. Every file is recorded when no files are given or
+    nothing was recorded yet.
+
+    Args:
+        file_paths (iterable, optional): Paths of the files written or removed. Defaults to
+                                         None for every archived file.
+        num_threads (int, optional): Number of threads to hash files on. Defaults to the
+                                     number of CPUs.
+    """
+    if file_paths is None or not os.path.exists(CHECKSUMS_PATH):
+        checksums = {}
+        file_paths = archive_files()
+    else:
+        with open(CHECKSUMS_PATH, encoding="utf-8") as f:
+            checksums = json.load(f)
+        skipped_paths = {os.path.normpath(MANIFEST_PATH), CHECKSUMS_PATH}
+        file_paths = {os.path.normpath(file_path) for file_path in file_paths}
+        file_paths = [file_path for file_path in file_paths
+                      if file_path.startswith(ARCHIVE_DIR + os.sep) and
+                      file_path not in skipped_paths and
+                      os.path.basename(file_path) != EXTRACTION_MARKER]
+        if not file_paths:
+            return
+    file_paths = [file_path for file_path in file_paths
+                  if not file_path.endswith(".part") and not file_path.endswith(".tmp")]
+    for file_path in file_paths:
+        if not os.path.isfile(file_path):
+            checksums.pop(os.path.relpath(file_path, ARCHIVE_DIR).replace("\\", "/"), None)
+    file_paths = [file_path for file_path in file_paths if os.path.isfile(file_path)]
+    hash_cache = JsonCache("content_hashes.json")
+    thread_pool = Pool(num_threads or os.cpu_count())
+    digests = thread_pool.map(lambda file_path: hash_file(file_path, hash_cache), file_paths)
+    thread_pool.close()
+    hash_cache.save()
+    checksums.update({os.path.relpath(file_path, ARCHIVE_DIR).replace("\\", "/"):
+                      [os.path.getsize(file_path), digest]
+                      for file_path, digest in zip(file_paths, digests)})
+    tmp_path = CHECKSUMS_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(checksums, f, indent=0, sort_keys=True, ensure_ascii=False)
+    os.replace(tmp_path, CHECKSUMS_PATH)
+
+
+def archive_files():
+    """Get every archived file, leaving out the files describing the archive
+
+    Returns:
+        list: Normalized paths of the files
+    """
+    skipped_paths = {os.path.normpath(MANIFEST_PATH), CHECKSUMS_PATH}
+    file_paths = []
+    for dir_path, dir_names, file_names in os.walk(ARCHIVE_DIR):
+        for file_name in file_names:
+            file_path = os.path.normpath(os.path.join(dir_path, file_name))
+            if file_name != EXTRACTION_MARKER and file_path not in skipped_paths:
+                file_paths += [file_path]
+    return file_paths
+
+
+def hash_archive_file(file_path, with_md5=False):
+    """Hash a file, memory mapping large files so they are hashed without copies
+
+    Args:
+        file_path (str): Path to the file
+        with_md5 (bool, optional): Whether to also compute the MD5. Defaults to False.
+
+    Returns:
+        (int, str, str): Size, SHA-256 and MD5 or None of the file,
+                         or None if it couldn't be read
+    """
+    try:
+        sha = hashlib.sha256()
+        md5 = hashlib.md5() if with_md5 else None
+        with open(file_path, "rb") as f:
+            file_size = os.fstat(f.fileno()).st_size
+            if file_size >= MMAP_THRESHOLD:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    sha.update(mapped)
+                    if md5 is not None:
+                        md5.update(mapped)
+            else:
+                data = f.read()
+                sha.update(data)
+                if md5 is not None:
+                    md5.update(data)
+        return file_size, sha.hexdigest(), md5.hexdigest() if md5 is not None else None
+    except OSError as e:
+        print_exception("Exception for hashing:", file_path, e)
+        return None
+
+
+def normalize_link(link):
+    """Map a link relative to the site root to a path
+
+    Args:
+        link (str): Link written with either kind of slash
+
+    Returns:
+        str: Normalized path
+    """
+    return os.path.normpath(link.replace("\\", "/"))
+
+
+def print_report(report):
+    """Print the problems found by verify_archive
+
+    Args:
+        report (dict): "missing", "corrupt" and "orphaned" lists of [path, reason]
+    """
+    for category, problems in report.items():
+        print("{} {}:".format(len(problems), category))
+        for file_path, reason in problems:
+            print("  {} ({})".format(file_path, reason))
+
+
+if __name__ == "__main__":
+    # python verify.py [--record] checks the archive, or records its checksums
+    if "--record" in sys.argv[1:]:
+        record_checksums()
+        clear_written_paths()
+    else:
+        report = verify_archive()
+        print_report(report)
+        sys.exit(1 if any(report.values()) else 0)
@@ -0,0 +1,527 @@
+from contextlib import contextmanager
+import difflib
+from datetime import datetime, timezone
+import hashlib
+import io
+import json
+import lzma
+import mmap
+import os
+import re
+import struct
+import sys
+from threading import Lock
+import zipfile
+
+from cache import note_written
+from dedup import ARCHIVE_DIR, hash_file, link_or_copy
+from extract import read_marker
+from runlog import count
+from search import TextExtractor
+from utils import print_exception
+
+
+# earlier revisions of each file ID, stored as deltas against the next newer revision
+VERSIONS_DIR = os.path.join(ARCHIVE_DIR, ".versions")
+# every this many stored revisions is kept whole, bounding the deltas applied to rebuild one
+KEYFRAME_INTERVAL = 8
+# content-defined blocks end after a newline or the end of a tag, so an edit only
+# changes the blocks around it
+BLOCK_END = re.compile(rb"[\n>]")
+# blocks shorter than this are cheaper to store than to point at
+MIN_MATCH = 8
+DELTA_MAGIC = b"PFD1"
+COPY_OP = b"C"
+LITERAL_OP = b"L"
+# lines of the text diff kept in each report
+MAX_DIFF_LINES = 2000
+# bytes read at a time when compressing a whole revision
+CHUNK_SIZE = 1024 * 1024
+
+
+class VersionStore():
+    """History of the revisions of each archived Drive file
+
+    The current revision is the file in the archive. When an update replaces
+    it, the old revision is stored as a reverse delta against the new one,
+    compressed with LZMA. Rebuilding a revision applies the deltas from the
+    current file back to it, and every KEYFRAME_INTERVAL-th revision is
+    stored whole so that chain stays short. The text diff of an update is
+    only worked out when it is asked for.
+    """
+    def __init__(self, versions_dir=VERSIONS_DIR):
+        self.versions_dir = versions_dir
+        self._lock = Lock()
+
+    @contextmanager
+    def updating(self, file_id, file_path, old_entry):
+        """Keep the archived revision of a file while the block replaces it
+
+        The archived revision is read from the path the manifest recorded,
+        which differs from file_path when a name collision moved the file. A zip
+        removed once extracted is rebuilt from its extracted folder. The revision
+        is stored after the block, so anything held only for the download should
+        be released inside it.
+
+        Args:
+            file_id (str): ID for the Google Doc
+            file_path (str): Archive path of the file
+            old_entry (dict): Manifest entry of the archived revision or None
+        """
+        if old_entry is None:
+            yield
+            return
+        # the copy is kept beside the folders of the files, so a file that turns out
+        # unchanged gets no folder
+        os.makedirs(self.versions_dir, exist_ok=True)
+        old_path = os.path.join(self.versions_dir, file_id + ".previous.tmp")
+        if os.path.exists(old_path):
+            os.remove(old_path)
+        try:
+            kept = copy_revision(old_entry["path"], old_path)
+        except Exception as e:
+            print_exception("Exception for earlier revision of:", old_entry["path"], e)
+            kept = False
+        if not kept:
+            print("Earlier revision of {} wasn't kept, since its archived copy is gone\n".format(
+                old_entry["path"]))
+            count("revisions_lost")
+            yield
+            return
+        try:
+            yield
+            if os.path.exists(file_path):
+                self.add_revision(file_id, old_path, file_path, old_entry)
+        finally:
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+    def add_revision(self, file_id, old_path, new_path, old_entry):
+        """Store an earlier revision as a delta against the revision that replaced it
+
+        Args:
+            file_id (str): ID for the Google Doc
+            old_path (str): Path to a copy of the earlier revision
+            new_path (str): Path to the new revision
+            old_entry (dict): Manifest entry of the earlier revision
+
+        Returns:
+            dict: History entry of the stored revision or None if the file didn't change
+        """
+        new_hash = hash_file(new_path)
+        old_hash = hash_file(old_path)
+        if old_hash == new_hash:
+            return None
+        file_dir = os.path.join(self.versions_dir, file_id)
+        os.makedirs(file_dir, exist_ok=True)
+        with self._lock:
+            history = self.read_history(file_id)
+            revision = len(history)
+            # the newest stored revision was a delta against the file just replaced
+            if history and history[-1]["base"] != old_hash:
+                print("Archived file changed outside of updates, so earlier revisions can't "
+                      "be rebuilt:\n" + new_path + "\n")
+            is_keyframe = revision % KEYFRAME_INTERVAL == KEYFRAME_INTERVAL - 1
+            stored_name = "{}.{}.xz".format(revision, "full" if is_keyframe else "delta")
+            stored_path = os.path.join(file_dir, stored_name)
+            # both revisions are streamed or mapped, so large files aren't read into memory
+            if is_keyframe:
+                with open(old_path, "rb") as f:
+                    stored_size = write_compressed(stored_path,
+                                                   iter(lambda: f.read(CHUNK_SIZE), b""))
+            else:
+                with map_file(new_path) as new_data, map_file(old_path) as old_data:
+                    stored_size = write_compressed(stored_path, make_delta(new_data, old_data))
+            entry = {
+                "revision": revision,
+                "archived": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                "version": old_entry.get("version"),
+                "modifiedTime": old_entry.get("modifiedTime"),
+                "download_type": old_entry.get("download_type"),
+                "path": old_entry["path"],
+                "sha256": old_hash,
+                "size": os.path.getsize(old_path),
+                "stored": stored_name,
+                "stored_size": stored_size,
+                # revision the delta is applied to, the one that replaced this one
+                "base": new_hash,
+            }
+            history.append(entry)
+            write_atomic(os.path.join(file_dir, "history.json"),
+                         json.dumps(history, indent=4, ensure_ascii=False).encode("utf-8"))
+        count("bytes", stored_size)
+        return entry
+
+    def read_history(self, file_id):
+        """Read the stored revisions of a file, oldest first
+
+        Args:
+            file_id (str): ID for the Google Doc
+
+        Returns:
+            list: History entries of the stored revisions
+        """
+        history_path = os.path.join(self.versions_dir, file_id, "history.json")
+        if not os.path.exists(history_path):
+            return []
+        with open(history_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def get_revision(self, file_id, revision, current_path):
+        """Rebuild the bytes of an earlier revision
+
+        Args:
+            file_id (str): ID for the Google Doc
+            revision (int): Number of the revision, 0 being the oldest stored
+            current_path (str): Archive path of the current revision
+
+        Returns:
+            bytes: Contents of the revision
+        """
+        history = self.read_history(file_id)
+        if not 0 <= revision < len(history):
+            raise ValueError("Unexpected revision:\n" + str(revision))
+        file_dir = os.path.join(self.versions_dir, file_id)
+        # find the nearest newer revision stored whole, or fall back to the current file
+        chain_end = revision
+        while chain_end < len(history) and not history[chain_end]["stored"].endswith(".full.xz"):
+            chain_end += 1
+        if chain_end < len(history):
+            with open(os.path.join(file_dir, history[chain_end]["stored"]), "rb") as f:
+                data = lzma.decompress(f.read())
+        else:
+            with open(current_path, "rb") as f:
+                data = f.read()
+            if hashlib.sha256(data).hexdigest() != history[-1]["base"]:
+                raise ValueError("Current file isn't the revision the history was built on:\n" +
+                                 current_path)
+        # apply the deltas from newer to older
+        for entry in reversed(history[revision:chain_end]):
+            with open(os.path.join(file_dir, entry["stored"]), "rb") as f:
+                data = apply_delta(data, lzma.decompress(f.read()))
+        if hashlib.sha256(data).hexdigest() != history[revision]["sha256"]:
+            raise ValueError("Rebuilt revision doesn't match its hash:\n" + str(revision))
+        return data
+
+    def diff_revision(self, file_id, revision, current_path):
+        """Diff the text of a revision and the one that replaced it
+
+        Both revisions are rebuilt, so updates don't wait on extracting their text.
+
+        Args:
+            file_id (str): ID for the Google Doc
+            revision (int): Number of the revision
+            current_path (str): Archive path of the current revision
+
+        Returns:
+            dict: "lines_added" and "lines_removed" counts and the unified "diff"
+        """
+        history = self.read_history(file_id)
+        old_data = self.get_revision(file_id, revision, current_path)
+        if revision + 1 < len(history):
+            new_data = self.get_revision(file_id, revision + 1, current_path)
+        else:
+            # get_revision checked the current file is the revision that replaced it
+            with open(current_path, "rb") as f:
+                new_data = f.read()
+        return diff_report(old_data, new_data, history[revision]["download_type"])
+
+
+def copy_revision(archive_path, copy_path):
+    """Copy an archived file, rebuilding zips that were removed after extraction
+
+    A rebuilt zip holds the same entries with the same CRCs as the original,
+    but isn't byte for byte the zip Drive exported.
+
+    Args:
+        archive_path (str): Path the file was archived at
+        copy_path (str): Path to copy it to
+
+    Returns:
+        bool: Whether the file could be copied
+    """
+    if os.path.exists(archive_path):
+        # a hardlink keeps the old bytes once the download replaces the file
+        link_or_copy(archive_path, copy_path)
+        return True
+    if archive_path[-4:] != ".zip":
+        return False
+    folder_path = archive_path[:-4]
+    marker = read_marker(folder_path)
+    # rewritten files no longer hold what the zip did, and moving files rewrites the HTML
+    if marker is None or marker.get("rewritten"):
+        return False
+    with zipfile.ZipFile(copy_path, "w", zipfile.ZIP_DEFLATED) as zip_f:
+        for file_name, (crc, _) in marker["entries"].items():
+            if file_name.endswith("/"):
+                zip_f.writestr(file_name, b"")
+                continue
+            entry_path = os.path.join(folder_path, file_name)
+            if not os.path.exists(entry_path):
+                break
+            with open(entry_path, "rb") as f:
+                data = f.read()
+            if zipfile.crc32(data) != crc:
+                break
+            zip_f.writestr(file_name, data)
+        else:
+            return True
+    os.remove(copy_path)
+    return False
+
+
+def make_delta(base, target):
+    """Encode target as blocks copied from base and literal bytes
+
+    Blocks of the base are looked up by their hash and compared in place, so
+    only the offsets are held in memory.
+
+    Args:
+        base (bytes or mmap): Contents the delta is applied to
+        target (bytes or mmap): Contents the delta rebuilds
+
+    Yields:
+        bytes: Parts of the uncompressed delta
+    """
+    block_offsets = {}
+    for offset, block in iter_blocks(base):
+        if len(block) >= MIN_MATCH:
+            block_offsets.setdefault(hash(block), offset)
+    yield DELTA_MAGIC
+    copy_start, copy_length = None, 0
+    literal = []
+    for _, block in iter_blocks(target):
+        block_offset = block_offsets.get(hash(block)) if len(block) >= MIN_MATCH else None
+        if block_offset is not None and base[block_offset:block_offset + len(block)] != block:
+            block_offset = None
+        if block_offset is None:
+            if copy_length:
+                yield COPY_OP + struct.pack("<QQ", copy_start, copy_length)
+                copy_start, copy_length = None, 0
+            literal += [block]
+            continue
+        if literal:
+            literal_bytes = b"".join(literal)
+            yield LITERAL_OP + struct.pack("<Q", len(literal_bytes)) + literal_bytes
+            literal = []
+        # extend the copy when the block follows on in the base
+        if copy_length and copy_start + copy_length == block_offset:
+            copy_length += len(block)
+        else:
+            if copy_length:
+                yield COPY_OP + struct.pack("<QQ", copy_start, copy_length)
+            copy_start, copy_length = block_offset, len(block)
+    if copy_length:
+        yield COPY_OP + struct.pack("<QQ", copy_start, copy_length)
+    if literal:
+        literal_bytes = b"".join(literal)
+        yield LITERAL_OP + struct.pack("<Q", len(literal_bytes)) + literal_bytes
+
+
+def iter_blocks(data):
+    """Split contents into blocks ending after a newline or the end of a tag
+
+    Args:
+        data (bytes or mmap): Contents to split
+
+    Yields:
+        (int, bytes): Offset and contents of each block
+    """
+    start = 0
+    for match in BLOCK_END.finditer(data):
+        yield start, data[start:match.end()]
+        start = match.end()
+    if start < len(data):
+        yield start, data[start:]
+
+
+def apply_delta(base, delta):
+    """Rebuild the target of a delta
+
+    Args:
+        base (bytes): Contents the delta was made against
+        delta (bytes): Uncompressed delta from make_delta
+
+    Returns:
+        bytes: Contents of the target
+    """
+    if delta[:len(DELTA_MAGIC)] != DELTA_MAGIC:
+        raise ValueError("Not a delta")
+    parts = []
+    pos = len(DELTA_MAGIC)
+    while pos < len(delta):
+        op = delta[pos:pos + 1]
+        if op == COPY_OP:
+            start, length = struct.unpack_from("<QQ", delta, pos + 1)
+            parts += [base[start:start + length]]
+            pos += 17
+        elif op == LITERAL_OP:
+            length, = struct.unpack_from("<Q", delta, pos + 1)
+            parts += [delta[pos + 9:pos + 9 + length]]
+            pos += 9 + length
+        else:
+            raise ValueError("Unexpected delta op at byte " + str(pos))
+    return b"".join(parts)
+
+
+def diff_report(old_data, new_data, download_type):
+    """Diff the text of two revisions of a guide
+
+    Args:
+        old_data (bytes): Contents of the earlier revision
+        new_data (bytes): Contents of the new revision
+        download_type (str): mimeType the revisions were downloaded as
+
+    Returns:
+        dict: "lines_added" and "lines_removed" counts and the unified "diff"
+    """
+    old_lines = revision_text_lines(old_data, download_type)
+    new_lines = revision_text_lines(new_data, download_type)
+    if old_lines is None or new_lines is None:
+        return {"lines_added": None, "lines_removed": None,
+                "diff": "Text diff isn't available for {}\n".format(download_type)}
+    diff_lines = list(difflib.unified_diff(old_lines, new_lines, "before", "after", lineterm=""))
+    lines_added = sum(1 for line in diff_lines
+                      if line.startswith("+") and not line.startswith("+++"))
+    lines_removed = sum(1 for line in diff_lines
+                        if line.startswith("-") and not line.startswith("---"))
+    if len(diff_lines) > MAX_DIFF_LINES:
+        diff_lines = diff_lines[:MAX_DIFF_LINES] + ["... {} more lines".format(
+            len(diff_lines) - MAX_DIFF_LINES)]
+    return {"lines_added": lines_added, "lines_removed": lines_removed,
+            "diff": "\n".join(diff_lines) + "\n"}
+
+
+def revision_text_lines(data, download_type):
+    """Get the lines of text of a revision
+
+    Args:
+        data (bytes): Contents of the revision
+        download_type (str): mimeType it was downloaded as
+
+    Returns:
+        list: Nonblank lines of text or None if the type can't be read
+    """
+    try:
+        if download_type == "application/zip":
+            with zipfile.ZipFile(io.BytesIO(data)) as zip_f:
+                html_names = [name for name in zip_f.namelist() if name.endswith(".html")]
+                if not html_names:
+                    return []
+                extractor = TextExtractor()
+                extractor.feed(zip_f.read(html_names[0]).decode("utf-8", errors="replace"))
+            parts = extractor.text_parts
+        elif download_type == "application/pdf":
+            # only needed for PDF diffs, so history is kept without it
+            from pypdf import PdfReader
+            parts = [page.extract_text() or "" for page in PdfReader(io.BytesIO(data)).pages]
+        else:
+            return None
+    except ImportError:
+        return None
+    except Exception as e:
+        print_exception("Exception for revision text of type:", str(download_type), e)
+        return None
+    return [line.strip() for part in parts for line in part.splitlines() if line.strip()]
+
+
+@contextmanager
+def map_file(file_path):
+    """Map a file into memory read only, rather than reading it
+
+    Args:
+        file_path (str): Path to the file
+
+    Yields:
+        mmap: Contents of the file, or empty bytes for an empty file
+    """
+    with open(file_path, "rb") as f:
+        # empty files can't be mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
+
+
+def write_compressed(file_path, chunks):
+    """Compress chunks of bytes into a file, replacing the old file only once fully written
+
+    Args:
+        file_path (str): Path to write
+        chunks (iterable): Bytes to compress, in order
+
+    Returns:
+        int: Size of the compressed file
+    """
+    compressor = lzma.LZMACompressor()
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        for chunk in chunks:
+            f.write(compressor.compress(chunk))
+        f.write(compressor.flush())
+    os.replace(tmp_path, file_path)
+    note_written(file_path)
+    return os.path.getsize(file_path)
+
+
+def write_atomic(file_path, data):
+    """Write bytes to a file, replacing the old file only once fully written
+
+    Args:
+        file_path (str): Path to write
+        data (bytes): Contents
+    """
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, file_path)
+    note_written(file_path)
+
+
+def format_history(file_id, history):
+    """Format the stored revisions of a file as a table
+
+    Args:
+        file_id (str): ID for the Google Doc
+        history (list): History entries, oldest first
+
+    Returns:
+        str: Report of the revisions
+    """
+    lines = ["History of " + file_id]
+    for entry in history:
+        lines += ["  {:>3}  replaced {}  modified {}  {:>9} B as {:>8} B".format(
+            entry["revision"], entry["archived"], entry["modifiedTime"], entry["size"],
+            entry["stored_size"])]
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    # python versions.py [file ID [revision [--diff | --output path]]]
+    from manifest import ArchiveManifest
+
+    store = VersionStore()
+    args = sys.argv[1:]
+    if not args:
+        # list the files with history
+        file_ids = sorted(file_id for file_id in os.listdir(VERSIONS_DIR)
+                          if os.path.isdir(os.path.join(VERSIONS_DIR, file_id))) \
+            if os.path.isdir(VERSIONS_DIR) else []
+        for file_id in file_ids:
+            print("{}  {} revisions".format(file_id, len(store.read_history(file_id))))
+    elif len(args) == 1:
+        print(format_history(args[0], store.read_history(args[0])))
+    elif "--diff" in args[2:]:
+        manifest_entry = ArchiveManifest().entries[args[0]]
+        report = store.diff_revision(args[0], int(args[1]), manifest_entry["path"])
+        print("+{} -{} lines".format(report["lines_added"], report["lines_removed"]))
+        print(report["diff"])
+    else:
+        manifest_entry = ArchiveManifest().entries[args[0]]
+        data = store.get_revision(args[0], int(args[1]), manifest_entry["path"])
+        output_path = args[args.index("--output") + 1] if "--output" in args else None
+        if output_path is None:
+            sys.stdout.buffer.write(data)
+        else:
+            write_atomic(output_path, data)
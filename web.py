@@ -1,64 +1,461 @@
-from functools import partial
+import hashlib
+import mimetypes
 from multiprocessing.dummy import Pool
+import os
+import re
+from threading import BoundedSemaphore, get_ident, Lock
+from urllib.parse import urljoin, urlsplit
 
-from pywebcopy import webpage, config
+from cache import JsonCache, note_written
+from dedup import get_blob_path
+from runlog import count, span
+from utils import print_exception
 
 
-# modified version of pywebcopy api's savewebpage to return filepath
-def save_webpage_with_path(url, project_folder, html=None, project_name=None,
-                           encoding=None, reset_config=False, popup=False, **kwargs):
-    # Set up the global configuration
-    config.setup_config(url, project_folder, project_name, **kwargs)
+# tag attributes that load resources, keyed by the option that enables them
+RESOURCE_TAGS = {
+    "load_css": [("link", "href")],
+    "load_javascript": [("script", "src")],
+    "load_images": [("img", "src")],
+}
+# Content-Types saved as pages rather than byte for byte
+HTML_TYPES = ["text/html", "application/xhtml+xml"]
+# url() and @import references in stylesheets, with the quotes around them
+CSS_URL_PATTERN = re.compile(
+    r"""(url\(\s*)(["']?)([^"')\s]+)\2(\s*\))|(@import\s+)(["'])([^"']+)\6""")
+
+
+class WebArchiver():
+    """Archive web pages and the resources they load
+
+    All settings live on the instance, so one archiver can save many pages
+    from many threads. Connections are pooled and kept alive per host, and
+    the number of requests in flight to any one host is limited.
+    """
+    def __init__(self, project_folder="archive", project_name="websites", num_threads=16,
+                 per_host_limit=4, load_css=True, load_javascript=True, load_images=True,
+                 timeout=30):
+        self.folder_path = os.path.join(project_folder, project_name)
+        # number of threads to use when multithreading
+        self.num_threads = num_threads
+        self.options = {
+            "load_css": load_css,
+            "load_javascript": load_javascript,
+            "load_images": load_images,
+        }
+        self.timeout = timeout
+        # imported here so stages that don't archive web pages skip loading requests
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        # pooled session shared by all threads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=num_threads, pool_maxsize=num_threads)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["User-Agent"] = "Mozilla/5.0 (compatible; PFGuideArchive)"
+        # limit on concurrent requests to each host
+        self.per_host_limit = per_host_limit
+        self._host_semaphores = {}
+        self._host_lock = Lock()
+        # ETag, Last-Modified and content hash of every URL saved before
+        self.validators = JsonCache("web_validators.json")
+        # resources saved during this run, so pages sharing them fetch them once
+        self._resource_paths = {}
+        self._resource_locks = {}
+        self._resource_lock = Lock()
+
+    def save_webpage(self, url, html=None, encoding=None):
+        """Save a web page and the resources it loads
+
+        Pages and resources that haven't changed since they were last saved,
+        by their validators or content hash, are not written again. An unchanged
+        page is saved again if any resource it loads has changed, so it points
+        at the new copy.
+
+        Args:
+            url (str): URL of the page
+            html (str, optional): Source to save instead of fetching the page. Defaults to None.
+            encoding (str, optional): Encoding of the page. Defaults to the detected encoding.
+
+        Returns:
+            str: Path to the saved page
+        """
+        response = None
+        if html is None:
+            response = self.fetch_if_changed(url)
+            if response is None:
+                entry = self.validators.get(url)
+                if not self.resources_changed(entry):
+                    return entry["path"]
+                response = self.fetch(url)
+            content_type = get_content_type(response)
+            if content_type and content_type not in HTML_TYPES:
+                # PDFs and other files linked as guides are kept as they are
+                file_path = self.url_to_path(response.url, content_type=content_type)
+                self.write_file(file_path, response.content)
+                self.record_validators(url, file_path, response, resources={})
+                return file_path
+            if encoding is not None:
+                response.encoding = encoding
+            html = response.text
+            page_url = response.url
+        else:
+            page_url = url
+        from bs4 import BeautifulSoup
+
+        file_path = self.url_to_path(page_url, is_page=True)
+        soup = BeautifulSoup(html, "html.parser")
+        # save the resources and point the page at the saved copies
+        resource_paths = {}
+        for option, tag_attrs in RESOURCE_TAGS.items():
+            if not self.options[option]:
+                continue
+            for tag_name, attr in tag_attrs:
+                for tag in soup.find_all(tag_name):
+                    if not tag.get(attr) or (tag_name == "link" and
+                                             "stylesheet" not in tag.get("rel", [])):
+                        continue
+                    resource_url = urljoin(page_url, tag[attr])
+                    resource_path = self.save_resource(resource_url)
+                    if resource_path is not None:
+                        resource_paths[resource_url] = resource_path
+                        relative_path = os.path.relpath(resource_path, os.path.dirname(file_path))
+                        tag[attr] = relative_path.replace("\\", "/")
+        self.write_file(file_path, soup.encode(formatter="minimal"))
+        if response is not None:
+            self.record_validators(url, file_path, response, resources=resource_paths)
+        return file_path
+
+    def save_resource(self, url, stylesheet_urls=()):
+        """Save a resource loaded by a page in the shared asset store
+
+        Resources are stored once by content hash, so pages from the same site
+        share one copy of its CSS, scripts and images. Each URL is checked at
+        most once per run. Stylesheets are stored with their url() and @import
+        references pointing at saved copies too.
+
+        Args:
+            url (str): URL of the resource
+            stylesheet_urls (tuple, optional): URLs of the stylesheets that reference
+                                               this one, innermost last. Defaults to ().
+
+        Returns:
+            str: Path to the saved resource or None if it couldn't be saved
+        """
+        if urlsplit(url).scheme not in ["http", "https"] or url in stylesheet_urls:
+            return None
+        with self._resource_lock:
+            url_lock = self._resource_locks.setdefault(url, Lock())
+        # stylesheets importing each other from two threads would otherwise wait forever
+        if not url_lock.acquire(timeout=self.timeout if stylesheet_urls else -1):
+            return None
+        try:
+            if url in self._resource_paths:
+                return self._resource_paths[url]
+            file_path = None
+            try:
+                response = self.fetch_if_changed(url)
+                if response is None:
+                    entry = self.validators.get(url)
+                    # the saved copy may have been removed since the validators were checked
+                    if not os.path.exists(entry["path"]) or \
+                       self.resources_changed(entry, stylesheet_urls + (url,)):
+                        response = self.fetch(url)
+                if response is not None:
+                    content = response.content
+                    resource_paths = None
+                    content_type = get_content_type(response)
+                    ext = os.path.splitext(sanitize_path_part(urlsplit(url).path))[1][:8] or \
+                        mimetypes.guess_extension(content_type) or ""
+                    if content_type == "text/css" or ext.lower() == ".css":
+                        content, resource_paths = self.save_stylesheet_resources(
+                            response.url, response.text, stylesheet_urls + (url,))
+                    file_path = get_blob_path(hashlib.sha256(content).hexdigest(), ext)
+                    if not os.path.exists(file_path):
+                        self.write_file(file_path, content)
+                    self.record_validators(url, file_path, response, resources=resource_paths)
+                else:
+                    file_path = entry["path"]
+            except Exception as e:
+                print_exception("Exception for resource:", url, e)
+            self._resource_paths[url] = file_path
+        finally:
+            url_lock.release()
+        return file_path
+
+    def save_stylesheet_resources(self, url, css, stylesheet_urls):
+        """Save the resources a stylesheet references and point it at the saved copies
+
+        Args:
+            url (str): URL the stylesheet was loaded from
+            css (str): Source of the stylesheet
+            stylesheet_urls (tuple): URLs of the stylesheet and those referencing it
+
+        Returns:
+            (bytes, dict): Stylesheet with its references rewritten, encoded as UTF-8,
+                           URLs of the saved resources mapped to their paths
+        """
+        # every blob folder is one level below the store, so paths between blobs don't
+        # depend on the hash of the stylesheet
+        store_folder = os.path.dirname(get_blob_path("00", ""))
+        resource_paths = {}
+
+        def replace_reference(match):
+            prefix, quote, reference, suffix = match.group(1, 2, 3, 4) \
+                if match.group(1) is not None else match.group(5, 6, 7, 6)
+            if reference.startswith("data:") or reference.startswith("#"):
+                return match.group(0)
+            resource_url = urljoin(url, reference)
+            resource_path = self.save_resource(resource_url, stylesheet_urls)
+            if resource_path is None:
+                # relative references would break once the stylesheet is in the store
+                return prefix + quote + resource_url + suffix
+            resource_paths[resource_url] = resource_path
+            relative_path = os.path.relpath(resource_path, store_folder).replace("\\", "/")
+            return prefix + quote + relative_path + suffix
+
+        css = CSS_URL_PATTERN.sub(replace_reference, css)
+        return css.encode("utf-8"), resource_paths
+
+    def resources_changed(self, entry, stylesheet_urls=()):
+        """Revalidate the resources of an unchanged page or stylesheet
+
+        Resources are stored by content hash, so a changed resource is saved
+        at a new path that the old copy of the page doesn't point at.
+
+        Args:
+            entry (dict): Validators recorded for the page or stylesheet
+            stylesheet_urls (tuple, optional): URLs of the stylesheet and those
+                                               referencing it. Defaults to ().
+
+        Returns:
+            bool: Whether any resource was saved at a different path than recorded
+        """
+        resources = entry.get("resources", {})
+        if isinstance(resources, list):
+            # recorded before resource paths were kept, so they can't be compared
+            return True
+        changed = False
+        for resource_url, old_path in resources.items():
+            resource_path = self.save_resource(resource_url, stylesheet_urls)
+            # a resource that can't be fetched now keeps its old copy
+            if resource_path is not None and resource_path != old_path:
+                changed = True
+        return changed
+
+    def fetch_if_changed(self, url):
+        """GET a URL unless it is unchanged since it was last saved
+
+        Sends the saved ETag and Last-Modified as a conditional request, then
+        compares content hashes for servers that don't support validators.
+
+        Args:
+            url (str): URL to get
 
-    # Create a object of web page
-    wp = webpage()
-    wp.url = config['project_url']
-    wp.path = config['project_folder']
+        Returns:
+            requests.Response: Response for the URL or None if it is unchanged
+        """
+        entry = self.validators.get(url)
+        if entry is not None and not os.path.exists(entry["path"]):
+            entry = None
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        response = self.fetch(url, headers=headers)
+        if entry is None:
+            return response
+        if response.status_code == 304:
+            count("cache_hits")
+            return None
+        if hashlib.sha256(response.content).hexdigest() == entry["sha256"]:
+            # keep the new validators so the next run can get a 304
+            self.record_validators(url, entry["path"], response, entry.get("resources"))
+            return None
+        return response
 
-    #: Remove the extra files downloading if requested
-    if not config.get('load_css'):
-        wp.deregister_tag_handler('link')
-        wp.deregister_tag_handler('style')
-    if not config.get('load_javascript'):
-        wp.deregister_tag_handler('script')
-    if not config.get('load_images'):
-        wp.deregister_tag_handler('img')
+    def record_validators(self, url, file_path, response, resources=None):
+        """Record the validators of a saved URL
 
-    if html:
-        #: only set url in manual mode because its internally
-        #: set in the get() method
-        wp.set_source(html, encoding)
+        Args:
+            url (str): URL that was saved
+            file_path (str): Path it was saved to
+            response (requests.Response): Response it was saved from
+            resources (dict, optional): URLs of the resources of a page or stylesheet
+                                        mapped to their paths. Defaults to None.
+        """
+        entry = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "sha256": hashlib.sha256(response.content).hexdigest(),
+            "path": file_path,
+        }
+        if resources is not None:
+            entry["resources"] = resources
+        self.validators.set(url, entry)
 
-    else:
-        wp.get(wp.url)
+    def fetch(self, url, headers=None):
+        """GET a URL, waiting for a free slot for its host
 
-    # If encoding is specified then change it otherwise a default encoding is
-    # always internally set by the get() method
-    if encoding:
-        wp.encoding = encoding
+        Args:
+            url (str): URL to get
+            headers (dict, optional): Extra request headers. Defaults to None.
 
-    # Instruct it to save the complete page
-    wp.save_complete()
+        Returns:
+            requests.Response: Response for the URL
+        """
+        with self.get_host_semaphore(urlsplit(url).netloc):
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+        count("http_requests")
+        response.raise_for_status()
+        return response
 
-    if reset_config:
-        # reset the config so that it does not mess up any con-current calls to
-        # the different web pages
-        config.reset_config()
+    def get_host_semaphore(self, host):
+        """Get the semaphore limiting concurrent requests to a host
 
-    return wp.utx.file_path
+        Args:
+            host (str): Host of the URL
+
+        Returns:
+            BoundedSemaphore: Semaphore for the host
+        """
+        with self._host_lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = BoundedSemaphore(self.per_host_limit)
+            return self._host_semaphores[host]
+
+    def url_to_path(self, url, is_page=False, content_type=None):
+        """Map a URL to a path in the project folder
+
+        Args:
+            url (str): URL to map
+            is_page (bool, optional): Whether the URL is a page, which always gets an
+                                      .html extension. Defaults to False.
+            content_type (str, optional): Content-Type giving the extension of URLs
+                                          without one. Defaults to None.
+
+        Returns:
+            str: Path for the saved URL
+        """
+        split_url = urlsplit(url)
+        path = split_url.path
+        if path == "" or path.endswith("/"):
+            path += "index.html"
+        path_parts = [sanitize_path_part(part) for part in path.split("/") if part]
+        name, ext = os.path.splitext(path_parts[-1])
+        # keep pages with different queries apart
+        if split_url.query:
+            name += "_" + hashlib.md5(split_url.query.encode("utf-8")).hexdigest()[:8]
+        if is_page and ext.lower() not in [".html", ".htm"]:
+            ext += ".html"
+        elif not ext and content_type is not None:
+            ext = mimetypes.guess_extension(content_type) or ""
+        path_parts[-1] = name + ext
+        return os.path.join(self.folder_path, sanitize_path_part(split_url.netloc), *path_parts)
+
+    def write_file(self, file_path, content):
+        """Write a file, replacing any old copy only once fully written
+
+        Args:
+            file_path (str): Path to write
+            content (bytes): Contents of the file
+        """
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(file_path, get_ident())
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, file_path)
+        note_written(file_path)
+        count("bytes", len(content))
+
+    def save_webpages(self, urls):
+        """Save web pages on multiple threads
+
+        Args:
+            urls (list): URLs of the pages
+
+        Returns:
+            list: Paths to the saved pages or None, in the same order as urls
+        """
+        def save_webpage(url):
+            with span(url, kind="file", stage="web"):
+                try:
+                    return self.save_webpage(url)
+                except Exception as e:
+                    print_exception("Exception for web page:", url, e)
+                    return None
+
+        thread_pool = Pool(self.num_threads)
+        with span("web"):
+            archive_paths = thread_pool.map(save_webpage, urls)
+        # close threads, but don't bother waiting for them to free resources
+        thread_pool.close()
+        self.validators.save()
+        return archive_paths
+
+
+def get_content_type(response):
+    """Get the media type of a response without its parameters
+
+    Args:
+        response (requests.Response): Response to check
+
+    Returns:
+        str: Lowercase media type, such as "text/html", or "" if the server sent none
+    """
+    return response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+
+
+def sanitize_path_part(part):
+    """Map characters that are invalid in paths to underscores
+
+    Args:
+        part (str): Part of a URL path
+
+    Returns:
+        str: Part usable as a file or folder name
+    """
+    return "".join("_" if char in "<>:\"\\|?*" else char for char in part)
+
+
+def save_webpage_with_path(url, project_folder, html=None, project_name=None,
+                           encoding=None, **kwargs):
+    """Save a web page and return the path it was saved to
+
+    Args:
+        url (str): URL of the page
+        project_folder (str): Folder to save projects in
+        html (str, optional): Source to save instead of fetching the page. Defaults to None.
+        project_name (str, optional): Folder in the project folder. Defaults to the page host.
+        encoding (str, optional): Encoding of the page. Defaults to the detected encoding.
+        **kwargs: Options for WebArchiver
+
+    Returns:
+        str: Path to the saved page
+    """
+    if project_name is None:
+        project_name = urlsplit(url).netloc
+    archiver = WebArchiver(project_folder, project_name, **kwargs)
+    file_path = archiver.save_webpage(url, html=html, encoding=encoding)
+    archiver.validators.save()
+    return file_path
 
 
 def save_webpages_with_path(urls):
-    num_threads = 4
-    # save webpages on multiple threads
-    thread_pool = Pool(num_threads)
-    archive_url = partial(save_webpage_with_path,
-        project_folder="archive",
-        project_name="websites",
-        reset_config=True,
-        bypass_robots=True
-    )
-    archive_paths = thread_pool.map(archive_url, urls)
-    # close threads, but don't bother waiting for them to free resources
-    thread_pool.close()
-    return archive_paths
+    archiver = WebArchiver(project_folder="archive", project_name="websites")
+    return archiver.save_webpages(urls)
+
+
+def save_webpage_records(records):
+    """Archive the non-Docs guides of guide records, setting their archive paths
+
+    Args:
+        records (GuideRecords): Guide records to archive the web pages of
+    """
+    urls = records.unique_urls(is_docs=False)
+    archive_paths = save_webpages_with_path(urls)
+    for url, archive_path in zip(urls, archive_paths):
+        records.set_archive_path(url, archive_path)
@@ -1,17 +1,87 @@
-from bs4 import BeautifulSoup
+import hashlib
+import json
+
+from cache import JsonCache
+from records import GuideRecord, GuideRecords
+from runlog import span
 
 
 ZENITH_BACKUP_PATH = r"ZenithGames\Zenith Games The Comprehensive Pathfinder Guides Guide.html"
 ZENITH_DIV_ID = "post-body-500675332292381825"
+# bump when get_link_table changes, so link tables cached by older code are rebuilt
+LINK_TABLE_VERSION = 1
 
 
 class ZenithParser():
     """Parse "The Comprehensive Pathfinder Guides Guide" by Zenith Games
     """
-    def __init__(self):
-        with open(ZENITH_BACKUP_PATH) as f:
-            soup = BeautifulSoup(f, "html.parser")
-        self.post_div = soup.find(id=ZENITH_DIV_ID)
+    def __init__(self, backup_path=ZENITH_BACKUP_PATH):
+        with open(backup_path) as f:
+            self.page_str = f.read()
+        self._post_div = None
+        # reuse the link table from an earlier run if neither the backup nor the
+        # class and blacklist tables below have changed
+        page_hash = hashlib.sha256(self.page_str.encode("utf-8")).hexdigest()
+        table_key = page_hash + "-" + get_parse_settings_hash()
+        link_cache = JsonCache("zenith_links.json")
+        with span("parse") as parse_span:
+            self.links = link_cache.get(table_key)
+            if self.links is None:
+                self.links = self.get_link_table()
+                link_cache.set(table_key, self.links)
+                link_cache.save()
+            else:
+                parse_span.count("cache_hits")
+        # build the results of every accessor in one pass over the table
+        self._docs_urls = ([], [])
+        self._non_docs_urls = ([], [])
+        self._guide_urls = ([], [], [])
+        for url, label, link_class, is_docs, blacklisted in self.links:
+            if is_docs:
+                self._docs_urls[0].append(url)
+                self._docs_urls[1].append(label)
+            elif not blacklisted:
+                self._non_docs_urls[0].append(url)
+                self._non_docs_urls[1].append(label.strip())
+            if link_class is not None:
+                self._guide_urls[0].append(url)
+                self._guide_urls[1].append(label)
+                self._guide_urls[2].append(link_class)
+
+    @property
+    def post_div(self):
+        """Div holding the guide links, parsed only when first needed
+        """
+        if self._post_div is None:
+            # only needed when the link table isn't cached, so imported here
+            from bs4 import BeautifulSoup, SoupStrainer
+            # only build the tree for the post div instead of the whole page
+            strainer = SoupStrainer(id=ZENITH_DIV_ID)
+            soup = BeautifulSoup(self.page_str, "html.parser", parse_only=strainer)
+            self._post_div = soup.find(id=ZENITH_DIV_ID)
+        return self._post_div
+
+    def get_link_table(self):
+        """Parse every link in the HTML in a single pass
+
+        Returns:
+            list: Rows of [url, label, class, is_docs, blacklisted] for each link
+        """
+        links = []
+        # data structures for tracking classes for links
+        cur_class = None
+        dict_counter = {}
+        for tag in self.post_div.find_all("a"):
+            url = tag["href"]
+            # update class for the links if boundary found
+            if url in url_to_class:
+                dict_count = min(dict_counter.get(url, 0), len(url_to_class[url]) - 1)
+                cur_class = url_to_class[url][dict_count]
+                dict_counter[url] = dict_counter.get(url, 0) + 1
+            is_docs = url.startswith("https://docs.google.com") or \
+                url.startswith("https://drive.google.com")
+            links += [[url, tag.text, cur_class, is_docs, tag.text in link_label_blacklist]]
+        return links
 
     def get_docs_urls(self):
         """Get Google Docs URLs linked in the HTML
@@ -20,15 +90,7 @@ class ZenithParser():
             (list, list): List of Google Docs URLs
                           List of labels given to the links
         """
-        docs_urls = []
-        link_labels = []
-        for tag in self.post_div.find_all("a"):
-            url = tag["href"]
-            if url.startswith("https://docs.google.com") or \
-               url.startswith("https://drive.google.com"):
-                docs_urls += [url]
-                link_labels += [tag.text]
-        return docs_urls, link_labels
+        return self._docs_urls
 
     def get_non_docs_urls(self):
         """Get non-Docs guide URLs linked in the HTML
@@ -37,16 +99,7 @@ class ZenithParser():
             (list, list): List of non-Docs guide URLs
                           List of labels given to the links
         """
-        non_docs_urls = []
-        link_labels = []
-        for tag in self.post_div.find_all("a"):
-            url = tag["href"]
-            if tag.text not in link_label_blacklist and \
-                not (url.startswith("https://docs.google.com") or \
-                     url.startswith("https://drive.google.com")):
-                non_docs_urls += [url]
-                link_labels += [tag.text.strip()]
-        return non_docs_urls, link_labels
+        return self._non_docs_urls
 
     def get_guide_urls(self):
         """Get URLs to guides linked in the HTML
@@ -56,26 +109,15 @@ class ZenithParser():
                                 List of labels given to the links
                                 List of classes for the links
         """
-        # data structures for returns
-        urls = []
-        link_labels = []
-        link_class = []
-        # data structures for tracking classes for links
-        cur_class = None
-        dict_counter = {}
-        for tag in self.post_div.find_all("a"):
-            url = tag["href"]
-            # update class for the links if boundary found
-            if url in url_to_class:
-                dict_count = min(dict_counter.get(url, 0), len(url_to_class[url]) - 1)
-                cur_class = url_to_class[url][dict_count]
-                dict_counter[url] = dict_counter.get(url, 0) + 1
-            # record the data for the link
-            if cur_class is not None:
-                urls += [url]
-                link_labels += [tag.text]
-                link_class += [cur_class]
-        return urls, link_labels, link_class
+        return self._guide_urls
+
+    def get_guide_records(self):
+        """Get records for the guides linked in the HTML
+
+        Returns:
+            GuideRecords: Records for every link with a class, in page order
+        """
+        return links_to_records(self.links)
 
     def print_class_dict_rough(self):
         """Prints a rough version of class_to_url for updating
@@ -99,6 +141,31 @@ class ZenithParser():
                     print("\"" + text + "\":\"" + link + "\",")
 
 
+def get_parse_settings_hash():
+    """Get a hash of the tables and code version the link table is parsed with
+
+    Returns:
+        str: Hex digest of LINK_TABLE_VERSION, class_to_url and link_label_blacklist
+    """
+    # order matters, since it decides which class a repeated boundary link starts
+    settings = [LINK_TABLE_VERSION, list(class_to_url.items()), link_label_blacklist]
+    return hashlib.sha256(json.dumps(settings).encode("utf-8")).hexdigest()
+
+
+def links_to_records(links):
+    """Build guide records from rows of the link table
+
+    Args:
+        links (list): Rows of [url, label, class, is_docs, blacklisted]
+
+    Returns:
+        GuideRecords: Records for every link with a class, in page order
+    """
+    return GuideRecords(GuideRecord(url, label, link_class, is_docs, blacklisted)
+                        for url, label, link_class, is_docs, blacklisted in links
+                        if link_class is not None)
+
+
 class_to_url = {
     "alchemist": "http://zenithgames.blogspot.com/2015/11/zeniths-guide-to-alchemist-part-i.html",
     "arcanist": "https://docs.google.com/document/d/19eADtzhxjNq8n8esfos6gnmotwPAIFot-ouLztuQtqA/pub",  # noqa: E501